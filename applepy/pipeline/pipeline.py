@@ -2,141 +2,314 @@
 import pandas as pd
 import time
 import os
+import sys
+import traceback
+import psutil
+import polars as pl
 from os.path import join as pjoin
 from contextlib import contextmanager
-from multiprocessing import Pool, Manager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from tqdm import tqdm
-from functools import partial
 
 from ..utils.preprocessing.checks import *
 from ..utils.preprocessing.interpolation import *
 from ..utils.calculations.bias_correction import *
 from ..utils.helper import *
-
-def el2_pipeline(fp, template_fp = '../applepy/template/RuleTables.xlsx'):
+from ..utils.storage import *
+from ..utils.template import *
+from ..utils.manifest import *
+from ..utils.lazy import *
+from ..utils.instrument import *
+
+def el2_plan(lf, template, compiled_overrides = None, base_year = 2020):
+    # lazy polars plan of the el2_pipeline stages of one submission (see el2_pipeline with backend='polars')
+    # lf is the submission as a LazyFrame (see scan_agmip_csv and to_lazy), template a CompiledTemplate, and compiled_overrides
+    # the compiled overrides file (see compile_overrides), or None if there is no overrides file
+    # returns the LazyFrames of the stage outputs by name, and 'lengths', the row counts of the input and the stages (and the model name).
+    # They share the scan of the submission, collect them together with pl.collect_all
+    lengths = [lf.select(pl.len().alias('input'), pl.col('model').drop_nulls().first().alias('model'))]
+    plan = {}
+    clean, plan['duplicates'] = lazy_duplicates(lf)
+    lengths.append(clean.select(pl.len().alias('duplicates')))
+
+    keep_variables = pl.col('variable').is_in(pl.Series(list(template.keep_variables), dtype=pl.String).implode()).fill_null(False)
+    plan['variables-to-keep'] = clean.filter(keep_variables)
+    clean = clean.filter(~keep_variables)
+
+    if compiled_overrides != None:
+        clean, plan['overrides'], keep = lazy_overrides(clean, compiled_overrides)
+        plan['overrides-removed'] = clean
+        plan['overrides-kept'] = keep
+    else:
+        keep = clean.head(0)
+
+    clean, plan['template-exceptions'] = lazy_template(clean, template)
+    lengths.append(clean.select(pl.len().alias('template')))
+    clean = pl.concat([clean, keep, plan['variables-to-keep']], how='vertical_relaxed')
+    lengths.append(clean.select(pl.len().alias('concatenated')))
+    clean = clean.drop(INDEX_COL).with_row_index(INDEX_COL).with_columns(pl.col(INDEX_COL).cast(pl.Int64))
+    plan['template-checked'], _ = lazy_duplicates(clean)
+    plan['pc-diff'] = lazy_pc_diff(plan['template-checked'], base_year)
+    # row counts of the input and of the intermediate stages, for the run report
+    plan['lengths'] = pl.concat(lengths, how='horizontal')
+    return plan
+
+def el2_pipeline(fp, template_fp = '../applepy/template/RuleTables.xlsx', file_format = 'csv', save = True, data_dir = None, overrides_fp = None, manifest_entry = None, workers = 1, backend = 'pandas', report = None, base_year = 2020):
     # TODO: 
     # - assertion that there is only one unique model in df
     # - rename all output files with model identifier  
-    data_dir = '/'.join(fp.split('/')[:-1])
-    overrides_fp = fp.split('.csv')[0]+'_OVERRIDES_fix.csv'
-    # open file
-    df = AgMIP_read_raw_csv(fp)
-
-    # get model name
-    model = df.model.unique()[0]
-    base_fn = model#fp.split('/')[-1].split('.csv')[0]
-
-    print(f"PROCESSING FILE : {base_fn}")
-    print(f">> original DataFrame length: {len(df)}")
-    print('\n')
-
-    ######################
-    ## DUPLICATES CHECK ##
-    ######################
-    # check duplicates
-    print(f">> checking duplicates")
-    clean_df, duplicates_df = check_duplicates(df)
-
-    duplicates_dir = pjoin(data_dir,'duplicates')
-    check_path(duplicates_dir)
-    duplicates_fp = pjoin(duplicates_dir,base_fn+'_duplicates.csv')
-    if len(duplicates_df)>0:
-        duplicates_df.to_csv(duplicates_fp)#,index=False)
-    print('\n')
-
-    #######################
-    ## VARIABLES TO KEEP ##
-    #######################
-    # set aside variables to keep
-    print(f">> setting aside variables to keep")
-    VariableUnitValueTable = pd.read_excel(template_fp,'VariableUnitValueTable')
-
-    variables_to_keep = VariableUnitValueTable[VariableUnitValueTable.Keep==1].Variable.values
-    variables_to_keep_df = clean_df[clean_df.variable.isin(variables_to_keep)]
-
-    if len(variables_to_keep_df)==0:
-        variables_to_keep_df = pd.DataFrame().reindex(columns=clean_df.columns)
-
-    # remove variables to keep from clean df, they will be added back later
-    clean_df = clean_df[~clean_df.variable.isin(variables_to_keep)]
-
-    print(f"... set aside variables to keep. DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/len(df))*100,0)}% of the original df")
-
-    ####################
-    ## OVERRIDE CHECK ##
-    ####################
-
-    # check overrides
-
-    print(f">> checking overrides")
-
-    if os.path.exists(overrides_fp):
-        clean_df,overrides_df,keep_df = check_overrides(clean_df,overrides_fp)
-    
-        print(f"... overrides checked. DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/len(df))*100,0)}% of the original df")
-
-        # save overrides-removed
-        overrides_dir = pjoin(data_dir,'overrides')
-        check_path(overrides_dir)
-        overridesRemoved_fp = pjoin(overrides_dir,base_fn+'_overrides-removed.csv')
-        clean_df.to_csv(overridesRemoved_fp,index=False)
-
-        # save updated overrides file
-        overrides_list = get_group_keys(overrides_df)
-        overridesList_fp = pjoin(overrides_dir,base_fn+'_overrides-list.csv')
-        overrides_list.to_csv(overridesList_fp)#,index=False)
-    else:
-        print(f"... no overrides file found!\n")
-        keep_df = pd.DataFrame().reindex(columns=clean_df.columns)
-    print('\n')
-
-    ####################
-    ## TEMPLATE CHECK ##
-    ####################
-
-    print(f">> checking against template")
-    clean_df,exception_df = check_template(clean_df,template_fp)
-
-    print(f"... template checked. DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/len(df))*100,0)}% of the original df")
-
-    print(f"... concatenating template-checked DataFrame with the kept overrides and variables to keep...")
-    clean_df = pd.concat([clean_df,keep_df,variables_to_keep_df],ignore_index=True)
-    
-    # check duplicates
-    print(f">> checking duplicates again")
-    clean_df, duplicates_df = check_duplicates(clean_df)
-
-    print(f"... DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/len(df))*100,0)}% of the original df")
-
-    templateChecked_dir = pjoin(data_dir,'template-checked')
-    check_path(templateChecked_dir)
-    templateChecked_fp = pjoin(templateChecked_dir,base_fn+'_template-checked.csv')
-    clean_df.to_csv(templateChecked_fp)#,index=False)
-
-    # save updated template exceptions file
-    exception_list = get_group_keys(exception_df)
-    exceptionList_fp = pjoin(templateChecked_dir,base_fn+'_template-exceptions-list.csv')
-    exception_list.to_csv(exceptionList_fp)#,index=False)
-    print('\n')
-
-    ####################
-    ## PERCENT CHANGE ##
-    ####################
-
-    print(f">> calculating percentage changes")
-
-    pcDiff_dir = pjoin(data_dir,'pc-diff')
-    check_path(pcDiff_dir)
-    pc_diff_interp(templateChecked_fp,output_dir=pcDiff_dir)
-    print('\n')
-
-    print(f"DONE PROCESSING : {base_fn}")
-
-
-# Context manager to redirect stdout to /dev/null
+    # fp is the path to the raw submission, or the submission already loaded as a DataFrame (then data_dir is needed to save the outputs)
+    # file_format sets how the stage outputs (duplicates, overrides-removed, template-checked, pc-diff) are saved: 'csv', 'parquet' or 'arrow'
+    # the stages are chained in memory; if save is False nothing is written to disk
+    # manifest_entry is the RunManifest entry of the submission (see el2_pipeline_multiprocess): the output files of each stage are recorded in it,
+    # and the pc-diff stage is reused when the template-checked data did not change
+    # workers sets the number of processes of the pc-diff stage (see pc_diff_interp); keep 1 inside el2_pipeline_multiprocess, whose workers already use all the cpus
+    # backend is 'pandas', or 'polars' to plan all the stages of the submission as one lazy polars plan (see el2_plan), optimized and
+    # run multi-threaded by polars in a single collect. The outputs are the same; workers is not used, and the pc-diff stage is not reused
+    # report is the RunReport the stages are recorded in (wall time, CPU time, peak memory, rows in/out and rows dropped by reason, see
+    # applepy.utils.instrument). If None, a new one is created, and saved to data_dir/logs/<model>_run-report.json if save is True
+    # base_year is the base year of the percentage changes (see pc_diff_interp), also in the name of the pc-diff output
+    # returns the pc-diff DataFrame
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    write_report = save and (report == None)
+    if report == None:
+        report = RunReport(fp.split('/')[-1] if isinstance(fp,str) else 'DataFrame')
+    report.info['backend'] = backend
+
+    # the instrumented functions (pc_diff_interp, ...) record their stages in the report, nested in the running stage
+    with report:
+        if isinstance(fp,pd.DataFrame):
+            df = fp
+            assert (not save) or (data_dir != None), "data_dir is needed to save the outputs of a DataFrame"
+        else:
+            if data_dir == None:
+                data_dir = '/'.join(fp.split('/')[:-1])
+            if overrides_fp == None:
+                overrides_fp = fp.split('.csv')[0]+'_OVERRIDES_fix.csv'
+            # open file (the polars backend scans it in its plan)
+            df = None
+            if backend == 'pandas':
+                with report.stage('read') as record:
+                    df = AgMIP_read_raw_csv(fp)
+                    record.rows_out = len(df)
+
+        if backend == 'polars':
+            with report.stage('plan', None if df is None else len(df)) as record:
+                lf = scan_agmip_csv(fp) if df is None else to_lazy(df)
+                compiled_overrides = compile_overrides(read_overrides(overrides_fp)) if (overrides_fp != None) and os.path.exists(overrides_fp) else None
+                plan = el2_plan(lf, load_template(template_fp), compiled_overrides, base_year)
+                stages = dict(zip(plan.keys(), pl.collect_all(list(plan.values()))))
+                lengths = stages.pop('lengths').row(0, named=True)
+                n_rows, model = lengths['input'], lengths['model']
+                stages = {stage:from_lazy(frame, (df is None) or is_agmip_schema(df)) for stage, frame in stages.items()}
+                record.rows_in = n_rows
+                record.rows_out = len(stages['pc-diff'])
+        else:
+            n_rows = len(df)
+            # get model name
+            model = df.model.unique()[0]
+        base_fn = model#fp.split('/')[-1].split('.csv')[0]
+        report.info['model'] = model
+
+        print(f"PROCESSING FILE : {base_fn}")
+        print(f">> original DataFrame length: {n_rows}")
+        print('\n')
+
+        ######################
+        ## DUPLICATES CHECK ##
+        ######################
+        # check duplicates
+        print(f">> checking duplicates")
+        with report.stage('duplicates', n_rows) as record:
+            if backend == 'polars':
+                duplicates_df = stages['duplicates']
+                print(f"...{len(duplicates_df)} entries have conflicting values...")
+                n_clean = lengths['duplicates']
+            else:
+                clean_df, duplicates_df = check_duplicates(df)
+                n_clean = len(clean_df)
+            stage_outputs = {}
+
+            if save and len(duplicates_df)>0:
+                duplicates_dir = pjoin(data_dir,'duplicates')
+                check_path(duplicates_dir)
+                duplicates_fp = stage_fp(pjoin(duplicates_dir,base_fn+'_duplicates.csv'),file_format)
+                write_stage(duplicates_df,duplicates_fp)#,index=False)
+                stage_outputs['duplicates'] = [duplicates_fp]
+            record.rows_out = n_clean
+            record.drop('exact_duplicate',n_rows-n_clean-len(duplicates_df))
+            record.drop('conflicting_duplicate',len(duplicates_df))
+        print('\n')
+
+        #######################
+        ## VARIABLES TO KEEP ##
+        #######################
+        # set aside variables to keep
+        print(f">> setting aside variables to keep")
+        # parsed once per process and cached on disk, see load_template
+        template = load_template(template_fp)
+
+        with report.stage('variables-to-keep', n_clean) as record:
+            if backend == 'polars':
+                variables_to_keep_df = stages['variables-to-keep']
+                record.rows_out = n_clean-len(variables_to_keep_df)
+                print(f"... set aside {len(variables_to_keep_df)} entries of variables to keep")
+            else:
+                variables_to_keep = list(template.keep_variables)
+                variables_to_keep_df = clean_df[clean_df.variable.isin(variables_to_keep)]
+
+                if len(variables_to_keep_df)==0:
+                    variables_to_keep_df = clean_df.iloc[:0]
+
+                # remove variables to keep from clean df, they will be added back later
+                clean_df = clean_df[~clean_df.variable.isin(variables_to_keep)]
+                record.rows_out = len(clean_df)
+
+                print(f"... set aside variables to keep. DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/n_rows)*100,0)}% of the original df")
+            record.drop('set_aside_keep_variable',len(variables_to_keep_df))
+
+        ####################
+        ## OVERRIDE CHECK ##
+        ####################
+
+        # check overrides
+
+        print(f">> checking overrides")
+
+        # rows left after the overrides check, the input of the template check (all of them without an overrides file)
+        n_overrides_checked = n_clean-len(variables_to_keep_df)
+        with report.stage('overrides', n_overrides_checked) as record:
+            if (overrides_fp != None) and os.path.exists(overrides_fp):
+                if backend == 'polars':
+                    clean_df,overrides_df,keep_df = stages['overrides-removed'],stages['overrides'],stages['overrides-kept']
+                else:
+                    clean_df,overrides_df,keep_df = check_overrides(clean_df,overrides_fp)
+                n_overrides_checked = len(clean_df)
+                record.rows_out = n_overrides_checked
+                record.drop('override_removed',len(overrides_df))
+                record.drop('set_aside_override_kept',len(keep_df))
+        
+                print(f"... overrides checked. DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/n_rows)*100,0)}% of the original df")
+
+                if save:
+                    # save overrides-removed
+                    overrides_dir = pjoin(data_dir,'overrides')
+                    check_path(overrides_dir)
+                    overridesRemoved_fp = stage_fp(pjoin(overrides_dir,base_fn+'_overrides-removed.csv'),file_format)
+                    write_stage(clean_df,overridesRemoved_fp,index=False)
+
+                    # save updated overrides file
+                    overrides_list = get_group_keys(overrides_df)
+                    overridesList_fp = pjoin(overrides_dir,base_fn+'_overrides-list.csv')
+                    overrides_list.to_csv(overridesList_fp)#,index=False)
+                    stage_outputs['overrides'] = [overridesRemoved_fp,overridesList_fp]
+            else:
+                print(f"... no overrides file found!\n")
+                record.rows_out = record.rows_in
+                if backend == 'pandas':
+                    keep_df = clean_df.iloc[:0]
+        print('\n')
+
+        ####################
+        ## TEMPLATE CHECK ##
+        ####################
+
+        print(f">> checking against template")
+        with report.stage('template', n_overrides_checked) as record:
+            if backend == 'polars':
+                clean_df,exception_df = stages['template-checked'],stages['template-exceptions']
+                record.rows_out = lengths['template']
+                print(f"Template exceptions removed: {len(exception_df)}")
+            else:
+                clean_df,exception_df = check_template(clean_df,template)
+                record.rows_out = len(clean_df)
+
+                print(f"... template checked. DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/n_rows)*100,0)}% of the original df")
+
+                print(f"... concatenating template-checked DataFrame with the kept overrides and variables to keep...")
+                clean_df = concat_agmip([clean_df,keep_df,variables_to_keep_df],ignore_index=True)
+            record.drop('unknown_variable',record.rows_in-record.rows_out-len(exception_df))
+            record.drop('unit_exception',len(exception_df))
+
+        # check duplicates
+        with report.stage('duplicates-again', lengths['concatenated'] if backend == 'polars' else len(clean_df)) as record:
+            if backend == 'pandas':
+                print(f">> checking duplicates again")
+                clean_df, duplicates_df = check_duplicates(clean_df)
+            record.rows_out = len(clean_df)
+            record.drop('duplicate',record.rows_in-len(clean_df))
+
+            print(f"... DataFrame length: {len(clean_df)}, {np.round((len(clean_df)/n_rows)*100,0)}% of the original df")
+
+            if save:
+                templateChecked_dir = pjoin(data_dir,'template-checked')
+                check_path(templateChecked_dir)
+                templateChecked_fp = stage_fp(pjoin(templateChecked_dir,base_fn+'_template-checked.csv'),file_format)
+                write_stage(clean_df,templateChecked_fp)#,index=False)
+
+                # save updated template exceptions file
+                exception_list = get_group_keys(exception_df)
+                exceptionList_fp = pjoin(templateChecked_dir,base_fn+'_template-exceptions-list.csv')
+                exception_list.to_csv(exceptionList_fp)#,index=False)
+                stage_outputs['template-checked'] = [templateChecked_fp,exceptionList_fp]
+        print('\n')
+
+        ####################
+        ## PERCENT CHANGE ##
+        ####################
+
+        print(f">> calculating percentage changes")
+
+        with report.stage('pc-diff', len(clean_df)) as record:
+            pcDiff_dir = None
+            if save:
+                pcDiff_dir = pjoin(data_dir,'pc-diff')
+                check_path(pcDiff_dir)
+            # the stages before are keyed by the submission inputs, the pc-diff stage by the template-checked data
+            if manifest_entry != None:
+                for stage, outputs in stage_outputs.items():
+                    record_stage(manifest_entry,stage,manifest_entry['inputs'].get('key'),outputs,data_dir)
+                pcDiff_key = combine_hashes(frame_hash(clean_df),file_format,base_year,manifest_entry['inputs'].get('applepy_version'))
+                pcDiff_outputs = reuse_stage(manifest_entry,'pc-diff',pcDiff_key,data_dir) if save and (backend == 'pandas') else None
+            else:
+                pcDiff_outputs = None
+
+            if pcDiff_outputs != None:
+                print(f"... template-checked data unchanged, reusing {pcDiff_outputs[0]}")
+                pc_df = read_stage(pcDiff_outputs[0],index_col=0)
+                report.info['pc-diff_reused'] = True
+            else:
+                pcDiff_fp = stage_fp(pjoin(pcDiff_dir,base_fn+f'_template-checked_pc-diff_interp-{base_year}.csv'),file_format) if save else None
+                if backend == 'polars':
+                    # computed in the same plan as the template-checked DataFrame
+                    pc_df = stages['pc-diff']
+                    if save:
+                        # same diagnostics file as pc_diff_interp on the pandas path
+                        save_diagnostics(pc_diff_diagnostics(pc_df,base_year),diagnostics_path(pcDiff_dir,base_fn+'_template-checked'))
+                        print(f"Done. Saving file to {pcDiff_fp}")
+                        write_stage(pc_df,pcDiff_fp)
+                else:
+                    # template-checked DataFrame is passed on in memory, no need to read it back
+                    pc_df = pc_diff_interp(clean_df,output_dir=pcDiff_dir,base_year=base_year,file_format=file_format,save=save,base_filename=base_fn+'_template-checked',workers=workers)
+                if save and (manifest_entry != None):
+                    record_stage(manifest_entry,'pc-diff',pcDiff_key,[pcDiff_fp],data_dir)
+            record.rows_out = len(pc_df)
+        print('\n')
+
+        if write_report:
+            log_dir = pjoin(data_dir,'logs')
+            check_path(log_dir)
+            report.save(pjoin(log_dir,base_fn+'_run-report.json'))
+
+        print(f"DONE PROCESSING : {base_fn}")
+        return pc_df
+
+
+# Context manager to redirect stdout to /dev/null, or to a log file
 @contextmanager
-def suppress_output():
-    with open(os.devnull, 'w') as devnull:
+def suppress_output(log_fp = None):
+    with open(os.devnull if log_fp == None else log_fp, 'w') as devnull:
         old_stdout = sys.stdout
         old_stderr = sys.stderr
         sys.stdout = devnull
@@ -147,17 +320,87 @@ def suppress_output():
             sys.stdout = old_stdout
             sys.stderr = old_stderr
             
-# Wrapper function to suppress stdout
-def el2_pipeline_silent(fp):
-    with suppress_output():
-        return el2_pipeline(fp)
-    
-# Function to update the progress bar
-def update_progress_bar(pbar, result):
-    pbar.update()
-
+def submission_result(fp, log_fp = None, manifest_entry = None, error = None):
+    # result of a submission in el2_pipeline_multiprocess, 'failed' until el2_pipeline_silent completes it
+    return {'submission':os.path.basename(fp),
+            'model':None,
+            'status':'failed',
+            'file_size':os.path.getsize(fp),
+            'rows_in':None,
+            'rows_out':None,
+            'wall_time':None,
+            'cpu_time':None,
+            'error':error,
+            'log_fp':log_fp,
+            'report':None,
+            'manifest_entry':manifest_entry
+            }
 
-def el2_pipeline_multiprocess(data_dir):
+# Wrapper function to suppress stdout
+def el2_pipeline_silent(fp, template_fp = '../applepy/template/RuleTables.xlsx', file_format = 'csv', manifest_entry = None, log_fp = None, live_interval = 10):
+    # the output of el2_pipeline goes to log_fp (discarded if None)
+    # errors are caught so that one failing submission does not stop the others, and returned with the result
+    # the stages are recorded in a RunReport (see applepy.utils.instrument), saved next to log_fp as <submission>_run-report.json
+    # returns a dict with the submission, model, status ('done' or 'failed'), timings, row counts, error, the run report (as a dict), and the updated manifest entry
+    result = submission_result(fp, log_fp, manifest_entry)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    with suppress_output(log_fp):
+        # the live throughput of the stages goes to the log file, every live_interval seconds
+        report = RunReport(result['submission'], live_interval=live_interval)
+        try:
+            with report.stage('read') as record:
+                df = AgMIP_read_raw_csv(fp)
+                record.rows_out = len(df)
+            result['rows_in'] = len(df)
+            # outputs are saved to disk, do not send the pc-diff DataFrame back to the main process
+            pc_df = el2_pipeline(df, template_fp, file_format=file_format, data_dir=os.path.dirname(fp),
+                                 overrides_fp=fp.split('.csv')[0]+'_OVERRIDES_fix.csv', manifest_entry=manifest_entry, report=report)
+            result['rows_out'] = len(pc_df)
+            result['status'] = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            result['error'] = f"{type(e).__name__}: {e}"
+            logger.error(f"{result['submission']} failed: {result['error']}")
+    result['wall_time'] = time.perf_counter()-start
+    result['cpu_time'] = time.process_time()-start_cpu
+    result['model'] = report.info.get('model')
+    result['report'] = report.to_dict()
+    if log_fp != None:
+        # per-submission report next to the log, also written when the submission failed
+        report.save(os.path.splitext(log_fp)[0]+'_run-report.json')
+    # the updated manifest entry is sent back, the manifest is only written by the main process
+    if (manifest_entry != None) and (result['status'] == 'done'):
+        manifest_entry['status'] = 'done'
+    return result
+
+def init_pipeline_worker(template_fp, queue = None):
+    # initializer of the worker processes of el2_pipeline_multiprocess: loads the template once per worker, and sends the records of the
+    # applepy logger of the worker to the run log of the main process through queue (see log_to_file)
+    init_template_worker(template_fp)
+    init_log_worker(queue)
+
+def estimate_memory(fp, memory_factor = 10):
+    # rough peak memory of el2_pipeline for a submission: the raw csv size times memory_factor
+    # (object columns, and the copies made by the checks and the percent change calculations)
+    return os.path.getsize(fp)*memory_factor
+
+def el2_pipeline_multiprocess(data_dir, template_fp = '../applepy/template/RuleTables.xlsx', file_format = 'csv', use_manifest = True, force = False,
+                              workers = None, memory_budget = None, memory_factor = 10, live_interval = 10):
+    # with use_manifest, the submissions are recorded in a run manifest (data_dir/manifest.json, see RunManifest):
+    # submissions whose input, overrides file, template and applepy version did not change since they were last processed are skipped,
+    # so that a rerun only processes the resubmitted models, and an interrupted batch resumes where it stopped
+    # force reprocesses all the submissions
+    #
+    # scheduling: the largest submissions are submitted first, to at most `workers` processes (default: number of cpus),
+    # as long as their estimated memory (file size * memory_factor, see estimate_memory) fits in memory_budget
+    # (bytes, default: 80% of the available memory). Smaller submissions fill in the remaining budget; a submission that
+    # does not fit on its own is run alone.
+    # if a worker dies (e.g. killed out of memory), the submissions running with it are run again one at a time, and a
+    # submission whose worker dies while it runs alone is recorded as failed ('worker died'), without stopping the others
+    # the output of each submission is written to data_dir/logs/<submission>.log, with the throughput of the running stage every live_interval seconds
+    # the errors logged by the workers go through a queue to data_dir/logs/run_<time>.log
+    # the run reports of the submissions (see RunReport) and their aggregate (see aggregate_reports) are saved to data_dir/logs/run-report_<time>.json
+    # returns a list of results (see el2_pipeline_silent), in the order of the file names
     if not os.path.isdir(data_dir):
         print(f"{data_dir} is not a valid directory.")
         return
@@ -170,14 +413,123 @@ def el2_pipeline_multiprocess(data_dir):
         print(f"No files found in {data_dir}.")
         return
     
-    manager = Manager()
-    with Pool(5) as p:
-        with tqdm(total=len(fps)) as pbar:
-            update_progress = partial(update_progress_bar, pbar)
-            results = []
-            for fp in fps:
-                result = p.apply_async(el2_pipeline_silent, args=(fp,), callback=update_progress)
-                results.append(result)
-            for result in results:
-                result.wait()  # Ensure all results are collected
-    print([result.get() for result in results])
+    manifest = None
+    entries = {fp:None for fp in fps}
+    if use_manifest:
+        manifest = RunManifest(pjoin(data_dir,MANIFEST_FN))
+        for fp in fps:
+            name = os.path.basename(fp)
+            inputs = manifest.submission_inputs(fp,template_fp,file_format)
+            if (not force) and manifest.is_done(name,inputs,data_dir):
+                print(f"{name} unchanged since the last run, skipping")
+                del entries[fp]
+                continue
+            # only the pc-diff stage can be reused, when the template-checked data turns out to be unchanged
+            previous = manifest.entry(name)
+            entries[fp] = {'inputs':inputs,
+                           'stages':{stage:record for stage,record in previous['stages'].items() if stage=='pc-diff'},
+                           'status':'running'
+                           }
+        fps = list(entries.keys())
+        if not fps:
+            print(f"All submissions in {data_dir} are up to date.")
+            return []
+
+    if workers == None:
+        workers = os.cpu_count()
+    workers = max(1,min(workers,len(fps)))
+    if memory_budget == None:
+        memory_budget = 0.8*psutil.virtual_memory().available
+
+    log_dir = pjoin(data_dir,'logs')
+    check_path(log_dir)
+
+    # largest first
+    pending = sorted(fps, key=os.path.getsize, reverse=True)
+    estimates = {fp:estimate_memory(fp,memory_factor) for fp in fps}
+    log_fps = {fp:pjoin(log_dir,os.path.basename(fp).split('.csv')[0]+'.log') for fp in fps}
+    running = {}
+    futures = {}
+    results = {}
+    # submissions that were running when a worker died: they are run again, alone, to find the one that killed it
+    isolated = set()
+
+    def record(fp, result):
+        results[fp] = result
+        # failed submissions are not recorded in the manifest, they are run again next time
+        if (manifest != None) and (result['status'] == 'done'):
+            manifest.update(result['submission'], result['manifest_entry'])
+
+    # compile the template once (cached on disk), then load it once per worker
+    started = time.strftime('%Y-%m-%d %H:%M:%S')
+    timestamp = time.strftime('%y%m%d-%H%M%S')
+    start = time.perf_counter()
+    load_template(template_fp)
+    with log_to_file(pjoin(log_dir,f"run_{timestamp}.log")) as queue, tqdm(total=len(fps)) as pbar:
+        executor = None
+        try:
+            while pending or running:
+                # a dead worker breaks the executor (BrokenProcessPool), a new one is started for the remaining submissions
+                if executor == None:
+                    executor = ProcessPoolExecutor(workers, initializer=init_pipeline_worker, initargs=(template_fp,queue))
+                # admit the largest pending submissions that fit in the free workers and memory
+                for fp in list(pending):
+                    if (len(running) >= workers) or any(x in isolated for x in running):
+                        break
+                    in_use = sum(running.values())
+                    if running and ((fp in isolated) or (in_use+estimates[fp] > memory_budget)):
+                        continue
+                    pending.remove(fp)
+                    running[fp] = estimates[fp]
+                    futures[fp] = executor.submit(el2_pipeline_silent, fp, template_fp, file_format, entries[fp], log_fps[fp], live_interval)
+
+                wait([futures[fp] for fp in running], return_when=FIRST_COMPLETED)
+                if any(isinstance(futures[fp].exception(), BrokenProcessPool) for fp in running if futures[fp].done()):
+                    # all the running submissions fail with the executor
+                    executor.shutdown(wait=True)
+                    executor = None
+                alone = len(running) == 1
+                for fp in [fp for fp in running if futures[fp].done()]:
+                    del running[fp]
+                    try:
+                        result = futures[fp].result()
+                    except BrokenProcessPool as e:
+                        if (not alone) and (fp not in isolated):
+                            # maybe killed with the worker of another submission, run it again alone
+                            isolated.add(fp)
+                            pending.append(fp)
+                            continue
+                        result = submission_result(fp, log_fps[fp], error=f"worker died: {type(e).__name__}: {e}")
+                    except Exception as e:
+                        # errors raised outside of el2_pipeline (e.g. sending the task to the worker)
+                        result = submission_result(fp, log_fps[fp], error=f"{type(e).__name__}: {e}")
+                    record(fp, result)
+                    pbar.update()
+                pending.sort(key=os.path.getsize, reverse=True)
+        finally:
+            if executor != None:
+                executor.shutdown(wait=True)
+
+    results = [results[fp] for fp in sorted(results)]
+    failed = [result for result in results if result['status'] != 'done']
+    print(f"Processed {len(results)-len(failed)} submission(s), {len(failed)} failed")
+    for result in failed:
+        print(f"... {result['submission']} failed: {result['error']} (see {result['log_fp']})")
+
+    reports = [result['report'] for result in results if result['report'] != None]
+    aggregate = aggregate_reports(reports)
+    run_report = {'data_dir':os.path.abspath(data_dir),
+                  'started':started,
+                  'wall_time':time.perf_counter()-start,
+                  'workers':workers,
+                  'file_format':file_format,
+                  'submissions':[{k:v for k,v in result.items() if k != 'manifest_entry'} for result in results],
+                  'aggregate':aggregate
+                  }
+    report_fp = pjoin(log_dir,f"run-report_{timestamp}.json")
+    save_report(run_report, report_fp)
+    # stages taking the most time over all the submissions
+    for stage, total in sorted(aggregate['stages'].items(), key=lambda x: x[1]['wall_time'], reverse=True)[:3]:
+        print(f"... {stage}: {total['wall_time']:.1f} s over {total['submissions']} submission(s), slowest {total['slowest_submission']} ({total['slowest_wall_time']:.1f} s)")
+    print(f">> Saving run report to {report_fp}")
+    return results
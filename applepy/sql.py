@@ -0,0 +1,237 @@
+import os
+import csv
+import duckdb
+import pandas as pd
+import pyarrow.dataset as ds
+
+from .utils.storage import *
+from .utils.template import *
+
+# data folder of this repository, with the merged dataset and the decomposition outputs of the paper
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'data')
+
+# views registered by `connect`, and their default sources (files that do not exist are skipped)
+DEFAULT_VIEWS = {'dataset':os.path.join(DATA_DIR,'global-paper_dataset.csv'),
+                 'decomposition':os.path.join(DATA_DIR,'global-paper_decomposition.csv'),
+                 'decomposition_long':os.path.join(DATA_DIR,'global-paper_decomposition_long-format.csv')
+                 }
+
+# connection used by `query` when none is given, created by `connect` (or on the first query)
+_connection = None
+
+def sql_literal(value):
+    """
+    Quotes a value (e.g. a file path) as a SQL string literal, for the statements that cannot take prepared parameters
+    (a view cannot keep parameters).
+
+    Parameters
+    ----------
+    value (str): Value.
+
+    Returns
+    -------
+    str: The value in single quotes, with its single quotes doubled.
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+def sql_identifier(name):
+    """
+    Quotes a name (e.g. of a view or a column) as a SQL identifier.
+
+    Parameters
+    ----------
+    name (str): Name.
+
+    Returns
+    -------
+    str: The name in double quotes, with its double quotes doubled.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+def csv_source(fp):
+    """
+    Gets the duckdb table function reading a CSV file of AgMIP data.
+
+    The dimensions are read as strings (so that e.g. the 'model' column is never sniffed as a number), the other
+    columns are detected by duckdb. The unnamed index column written by `DataFrame.to_csv` is dropped.
+
+    Parameters
+    ----------
+    fp (str): Path of the CSV file, or a glob of CSV files with the same columns.
+
+    Returns
+    -------
+    str: SQL of the relation.
+    """
+    first_fp = sorted(duckdb.execute("SELECT file FROM glob(?)", [fp]).fetchall())[0][0] if any([x in fp for x in '*?[']) else fp
+    with open(first_fp, newline='') as f:
+        header = next(csv.reader(f))
+    options = ["header=true"]
+    types = ', '.join([f"{sql_literal(col)}: 'VARCHAR'" for col in header if col in DIMENSION_COLS])
+    if types:
+        options.append(f"types={{{types}}}")
+    if header[0] == '':
+        # index of DataFrame.to_csv, given a name so that it can be excluded
+        options.append("names=['_index']")
+        return f"(SELECT * EXCLUDE (_index) FROM read_csv({sql_literal(fp)}, {', '.join(options)}))"
+    return f"read_csv({sql_literal(fp)}, {', '.join(options)})"
+
+def register_view(name, source, con=None):
+    """
+    Registers a view of a connection over a stage output, a merged dataset or a DataFrame.
+
+    Files are not loaded: the view scans them every time it is queried, in parallel and with the filters and column
+    selections of the query pushed down into the scan, so that queries on files larger than memory run out-of-core.
+
+    Parameters
+    ----------
+    name (str): Name of the view.
+    source (str or pd.DataFrame): CSV, Parquet or Arrow IPC file (see `stage_format`), a glob of such files (e.g.
+        'pc-diff/*.parquet'), a directory of Parquet files (hive-partitioned, e.g. 'model=GLOBIOM/...'), or a DataFrame.
+    con (duckdb.DuckDBPyConnection or None, optional): Connection. If None, the connection of `query`. Defaults to None.
+
+    Returns
+    -------
+    None
+    """
+    con = get_connection() if con is None else con
+    if isinstance(source, pd.DataFrame):
+        con.register(name, source)
+        return
+    if os.path.isdir(source):
+        source = os.path.join(source, '**', '*.parquet')
+    file_format = stage_format(source)
+    if file_format == 'arrow':
+        # no Arrow IPC reader in duckdb, scan it as a pyarrow dataset instead
+        con.register(name, ds.dataset(source, format='arrow'))
+        return
+    if file_format == 'parquet':
+        relation = f"read_parquet({sql_literal(source)}, hive_partitioning=true, union_by_name=true)"
+    else:
+        relation = csv_source(source)
+    con.execute(f'CREATE OR REPLACE VIEW {sql_identifier(name)} AS SELECT * FROM {relation}')
+
+def register_template(template_fp=DEFAULT_TEMPLATE_FP, con=None):
+    """
+    Registers the sheets of a RuleTables workbook as views (e.g. 'VariableUnitValueTable', 'RegionTable').
+
+    Parameters
+    ----------
+    template_fp (str or CompiledTemplate, optional): RuleTables workbook. Defaults to the RuleTables of this package.
+    con (duckdb.DuckDBPyConnection or None, optional): Connection. If None, the connection of `query`. Defaults to None.
+
+    Returns
+    -------
+    list of str: Names of the registered views.
+    """
+    con = get_connection() if con is None else con
+    tables = load_template(template_fp).tables
+    for sheet, table in tables.items():
+        con.register(sheet, table)
+    return list(tables.keys())
+
+def connect(dataset_fp=DEFAULT_VIEWS['dataset'], decomposition_fp=DEFAULT_VIEWS['decomposition'],
+            decomposition_long_fp=DEFAULT_VIEWS['decomposition_long'], template_fp=DEFAULT_TEMPLATE_FP, views=None,
+            database=':memory:', threads=None, memory_limit=None, temp_dir=None):
+    """
+    Opens an in-process duckdb connection with views over the merged dataset, the decomposition outputs and the
+    template tables, and makes it the connection of `query`.
+
+    Views are registered with `register_view`: 'dataset' (merged dataset, see `merge_fps`), 'decomposition' (see
+    `decompose_all`), 'decomposition_long' (see `decomposition_long_format`), and the RuleTables sheets (see
+    `register_template`). Sources that are None or do not exist are skipped.
+
+    Parameters
+    ----------
+    dataset_fp (str, pd.DataFrame or None, optional): Merged dataset. Defaults to 'data/global-paper_dataset.csv'.
+    decomposition_fp (str, pd.DataFrame or None, optional): Decomposition, wide format. Defaults to 'data/global-paper_decomposition.csv'.
+    decomposition_long_fp (str, pd.DataFrame or None, optional): Decomposition, long format. Defaults to 'data/global-paper_decomposition_long-format.csv'.
+    template_fp (str, CompiledTemplate or None, optional): RuleTables workbook. Defaults to the RuleTables of this package.
+    views (dict or None, optional): Other views, {name: source}. Defaults to None.
+    database (str, optional): duckdb database file, or ':memory:'. Defaults to ':memory:'.
+    threads (int or None, optional): Number of threads of the queries. If None, the duckdb default (all cores). Defaults to None.
+    memory_limit (str or None, optional): Memory limit of the queries (e.g. '4GB'), beyond which they spill to `temp_dir`. If None, the duckdb default (80% of the memory). Defaults to None.
+    temp_dir (str or None, optional): Directory of the spilled data. If None, the duckdb default. Defaults to None.
+
+    Returns
+    -------
+    duckdb.DuckDBPyConnection
+
+    Examples
+    --------
+    >>> con = connect('../data/global-paper_dataset.csv')
+    >>> query("SELECT * FROM VariableUnitValueTable WHERE Variable = 'EMIS'")
+    """
+    global _connection
+    con = duckdb.connect(database)
+    if threads != None:
+        con.execute("SET threads = ?", [int(threads)])
+    if memory_limit != None:
+        con.execute("SET memory_limit = ?", [memory_limit])
+    if temp_dir != None:
+        con.execute("SET temp_directory = ?", [temp_dir])
+
+    sources = {'dataset':dataset_fp, 'decomposition':decomposition_fp, 'decomposition_long':decomposition_long_fp}
+    sources.update({} if views == None else views)
+    for name, source in sources.items():
+        if isinstance(source, pd.DataFrame) or ((source != None) and (os.path.exists(source) or any([x in source for x in '*?[']))):
+            register_view(name, source, con)
+    if template_fp != None:
+        register_template(template_fp, con)
+
+    _connection = con
+    return con
+
+def get_connection():
+    """
+    Gets the connection of `query`, opened with the default views of `connect` if there is none yet.
+
+    Returns
+    -------
+    duckdb.DuckDBPyConnection
+    """
+    if _connection is None:
+        connect()
+    return _connection
+
+def list_views(con=None):
+    """
+    Gets the names of the views and registered DataFrames of a connection.
+
+    Parameters
+    ----------
+    con (duckdb.DuckDBPyConnection or None, optional): Connection. If None, the connection of `query`. Defaults to None.
+
+    Returns
+    -------
+    list of str
+    """
+    con = get_connection() if con is None else con
+    return [x[0] for x in con.execute("SELECT table_name FROM information_schema.tables ORDER BY table_name").fetchall()]
+
+def query(sql, params=None, con=None):
+    """
+    Runs a SQL query on the views of a connection (see `connect`).
+
+    Parameters
+    ----------
+    sql (str): Query, in the duckdb SQL dialect.
+    params (list, dict or None, optional): Values of the '?' (list) or '$name' (dict) parameters of the query. Defaults to None.
+    con (duckdb.DuckDBPyConnection or None, optional): Connection. If None, the connection opened by `connect`, or
+        one with the default views. Defaults to None.
+
+    Returns
+    -------
+    pd.DataFrame: Result of the query.
+
+    Examples
+    --------
+    Median percent change of ELM from BAU in 2050 across the models, by region:
+
+    >>> query('''SELECT region, variable, item, median(percent_change_BAU) AS median_pc_BAU, count(DISTINCT model) AS models
+    ...          FROM dataset
+    ...          WHERE scenario = 'ELM' AND year = 2050 AND variable = $variable AND item = $item
+    ...          GROUP BY ALL ORDER BY region''', params={'variable':'CALO', 'item':'AGR'})
+    """
+    con = get_connection() if con is None else con
+    return con.execute(sql, params).df()
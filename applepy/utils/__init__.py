@@ -1,2 +1,4 @@
 from .calculations import *
 from .preprocessing import *
+from .dataset import *
+from .store import *
@@ -5,28 +5,34 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-import logging
 import time
+from functools import partial
+from multiprocessing import Pool
+import polars as pl
 pd.set_option("mode.copy_on_write", True)
 
 from .basic import *
 from ..helper import *
+from ..storage import *
 from ..preprocessing.interpolation import *
+from ..lazy import *
+from ..instrument import *
 
 
-def pc_diff(fp,output_dir=None,base_year=2020):
+def pc_diff(fp,output_dir=None,base_year=2020,workers=1):
     """
     Processes a dataset to calculate percent change and differences relative to a baseline scenario and year.
 
     This function reads a CSV file, processes it to calculate the percent change and absolute differences
-    relative to a specified baseline scenario and year. The results are saved to a new CSV file. Optionally, logs
-    are generated to keep track of errors and processing steps.
+    relative to a specified baseline scenario and year. The results are saved to a new CSV file. The rows whose percent
+    changes or differences could not be calculated are reported once per run (see `pc_diff_diagnostics`).
 
     Parameters:
     -----------
     fp (str): The file path of the CSV file to be processed.
     output_dir (str, optional): The directory where the output files will be saved. If None, an 'output' directory is created in the same location as the input file. Defaults to None.
     base_year (int, optional): The base year for calculating percent changes and differences. Defaults to 2020.
+    workers (int, optional): Number of processes. If more than 1, the groups are split into shards processed in parallel (see `run_sharded`). Defaults to 1.
 
     Returns:
     --------
@@ -36,7 +42,7 @@ def pc_diff(fp,output_dir=None,base_year=2020):
     ------
     - The function creates a new DataFrame with additional columns for storing percent changes and differences.
     - Grouping is done based on 'model', 'variable', 'item', 'region', and 'unit' columns.
-    - Logging is set up to record errors during processing.
+    - The diagnostics are written to 'logs/<base_filename>_pc-diff-diagnostics_<time>.csv' in the output directory.
     - Percent changes and differences are calculated for three scenarios: 'BAU' relative to the base year, 'BAU' for the same year, and 'ELM' for the same year.
     - The results are saved to a CSV file in the specified or default output directory.
     """
@@ -53,10 +59,6 @@ def pc_diff(fp,output_dir=None,base_year=2020):
         output_dir = '/'.join(fp.split('/')[:-1])+'/output'
         check_path(output_dir)
 
-    log_dir = pjoin(output_dir,'logs')
-    check_path(log_dir)
-
-
     # create a new df with empty columns to populate
     df_pc = df.copy()
     df_pc.reset_index(inplace=True)
@@ -72,198 +74,516 @@ def pc_diff(fp,output_dir=None,base_year=2020):
 
     df_pc['index'] = df_pc.index
 
-    grouped = df_pc.groupby(['model','variable','item','region','unit'])
-
-    logging.basicConfig(filename=pjoin(log_dir,base_filename+
-            '_pc-diff_'+
-            time.strftime('%y%m%d-%H%M%S', time.localtime())+'.log'),
-            encoding='utf-8',
-            level=logging.DEBUG)
-    # base_year = 2020
-    for k in tqdm(list(grouped.groups.keys())):
-        # status(k)
-        try:
-            k_df = grouped.get_group(k)
-            for scenario in k_df.scenario.unique():
-                model_base_year = find_nearest(k_df.year.unique(),base_year)[0]
-                for year in k_df.year.unique():
-                    val =     k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year) , 'value'].values
-                    
-                    # percent change to BAU 2020
-                    try:
-                        ref =  k_df.loc[(k_df.scenario=='BAU') &
-                                    (k_df.year==model_base_year), 'value'].values
-                        
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'percent_change_BAU_ref_year'] = percent_change(ref,val)
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'diff_BAU_ref_year'] = val-ref
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'BAU_ref_year'] = model_base_year
-
-                    except Exception as e:
-                        logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())}, {k},{scenario},{year},{model_base_year},'percent_change_BAU_2020',{e}")
-
-                    # percent change BAU, same year
-                    try:
-
-                        ref =  k_df.loc[(k_df.scenario=='BAU') &
-                                    (k_df.year==year), 'value'].values
-                        
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'percent_change_BAU'] = percent_change(ref,val)
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'diff_BAU'] = val-ref
-
-                    except Exception as e:
-                        logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())}, {k},{scenario},{year},'percent_change_BAU',{e}")
-                    
-                    # percent change ELM, same year
-                    try:
-                        ref =  k_df.loc[(k_df.scenario=='ELM') &
-                                    (k_df.year==year), 'value'].values
-                        
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'percent_change_ELM'] = percent_change(ref,val)
-                        df_pc.loc[k_df[(k_df.scenario==scenario) & (k_df.year==year)].index, 'diff_ELM'] = val-ref
-
-                    except Exception as e:
-                        logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())},{k},{scenario},{year},'percent_change_ELM',{e}")
-        except Exception as e:
-            logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())}, {k},{scenario},{year},'key error'")
-    
+    if workers > 1:
+        # rows are filled in place, so the shards are put back in the original order
+        df_pc = pd.concat(run_sharded(df_pc, pc_diff_nearest, workers, base_year=base_year)).sort_index()
+    else:
+        df_pc = pc_diff_nearest(df_pc, base_year)
+    save_diagnostics(pc_diff_diagnostics(df_pc,base_year,nearest=True),diagnostics_path(output_dir,base_filename))
     
     save_filename = pjoin(output_dir,base_filename+'_pc-diff.csv')
     print(f"Done. Saving file to {save_filename}")
     df_pc.to_csv(save_filename,)
 
-
-
-def pc_diff_interp(fp,output_dir,base_year=2020):
+def pc_diff_nearest(df_pc, base_year=2020):
     """
-    Processes a dataset to calculate percent change and differences relative to a baseline scenario and year,
-    including interpolation if the base year is missing from the dataset.
-
-    This function reads a CSV file, processes it to calculate the percent change and absolute differences
-    relative to a specified baseline scenario and year. If the base year is not present in the data, it performs
-    linear interpolation to estimate values for the base year. The results are saved to a new CSV file. Optionally,
-    logs are generated to keep track of errors and processing steps.
+    Fills the percent change and differences columns of `pc_diff`, using the year nearest to `base_year` as the
+    reference year of each group (see `nearest_years`). The columns are computed for the whole DataFrame at once, with
+    one keyed join per reference (see `reference_values`), as in `pc_diff_frame`.
 
     Parameters:
     -----------
-    fp (str): The file path of the CSV file to be processed.
-    output_dir (str, optional): The directory where the output files will be saved. If None, an 'output' directory is created in the same location as the input file. Defaults to None.
+    df_pc (pd.DataFrame): DataFrame prepared by `pc_diff`, with the (empty) percent change and differences columns.
     base_year (int, optional): The base year for calculating percent changes and differences. Defaults to 2020.
 
     Returns:
     --------
-    None
+    pd.DataFrame: `df_pc` with the columns filled.
 
     Notes:
     ------
-    - The function creates a new DataFrame with additional columns for storing percent changes and differences.
-    - Grouping is done based on 'model', 'variable', 'item', 'region', and 'unit' columns.
-    - Logging is set up to record errors during processing.
-    - Percent changes and differences are calculated for three scenarios: 'BAU' relative to the base year, 'BAU' for the same year, and 'ELM' for the same year.
-    - If the base year is not present in the data, linear interpolation is used to estimate the values.
-    - The results are saved to a CSV file in the specified or default output directory.
+    - Rows with a missing group key ('model', 'variable', 'item', 'region', 'unit'), scenario or year are left empty.
+    - A reference that is missing or matches more than one row leaves the corresponding columns empty (see `pc_diff_diagnostics`).
+    """
+    group_cols = ['model','variable','item','region','unit']
+    group_id = df_pc.groupby(group_cols, sort=False, observed=True).ngroup().to_numpy()
+    ref_year = nearest_years(df_pc, group_cols, base_year)
+
+    valid = ((group_id>=0) & df_pc.scenario.notna() & df_pc.year.notna()).to_numpy()
+    val = df_pc['value'].to_numpy()
+
+    # percent change to BAU in the reference year
+    ref = np.where(valid, reference_values(df_pc, group_cols, (df_pc.scenario=='BAU') & (df_pc.year==ref_year)), np.nan)
+    df_pc['percent_change_BAU_ref_year'] = percent_change(ref,val)
+    df_pc['diff_BAU_ref_year'] = val-ref
+    df_pc['BAU_ref_year'] = np.where(np.isnan(ref), np.nan, ref_year)
+
+    # percent change BAU, same year
+    ref = np.where(valid, reference_values(df_pc, group_cols+['year'], df_pc.scenario=='BAU'), np.nan)
+    df_pc['percent_change_BAU'] = percent_change(ref,val)
+    df_pc['diff_BAU'] = val-ref
+
+    # percent change ELM, same year
+    ref = np.where(valid, reference_values(df_pc, group_cols+['year'], df_pc.scenario=='ELM'), np.nan)
+    df_pc['percent_change_ELM'] = percent_change(ref,val)
+    df_pc['diff_ELM'] = val-ref
+    return df_pc
+
+def nearest_years(df, group_cols, base_year):
     """
+    Finds the reference year of every row of a DataFrame: the year nearest to `base_year` reported in its group
+    (the first one reported, if two years are as near), as `find_nearest` on the years of each group.
 
-    # load dataset
-    df = pd.read_csv(fp)
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with the `group_cols` and 'year' columns.
+    group_cols (list of str): Group columns.
+    base_year (int): The base year.
 
-    # set up output directory
-    base_filename = fp.split('/')[-1].split('.csv')[-2]
+    Returns:
+    --------
+    numpy.ndarray: Reference year of each row of `df`, in the same order (NaN for a group without years).
+    """
+    group_id = df.groupby(group_cols, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    year = df.year.to_numpy(dtype=float)
+    distance = np.nan_to_num(np.abs(year-base_year), nan=np.inf)
+    return year[pd.Series(distance).groupby(group_id).transform('idxmin').to_numpy()]
 
-    print(f'Processing file: {base_filename}')
+def run_sharded(df, fn, workers, group_cols=('model','variable','item','region','unit'), **kwargs):
+    """
+    Runs a group-wise function on shards of a DataFrame in a process pool.
 
-    if output_dir==None:
-        output_dir = '/'.join(fp.split('/')[:-1])+'/output'
-        check_path(output_dir)
+    The groups are hash-partitioned into `workers` shards, so that all the rows of a group are in the same shard, and
+    the shards are given to `fn` in parallel. The partition only depends on the group keys, so it is the same from
+    one run to the next.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with the `group_cols` columns.
+    fn (callable): Module-level function called as `fn(shard_df, **kwargs)`, returning a DataFrame.
+    workers (int): Number of shards and processes.
+    group_cols (tuple of str, optional): Group columns. Defaults to ('model','variable','item','region','unit').
+    **kwargs: Passed to `fn`.
+
+    Returns:
+    --------
+    list of pd.DataFrame: Output of `fn` for each non-empty shard, in shard order.
+    """
+    shard = pd.util.hash_pandas_object(df[list(group_cols)].astype(object), index=False).to_numpy() % workers
+    shards = [df[shard==i] for i in range(workers) if (shard==i).any()]
+    # the workers log to the log file of the caller, if any (see log_to_file)
+    with Pool(min(workers,len(shards)), initializer=init_log_worker, initargs=(log_queue(),)) as p:
+        return p.map(partial(fn, **kwargs), shards)
+
+def sort_groups(df, group_cols=('model','variable','item','region','unit')):
+    """
+    Puts the groups of a reassembled DataFrame back in sorted group order, keeping the order of the rows within each group.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with the `group_cols` columns.
+    group_cols (tuple of str, optional): Group columns. Defaults to ('model','variable','item','region','unit').
+
+    Returns:
+    --------
+    pd.DataFrame: The reordered DataFrame.
+    """
+    group_id = df.groupby(list(group_cols), sort=True, observed=True).ngroup().to_numpy()
+    return df.iloc[np.argsort(group_id, kind='stable')]
+
+
+
+def reference_matches(df, keys, mask):
+    """
+    Looks up a reference value for every row of a DataFrame with one keyed join, with the number of reference rows
+    matched by each row.
+
+    The reference rows are the rows of `df` selected by `mask`. Each row of `df` is matched to the reference rows
+    with the same `keys`. Rows without a reference (0 matches), or with more than one reference row (ambiguous), get NaN.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with the `keys` columns and a 'value' column.
+    keys (list of str): Columns used to match rows to their reference.
+    mask (array-like of bool): Selects the reference rows in `df`.
+
+    Returns:
+    --------
+    values (numpy.ndarray): Reference value for each row of `df`, in the same order.
+    matches (numpy.ndarray): Number of reference rows matched by each row of `df`.
+    """
+    ref = df.loc[mask, keys+['value']]
+    ref = ref.groupby(keys, observed=True, dropna=False, sort=False).agg(value=('value','first'), _matches=('value','size')).reset_index()
+    ref = df[keys].merge(ref, on=keys, how='left', validate='many_to_one')
+    matches = ref['_matches'].fillna(0).to_numpy(dtype=int)
+    return np.where(matches==1, ref['value'].to_numpy(dtype=float), np.nan), matches
+
+def reference_values(df, keys, mask):
+    """
+    Looks up a reference value for every row of a DataFrame with one keyed join (see `reference_matches`).
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with the `keys` columns and a 'value' column.
+    keys (list of str): Columns used to match rows to their reference.
+    mask (array-like of bool): Selects the reference rows in `df`.
+
+    Returns:
+    --------
+    numpy.ndarray: Reference value for each row of `df`, in the same order.
+    """
+    return reference_matches(df, keys, mask)[0]
+
+# checks of `pc_diff_diagnostics`, and their description
+PC_DIFF_CHECKS = {'base_year_not_interpolated':'the base year is not reported and cannot be interpolated (no year before and after it in every scenario), the percent changes and differences are empty',
+                  'missing_scenario_or_year':'the scenario or the year is missing, the percent changes and differences are empty',
+                  'missing_BAU_ref_year':'no BAU value in the base year',
+                  'ambiguous_BAU_ref_year':'more than one BAU value in the base year',
+                  'zero_BAU_ref_year':'the BAU value in the base year is 0, the percent change is not defined',
+                  'missing_BAU':'no BAU value in the same year',
+                  'ambiguous_BAU':'more than one BAU value in the same year',
+                  'zero_BAU':'the BAU value in the same year is 0, the percent change is not defined',
+                  'missing_ELM':'no ELM value in the same year',
+                  'ambiguous_ELM':'more than one ELM value in the same year',
+                  'zero_ELM':'the ELM value in the same year is 0, the percent change is not defined'
+                  }
+
+def pc_diff_diagnostics(df_pc, base_year=2020, nearest=False):
+    """
+    Finds the rows of a `pc_diff_interp` (or `pc_diff`) output whose percent changes or differences could not be calculated, and why
+    (see PC_DIFF_CHECKS): base year that cannot be interpolated, missing or ambiguous (more than one row) BAU base-year,
+    BAU same-year and ELM same-year references, and references equal to 0.
+
+    The checks are vectorized conditions on the whole output, evaluated once per run instead of logging every
+    failing cell, and work the same on the outputs of both backends.
+
+    Parameters:
+    -----------
+    df_pc (pd.DataFrame): Output of `pc_diff_interp`, or of `pc_diff` with `nearest`.
+    base_year (int, optional): The base year of the percent changes and differences. Defaults to 2020.
+    nearest (bool, optional): If True, the reference year of each group is the reported year nearest to `base_year`, as in `pc_diff` (see `nearest_years`), and is never interpolated. Defaults to False.
+
+    Returns:
+    --------
+    pd.DataFrame: One row per group, scenario and failed check, with the columns 'model', 'variable', 'item',
+    'region', 'unit', 'scenario', 'check', 'rows' (number of rows failing the check), 'first_year', 'last_year'
+    and 'message'.
+    """
+    group_cols = ['model','variable','item','region','unit']
+    cols = group_cols+['scenario','check','rows','first_year','last_year','message']
+    df = df_pc[group_cols+['scenario','year','value']].reset_index(drop=True)
+    if len(df)==0:
+        return pd.DataFrame(columns=cols)
+    if nearest:
+        ref_year = nearest_years(df, group_cols, base_year)
+        interpolated = np.ones(len(df), dtype=bool)
+    else:
+        ref_year = base_year
+        group_id = df.groupby(group_cols, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+        # groups without the base year in the output are the ones that could not be interpolated
+        interpolated = np.isin(group_id, np.unique(group_id[(df.year==base_year).to_numpy()]))
+    valid = (df.scenario.notna() & df.year.notna()).to_numpy()
+
+    checks = [('base_year_not_interpolated', ~interpolated),
+              ('missing_scenario_or_year', interpolated & ~valid)]
+    valid = valid & interpolated
+    references = [('BAU_ref_year', group_cols, (df.scenario=='BAU') & (df.year==ref_year)),
+                  ('BAU', group_cols+['year'], df.scenario=='BAU'),
+                  ('ELM', group_cols+['year'], df.scenario=='ELM')]
+    for name, keys, mask in references:
+        ref, matches = reference_matches(df, keys, mask)
+        checks += [(f'missing_{name}', valid & (matches==0)),
+                   (f'ambiguous_{name}', valid & (matches>1)),
+                   (f'zero_{name}', valid & (ref==0))]
+
+    rows = np.concatenate([np.flatnonzero(failed) for check, failed in checks])
+    check = np.concatenate([np.full(failed.sum(), check, dtype=object) for check, failed in checks])
+    if len(rows)==0:
+        return pd.DataFrame(columns=cols)
+    failed_df = df.iloc[rows].assign(check=check)
+    for col in group_cols+['scenario']:
+        failed_df[col] = failed_df[col].astype(object)
+    diagnostics_df = failed_df.groupby(group_cols+['scenario','check'], sort=True, dropna=False).agg(rows=('year','size'),
+                                                                                                 first_year=('year','min'),
+                                                                                                 last_year=('year','max')).reset_index()
+    diagnostics_df['message'] = diagnostics_df.check.map(PC_DIFF_CHECKS)
+    return diagnostics_df[cols]
+
+def diagnostics_path(output_dir, base_filename):
+    """
+    Gets the path of the diagnostics file of a percent change and differences run (see `pc_diff_diagnostics`):
+    '<output_dir>/logs/<base_filename>_pc-diff-diagnostics_<time>.csv'. The logs directory is created if needed.
 
+    Parameters:
+    -----------
+    output_dir (str): The output directory of the run.
+    base_filename (str): Prefix of the output files.
+
+    Returns:
+    --------
+    str: The path of the diagnostics file.
+    """
     log_dir = pjoin(output_dir,'logs')
     check_path(log_dir)
+    return pjoin(log_dir,f"{base_filename}_pc-diff-diagnostics_{time.strftime('%y%m%d-%H%M%S', time.localtime())}.csv")
+
+def save_diagnostics(diagnostics_df, diagnostics_fp):
+    """
+    Saves the diagnostics of a percent change and differences run (see `pc_diff_diagnostics`), and prints the number
+    of failed checks, if any.
+
+    Parameters:
+    -----------
+    diagnostics_df (pd.DataFrame): Output of `pc_diff_diagnostics`.
+    diagnostics_fp (str): The path of the diagnostics file (see `diagnostics_path`).
+
+    Returns:
+    --------
+    None
+    """
+    diagnostics_df.to_csv(diagnostics_fp,index=False)
+    if len(diagnostics_df) > 0:
+        print(f"{diagnostics_df.rows.sum()} failed check(s) in the percent changes and differences, see {diagnostics_fp}")
+
+def pc_diff_frame(df, base_year=2020):
+    """
+    Calculates the percent change and differences columns of `pc_diff_interp` for a whole DataFrame at once.
+
+    Instead of looping over every group, scenario and year, the BAU base-year, BAU same-year and ELM same-year
+    references are built with one keyed join each (see `reference_values`), and the seven output columns are
+    computed as whole-column arithmetic. Groups that do not report `base_year` are patched first, all at once, with
+    `interp_base_year_frame`. The output matches the loop in `pc_diff_interp` row-for-row: rows are ordered by group, interpolated rows
+    are appended at the end of their group (whose index is then reset), and groups that cannot be interpolated are
+    kept with empty percent change and difference columns.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with columns 'model', 'scenario', 'region', 'variable', 'item', 'unit', 'year', 'value'.
+    base_year (int, optional): The base year for calculating percent changes and differences. Defaults to 2020.
+
+    Returns:
+    --------
+    pd.DataFrame: `df` with the columns 'BAU_ref_year', 'percent_change_BAU_ref_year', 'diff_BAU_ref_year',
+    'percent_change_BAU', 'diff_BAU', 'percent_change_ELM', 'diff_ELM' added.
+
+    Notes:
+    ------
+    - Rows with a missing group key ('model', 'variable', 'item', 'region', 'unit') are dropped, as in the loop.
+    - A reference that is missing or matches more than one row leaves the corresponding columns empty.
+    """
+    group_cols = ['model','variable','item','region','unit']
+    df = df.dropna(subset=group_cols)
+    group_id = df.groupby(group_cols, sort=True, observed=True).ngroup().to_numpy()
+    order = np.arange(len(df))
+
+    # patch groups that do not report base_year (this is the same as ref_year).
+    # do a linear interpolation between the two nearest years, for all the series at once
+    has_base_year = np.isin(group_id, np.unique(group_id[(df.year==base_year).to_numpy()]))
+    interp_df, failed = interp_base_year_frame(df[~has_base_year], base_year)
+    # a group is interpolated only if all its scenarios are (a missing scenario cannot be, as in interp_base_year),
+    # the other groups are reported as 'base_year_not_interpolated' by pc_diff_diagnostics
+    missing_group_id = group_id[~has_base_year]
+    failed_groups = np.unique(missing_group_id[failed | df.scenario[~has_base_year].isna().to_numpy()])
+    interp_df = interp_df.assign(_group=missing_group_id[interp_df.index.to_numpy()])
+    interp_df = interp_df[~interp_df._group.isin(failed_groups)]
+    interp_groups = np.unique(interp_df._group.to_numpy())
+
+    df_pc = df.assign(_group=group_id, _order=order)
+    if len(interp_df)>0:
+        interp_df['_order'] = len(df) + np.arange(len(interp_df))
+        df_pc = pd.concat([df_pc, interp_df])
+    df_pc = df_pc.sort_values(['_group','_order'], kind='stable')
+
+    # interpolated groups get a fresh index, as if concatenated with ignore_index=True
+    reset_index = df_pc._group.isin(interp_groups).to_numpy()
+    index = df_pc.index.to_numpy(dtype=object)
+    index[reset_index] = df_pc[reset_index].groupby('_group').cumcount().to_numpy()
+    df_pc.index = pd.Index(index).infer_objects()
+
+    valid = (df_pc.scenario.notna() & df_pc.year.notna() & ~df_pc._group.isin(failed_groups)).to_numpy()
+    val = df_pc['value'].to_numpy()
+
+    # percent change to BAU base_year
+    ref = np.where(valid, reference_values(df_pc, group_cols, (df_pc.scenario=='BAU') & (df_pc.year==base_year)), np.nan)
+    df_pc['BAU_ref_year'] = np.where(np.isnan(ref), np.nan, base_year)
+    df_pc['percent_change_BAU_ref_year'] = percent_change(ref,val)
+    df_pc['diff_BAU_ref_year'] = val-ref
+
+    # percent change BAU, same year
+    ref = np.where(valid, reference_values(df_pc, group_cols+['year'], df_pc.scenario=='BAU'), np.nan)
+    df_pc['percent_change_BAU'] = percent_change(ref,val)
+    df_pc['diff_BAU'] = val-ref
+
+    # percent change ELM, same year
+    ref = np.where(valid, reference_values(df_pc, group_cols+['year'], df_pc.scenario=='ELM'), np.nan)
+    df_pc['percent_change_ELM'] = percent_change(ref,val)
+    df_pc['diff_ELM'] = val-ref
+
+    return df_pc.drop(columns=['_group','_order'])
+
+def pc_diff_loop(df, base_year=2020):
+    """
+    Calculates the percent change and differences columns of `pc_diff_interp` group by group, scenario by scenario
+    and year by year. Superseded by `pc_diff_frame`, kept for reference.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with columns 'model', 'scenario', 'region', 'variable', 'item', 'unit', 'year', 'value'.
+    base_year (int, optional): The base year for calculating percent changes and differences. Defaults to 2020.
 
+    Returns:
+    --------
+    pd.DataFrame: `df` with the percent change and differences columns added.
 
+    Notes:
+    ------
+    - A reference that is missing or matches more than one row leaves the corresponding columns empty, and a group
+      whose base year cannot be interpolated is kept without the columns, as in `pc_diff_frame`. Both are reported
+      by `pc_diff_diagnostics`.
+    """
     # create a new df with empty columns to populate
     df_pc = pd.DataFrame()
 
-    grouped = df.groupby(['model','variable','item','region','unit'])
-
-    logging.basicConfig(filename=pjoin(log_dir,base_filename+
-            '_pc-diff_'+
-            time.strftime('%y%m%d-%H%M%S', time.localtime())+'.log'),
-            encoding='utf-8',
-            level=logging.DEBUG)
+    grouped = df.groupby(['model','variable','item','region','unit'],observed=True)
 
     for k in tqdm(list(grouped.groups.keys())):
         # status(k)
-        try:
-            k_df = grouped.get_group(k)
+        k_df = grouped.get_group(k)
 
-            # patch k_df if model does not report base_year (this is the same as ref_year). 
-            # do a linear interpolation between the two nearest years
-            if base_year not in k_df.year.unique():
+        # patch k_df if model does not report base_year (this is the same as ref_year). 
+        # do a linear interpolation between the two nearest years
+        if base_year not in k_df.year.unique():
+            try:
                 k_df = interp_base_year(k_df,base_year)
-            
-            # create new columns
-            k_df.loc[:,'BAU_ref_year'] = np.nan
-            k_df.loc[:,'percent_change_BAU_ref_year'] = np.nan
-            k_df.loc[:,'diff_BAU_ref_year'] = np.nan
-
-            k_df.loc[:,'percent_change_BAU'] = np.nan
-            k_df.loc[:,'diff_BAU'] = np.nan
-
-            k_df.loc[:,'percent_change_ELM'] = np.nan
-            k_df.loc[:,'diff_ELM'] = np.nan
-            
-
-            for scenario in k_df.scenario.unique():
-                for year in k_df.year.unique():   
-                    val =   k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year) , 'value'].values
-                    # percent change to BAU 2020
-                    try:
-                        ref =  k_df.loc[(k_df.scenario=='BAU') &
-                                    (k_df.year==base_year), 'value'].values
-                        # print(k,scenario,year,val,ref,percent_change(ref,val))
-                        
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'percent_change_BAU_ref_year'] = percent_change(ref,val)
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'diff_BAU_ref_year'] = val-ref
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'BAU_ref_year'] = base_year
-
-                    except Exception as e:
-                        logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())}, {k},{scenario},{year},{base_year},'percent_change_BAU_2020',{e}")
-
-                    # percent change BAU, same year
-                    try:
-
-                        ref =  k_df.loc[(k_df.scenario=='BAU') &
-                                    (k_df.year==year), 'value'].values
-                        
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'percent_change_BAU'] = percent_change(ref,val)
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'diff_BAU'] = val-ref
-
-                    except Exception as e:
-                        logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())}, {k},{scenario},{year},'percent_change_BAU',{e}")
-                    
-                    # percent change ELM, same year
-                    try:
-                        ref =  k_df.loc[(k_df.scenario=='ELM') &
-                                    (k_df.year==year), 'value'].values
-                        
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'percent_change_ELM'] = percent_change(ref,val)
-                        k_df.loc[(k_df.scenario==scenario) &
-                                    (k_df.year==year),'diff_ELM'] = val-ref
-
-                    except Exception as e:
-                        logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())},{k},{scenario},{year},'percent_change_ELM',{e}")
-        except Exception as e:
-            logging.error(f"{time.strftime('%y%m%d-%H%M%S', time.localtime())}, {k},{scenario},{year},'key error'")
+            except Exception:
+                # reported as 'base_year_not_interpolated' by pc_diff_diagnostics
+                df_pc = pd.concat([df_pc,k_df])
+                continue
+        
+        # create new columns
+        k_df.loc[:,'BAU_ref_year'] = np.nan
+        k_df.loc[:,'percent_change_BAU_ref_year'] = np.nan
+        k_df.loc[:,'diff_BAU_ref_year'] = np.nan
+
+        k_df.loc[:,'percent_change_BAU'] = np.nan
+        k_df.loc[:,'diff_BAU'] = np.nan
+
+        k_df.loc[:,'percent_change_ELM'] = np.nan
+        k_df.loc[:,'diff_ELM'] = np.nan
+        
+        ref_year = k_df.loc[(k_df.scenario=='BAU') &
+                            (k_df.year==base_year), 'value'].values
+
+        for scenario in k_df.scenario.unique():
+            for year in k_df.year.unique():   
+                rows = (k_df.scenario==scenario) & (k_df.year==year)
+                val = k_df.loc[rows, 'value'].values
+
+                # percent change to BAU 2020
+                if len(ref_year) == 1:
+                    k_df.loc[rows,'percent_change_BAU_ref_year'] = percent_change(ref_year,val)
+                    k_df.loc[rows,'diff_BAU_ref_year'] = val-ref_year
+                    k_df.loc[rows,'BAU_ref_year'] = base_year
+
+                # percent change BAU, same year
+                ref =  k_df.loc[(k_df.scenario=='BAU') &
+                                (k_df.year==year), 'value'].values
+                if len(ref) == 1:
+                    k_df.loc[rows,'percent_change_BAU'] = percent_change(ref,val)
+                    k_df.loc[rows,'diff_BAU'] = val-ref
+                
+                # percent change ELM, same year
+                ref =  k_df.loc[(k_df.scenario=='ELM') &
+                                (k_df.year==year), 'value'].values
+                if len(ref) == 1:
+                    k_df.loc[rows,'percent_change_ELM'] = percent_change(ref,val)
+                    k_df.loc[rows,'diff_ELM'] = val-ref
 
         df_pc = pd.concat([df_pc,k_df])
 
-    save_filename = pjoin(output_dir,base_filename+f'_pc-diff_interp-{base_year}.csv')
-    print(f"Done. Saving file to {save_filename}")
-    df_pc.to_csv(save_filename,)
+    return df_pc
+
+@instrumented()
+def pc_diff_interp(fp,output_dir=None,base_year=2020,vectorized=True,file_format=None,save=True,base_filename=None,workers=1,backend='pandas',return_diagnostics=False):
+    """
+    Processes a dataset to calculate percent change and differences relative to a baseline scenario and year,
+    including interpolation if the base year is missing from the dataset.
+
+    This function reads a CSV (or Parquet/Arrow IPC) file, or takes the DataFrame returned by the previous stage,
+    and processes it to calculate the percent change and absolute differences relative to a specified baseline
+    scenario and year. If the base year is not present in the data, it performs linear interpolation to estimate
+    values for the base year. The results are returned and, optionally, saved to a new file. The rows whose percent
+    changes or differences could not be calculated are reported once per run (see `pc_diff_diagnostics`).
+
+    Parameters:
+    -----------
+    fp (str or pd.DataFrame): The file path of the CSV, Parquet or Arrow IPC file to be processed, or the DataFrame itself.
+    output_dir (str, optional): The directory where the output files will be saved. If None, an 'output' directory is created in the same location as the input file (a DataFrame is not saved and no diagnostics are written). Defaults to None.
+    base_year (int, optional): The base year for calculating percent changes and differences. Defaults to 2020.
+    vectorized (bool, optional): If True, the columns are computed for the whole DataFrame at once with `pc_diff_frame`. If False, the DataFrame is processed group by group, scenario by scenario and year by year. Defaults to True.
+    file_format (str, optional): Storage format of the output file, 'csv', 'parquet' or 'arrow' (see `write_stage`). If None, the format of the input file is used ('csv' for a DataFrame). Defaults to None.
+    save (bool, optional): If True, the output is saved in `output_dir`. Defaults to True.
+    base_filename (str, optional): Prefix of the output and log files. If None, the input file name (or the model name for a DataFrame) is used. Defaults to None.
+    workers (int, optional): Number of processes. If more than 1, the groups are hash-partitioned into shards processed in parallel (see `run_sharded`), and the output is put back in the same order as with a single process. Defaults to 1.
+    backend (str, optional): 'pandas', or 'polars' to compute the columns as one lazy polars plan (see `lazy_pc_diff`), run multi-threaded by polars (`vectorized` and `workers` are then not used). Defaults to 'pandas'.
+    return_diagnostics (bool, optional): If True, the diagnostics DataFrame (see `pc_diff_diagnostics`) is returned as well. Defaults to False.
+
+    Returns:
+    --------
+    pd.DataFrame: The dataset with the percent change and differences columns (and the diagnostics DataFrame, with `return_diagnostics`).
+
+    Notes:
+    ------
+    - The function creates a new DataFrame with additional columns for storing percent changes and differences.
+    - Grouping is done based on 'model', 'variable', 'item', 'region', and 'unit' columns.
+    - With an output directory, the diagnostics are written once to 'logs/<base_filename>_pc-diff-diagnostics_<time>.csv'.
+    - Percent changes and differences are calculated for three scenarios: 'BAU' relative to the base year, 'BAU' for the same year, and 'ELM' for the same year.
+    - If the base year is not present in the data, linear interpolation is used to estimate the values.
+    - The results are saved to a CSV file in the specified or default output directory.
+    """
+
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    # load dataset, or use the DataFrame passed by the previous stage
+    if isinstance(fp,pd.DataFrame):
+        df = fp
+        assert (not save) or (output_dir!=None), "output_dir is needed to save the output of a DataFrame"
+        if file_format==None:
+            file_format = 'csv'
+        if base_filename==None:
+            base_filename = '-'.join([str(x) for x in df.model.unique()])
+    else:
+        df = read_stage(fp)
+        if file_format==None:
+            file_format = stage_format(fp)
+        if base_filename==None:
+            base_filename = os.path.splitext(fp.split('/')[-1])[0]
+
+        # set up output directory
+        if output_dir==None:
+            output_dir = '/'.join(fp.split('/')[:-1])+'/output'
+            check_path(output_dir)
+
+    print(f'Processing file: {base_filename}')
+
+    diagnostics_fp = diagnostics_path(output_dir,base_filename) if output_dir!=None else None
+
+    pc_fn = pc_diff_frame if vectorized else pc_diff_loop
+    if backend == 'polars':
+        df_pc = from_lazy(lazy_pc_diff(to_lazy(df),base_year), is_agmip_schema(df))
+    else:
+        df_pc = sort_groups(pd.concat(run_sharded(df, pc_fn, workers, base_year=base_year))) if workers > 1 else pc_fn(df,base_year)
+
+    diagnostics_df = None
+    if (diagnostics_fp != None) or return_diagnostics:
+        diagnostics_df = pc_diff_diagnostics(df_pc,base_year)
+    if diagnostics_fp != None:
+        save_diagnostics(diagnostics_df,diagnostics_fp)
+
+    if save:
+        save_filename = stage_fp(pjoin(output_dir,base_filename+f'_pc-diff_interp-{base_year}.csv'),file_format)
+        print(f"Done. Saving file to {save_filename}")
+        write_stage(df_pc,save_filename)
+    if return_diagnostics:
+        return df_pc, diagnostics_df
+    return df_pc
+
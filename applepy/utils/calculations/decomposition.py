@@ -3,6 +3,8 @@ import pandas as pd
 import polars as pl
 import numpy as np
 from applepy.utils.calculations.basic import *
+from applepy.utils.lazy import *
+from applepy.utils.instrument import *
 
 def individual_effect(scenario_pl, value, driver, normalized = False,use_pandas=False):
     ## using pandas is slower than using polars
@@ -81,6 +83,112 @@ def decompose_driver_effect_filtered(scenario_df, value, driver, normalized = Fa
     else:
         return effect_dict
 
+@instrumented()
+def decompose_all(df, drivers = None, value_types = None, long_format = False, backend = 'pandas'):
+    """
+    Decomposes the individual, total, and interaction effects of all drivers, value types and normalizations at once.
+
+    Scenarios are pivoted to columns once, so that every (model, region, variable, item, unit, year) group is a row.
+    The effects are then computed as whole-column arithmetic, with the same formulas as
+    `decompose_driver_effect_filtered` (`full_dict=True`), and returned as scalar float columns.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): DataFrame with columns 'model', 'scenario', 'region', 'variable', 'item', 'unit', 'year' and the `value_types` columns.
+    drivers (list of str or None, optional): Drivers to decompose. If None, ['DIET','PROD','MITI','WAST']. Defaults to None.
+    value_types (list of str or None, optional): Columns to decompose. If None, ['value','percent_change_BAU','percent_change_BAU_ref_year']. Defaults to None.
+    long_format (bool, optional): If True, returns the long format (see `decomposition_long_format`). Defaults to False.
+    backend (str, optional): 'pandas', or 'polars' to compute the decomposition as one lazy polars plan (see `lazy_decompose`). Defaults to 'pandas'.
+
+    Returns:
+    --------
+    pd.DataFrame: One row per group, driver, value type and normalization (in this order), with the columns
+    'individual', 'total', 'interaction', 'model', 'region', 'variable', 'item', 'year', 'unit', 'driver', 'normalized',
+    'value_type', 'ELM', 'BAU', 'EL2', 'ELM_driver', 'BAU_driver', 'percent_change_BAU_individual',
+    'percent_change_BAU_total', 'percent_change_BAU_interaction'.
+
+    Notes:
+    ------
+    - EL2 is read from the 'ELM_MITI' scenario.
+    - Missing scenarios give NaN effects. If a scenario is reported more than once for a group, the first row is used.
+    """
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    drivers = ['DIET','PROD','MITI','WAST'] if drivers == None else list(drivers)
+    value_types = ['value','percent_change_BAU','percent_change_BAU_ref_year'] if value_types == None else list(value_types)
+    if backend == 'polars':
+        dc_df = from_lazy(lazy_decompose(to_lazy(df), drivers, value_types), is_agmip_schema(df))
+        if long_format:
+            return decomposition_long_format(dc_df)
+        return dc_df
+
+    group_cols = ['model','region','variable','item','unit','year']
+    df = df.dropna(subset=group_cols).drop_duplicates(subset=group_cols+['scenario'], keep='first')
+    wide = df.set_index(group_cols+['scenario'])[value_types].unstack('scenario').sort_index()
+    keys = wide.index.to_frame(index=False)
+
+    def scenario_values(value, scenario):
+        if (value, scenario) in wide.columns:
+            return wide[(value, scenario)].to_numpy(dtype=float)
+        return np.full(len(wide), np.nan)
+
+    dc_dfs = []
+    for driver in drivers:
+        for value in value_types:
+            baseline = scenario_values(value,'BAU')
+            full = scenario_values(value,'ELM')
+            driver_only = scenario_values(value,'BAU_'+driver)
+            all_but_driver = scenario_values(value,'ELM_'+driver)
+            for normalized in [True,False]:
+                individual = driver_only-baseline
+                total = full-all_but_driver
+                if normalized:
+                    individual = individual/(full-baseline)
+                    total = total/(full-baseline)
+                interaction = total-individual
+                dc_df = pd.DataFrame({'individual':individual, 'total':total, 'interaction':interaction})
+                dc_df = pd.concat([dc_df, keys], axis=1)
+                dc_df['driver'] = driver
+                dc_df['normalized'] = normalized
+                dc_df['value_type'] = value
+                dc_df['ELM'] = full
+                dc_df['BAU'] = baseline
+                dc_df['EL2'] = scenario_values(value,'ELM_MITI')
+                dc_df['ELM_driver'] = all_but_driver
+                dc_df['BAU_driver'] = driver_only
+                dc_df['percent_change_BAU_individual'] = percent_change(baseline,individual)
+                dc_df['percent_change_BAU_total'] = percent_change(baseline,total)
+                dc_df['percent_change_BAU_interaction'] = percent_change(baseline,interaction)
+                dc_df['_group'] = np.arange(len(wide))
+                dc_dfs.append(dc_df)
+
+    cols = ['individual','total','interaction','model','region','variable','item','year','unit','driver','normalized','value_type',
+            'ELM','BAU','EL2','ELM_driver','BAU_driver',
+            'percent_change_BAU_individual','percent_change_BAU_total','percent_change_BAU_interaction']
+    if len(dc_dfs)==0:
+        dc_df = pd.DataFrame(columns=cols)
+    else:
+        dc_df = pd.concat(dc_dfs, ignore_index=True).sort_values('_group', kind='stable')[cols].reset_index(drop=True)
+
+    if long_format:
+        return decomposition_long_format(dc_df)
+    return dc_df
+
+def decomposition_long_format(dc_df, effects = ('individual','total','interaction')):
+    """
+    Converts the wide output of `decompose_all` to the long format (one row per effect), dropping empty effects.
+
+    Parameters:
+    -----------
+    dc_df (pd.DataFrame): Wide decomposition DataFrame, as returned by `decompose_all`.
+    effects (tuple of str, optional): Columns to melt into the 'effect' column. Defaults to ('individual','total','interaction').
+
+    Returns:
+    --------
+    pd.DataFrame: DataFrame with columns 'model', 'region', 'variable', 'item', 'unit', 'year', 'driver', 'normalized', 'value_type', 'effect', 'value'.
+    """
+    dc_df_l = dc_df.melt(id_vars=['model','region','variable','item','unit','year','driver','normalized','value_type'],value_vars=list(effects),var_name='effect')
+    return dc_df_l.dropna(subset=['value']).reset_index(drop=True)
+
 # def individual_effect(scenario_pl, driver, normalized = False,use_pandas=False):
 #     ## using pandas is slower than using polars
 #     if use_pandas:
@@ -0,0 +1,290 @@
+import os
+from os.path import join as pjoin
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from .basic import *
+from .bias_correction import *
+from ..helper import *
+from ..storage import *
+from ..instrument import *
+
+# folder of the RuleTables and of the model item files ('model_emissions.json', 'model_land.json')
+TEMPLATE_DIR = os.path.dirname(DEFAULT_TEMPLATE_FP)
+
+# index of the wide DataFrame of a formula set (one pivot of the base data)
+DERIVED_INDEX = ['model','scenario','region','year']
+
+# formula sets of `derive_variables`, all evaluated on one pivot of the base data:
+# - model_items: file of the template folder with the item(s) of each model. Only the models in it are calculated
+# - inputs: columns of the pivot, with the variable and item of the base rows they are read from. An item of None
+#   is the item of the model in model_items, and an input with an item is only read for the models that have it
+# - fill_value: value of the missing inputs (None: they are left empty)
+# - formulas: name and expression of the derived columns, in order (see `evaluate_formula`); an expression can
+#   use the inputs and the previous formulas
+# - outputs: columns of the long format, with their unit and the other dimension of the rows ('item' when
+#   melt is 'variable', 'variable' when melt is 'item'). The inputs and formulas not listed are only in the wide DataFrame
+# - melt: dimension of the long format whose values are the names of the outputs
+# - folder, suffix: output folder and file name suffix of `run_derived_calcs`
+# - describe: column summarized by model when the set is calculated, with its title
+DERIVED_VARIABLES = {
+    'emissions':{'model_items':'model_emissions.json',
+                 'inputs':{'ECH4':{'variable':'ECH4', 'item':None},
+                           'ECO2':{'variable':'ECO2', 'item':None},
+                           'EMIS':{'variable':'EMIS', 'item':None},
+                           'EN2O':{'variable':'EN2O', 'item':None}},
+                 'fill_value':0,
+                 'formulas':[('EMIS_added', 'ECH4 + ECO2 + EN2O'),
+                             ('EMIS_nonCO2', 'ECH4 + EN2O'),
+                             ('EMIS_diff', 'EMIS - (ECH4 + ECO2 + EN2O)'),
+                             ('ECH4_share', 'ECH4 / EMIS_added'),
+                             ('ECO2_share', 'ECO2 / EMIS_added'),
+                             ('EN2O_share', 'EN2O / EMIS_added'),
+                             ('nonCO2_share', 'EMIS_nonCO2 / EMIS_added')],
+                 'melt':'variable',
+                 'outputs':[('EMIS_added', 'AGR', 'MtCO2e'),
+                            ('EMIS_nonCO2', 'AGR', 'MtCO2e'),
+                            ('ECH4_share', 'AGR', 'share'),
+                            ('ECO2_share', 'AGR', 'share'),
+                            ('EN2O_share', 'AGR', 'share'),
+                            ('nonCO2_share', 'AGR', 'share')],
+                 'folder':'emissions',
+                 'suffix':'EMIS-calcs',
+                 'describe':('EMIS_diff', "Statistics on the difference between added emissions (CH4, N2O, and CO2) and total emisisons reported")},
+    'land':{'model_items':'model_land.json',
+            'inputs':{item:{'variable':'LAND', 'item':item} for item in ['AGR','CRP','LSP','GRS','ONV','FOR','ECP']},
+            'fill_value':None,
+            'formulas':[('AGR_added', 'CRP + GRS'),
+                        ('AGR_diff', 'AGR - AGR_added'),
+                        ('ONV_added', 'fill0(FOR) + fill0(ONV)'),
+                        ('LAND_tot', 'AGR_added + ONV_added'),
+                        ('AGR_share', 'AGR_added / LAND_tot'),
+                        ('CRP_share', 'CRP / LAND_tot'),
+                        ('GRS_share', 'GRS / LAND_tot'),
+                        ('CRP_AGR_share', 'CRP / AGR_added'),
+                        ('GRS_AGR_share', 'GRS / AGR_added'),
+                        ('ONV_share', 'ONV_added / LAND_tot')],
+            'melt':'item',
+            'outputs':[('AGR_added', 'LAND_added', '1000 ha'),
+                       ('CRP', 'LAND_added', '1000 ha'),
+                       ('GRS', 'LAND_added', '1000 ha'),
+                       ('ONV_added', 'LAND_added', '1000 ha'),
+                       ('LAND_tot', 'LAND_added', '1000 ha'),
+                       ('ONV_share', 'LAND_share', 'share'),
+                       ('AGR_share', 'LAND_share', 'share'),
+                       ('CRP_share', 'LAND_share', 'share'),
+                       ('GRS_share', 'LAND_share', 'share'),
+                       ('CRP_AGR_share', 'LAND_share', 'share'),
+                       ('GRS_AGR_share', 'LAND_share', 'share')],
+            'folder':'land',
+            'suffix':'LAND-calcs',
+            'describe':None}
+    }
+
+# functions of the formula expressions
+FORMULA_FUNCTIONS = {'fill0':lambda x: x.fillna(0)}
+
+def load_model_items(fp):
+    """
+    Loads the item(s) of each model for a formula set (e.g. 'model_emissions.json').
+
+    Parameters:
+    -----------
+    fp (str): JSON file, relative to the template folder of this package (TEMPLATE_DIR) or absolute.
+
+    Returns:
+    --------
+    dict: List of items of each model.
+    """
+    with open(pjoin(TEMPLATE_DIR, fp)) as f:
+        model_dict = json.load(f)
+    return {model:[entry['item']] if isinstance(entry['item'], str) else list(entry['item']) for model, entry in model_dict.items()}
+
+def input_map(sets, models):
+    """
+    Gets the base rows read by the inputs of formula sets, for the models of the data.
+
+    Parameters:
+    -----------
+    sets (list of str): Formula sets (see DERIVED_VARIABLES).
+    models (list of str): Models of the data.
+
+    Returns:
+    --------
+    pd.DataFrame: Columns 'model', 'variable', 'item', '_input' (name of the input) and '_set'.
+    """
+    rows = []
+    for name in sets:
+        formula_set = DERIVED_VARIABLES[name]
+        model_items = load_model_items(formula_set['model_items'])
+        for model in [model for model in model_items if model in models]:
+            for input_name, spec in formula_set['inputs'].items():
+                items = model_items[model] if spec['item'] == None else [spec['item']]
+                rows += [(model, spec['variable'], item, input_name, name) for item in items if item in model_items[model]]
+    return pd.DataFrame(rows, columns=['model','variable','item','_input','_set'])
+
+def evaluate_formula(expression, columns):
+    """
+    Evaluates the expression of a formula (e.g. 'ECH4 / EMIS_added') on the columns of a wide DataFrame.
+
+    The names of the expression are the columns, and the functions of FORMULA_FUNCTIONS (e.g. 'fill0(FOR)').
+
+    Parameters:
+    -----------
+    expression (str): Python arithmetic expression.
+    columns (dict): Columns by name.
+
+    Returns:
+    --------
+    pd.Series
+    """
+    return eval(expression, {'__builtins__':{}, **FORMULA_FUNCTIONS}, columns)
+
+def derive_variables(df, sets=None, base_year=2020):
+    """
+    Calculates the derived variables of formula sets (see DERIVED_VARIABLES) and their percentage changes.
+
+    The inputs of all the sets are selected with one keyed join on (model, variable, item) and pivoted once by
+    (model, scenario, region, year). The formulas of each set are evaluated on the rows of the pivot where one of
+    its inputs is reported, and the outputs of all the sets are melted to the long format and given their percent
+    change and differences columns in one pass (see `pc_diff_interp`). Adding a formula, or a set, does not add a
+    read, a pivot or a pc-diff pass.
+
+    Parameters:
+    -----------
+    df (pd.DataFrame): pc-diff data.
+    sets (list of str or None, optional): Formula sets. If None, all of them. Defaults to None.
+    base_year (int, optional): The base year of the percent changes and differences. Defaults to 2020.
+
+    Returns:
+    --------
+    dict: For each set, a dict with 'wide' (inputs and formulas by (model, scenario, region, year)), 'long' (outputs
+    in the AgMIP long format) and 'pc' (long format with the percent change and differences columns), or None if
+    the data has no valid entries for the set.
+    """
+    sets = list(DERIVED_VARIABLES.keys()) if sets == None else list(sets)
+    inputs = input_map(sets, [str(x) for x in df.model.dropna().unique()])
+    results = {name:None for name in sets}
+    sets = [name for name in sets if name in set(inputs._set)]
+    if len(sets) == 0:
+        return results
+    # inputs that no model reports are still columns of the pivot (empty)
+    input_names = list(dict.fromkeys([input_name for name in sets for input_name in DERIVED_VARIABLES[name]['inputs']]))
+
+    # one join and one pivot for all the sets
+    fdf = df[df.variable.isin(inputs.variable.unique()) & df.model.notna() & df.item.notna()][DERIVED_INDEX+['variable','item','value']]
+    keys = inputs.model+'|'+inputs.variable+'|'+inputs.item
+    fdf = fdf.assign(_key=fdf.model.astype(str)+'|'+fdf.variable.astype(str)+'|'+fdf.item.astype(str))
+    fdf = fdf.merge(inputs[['_input']].assign(_key=keys), on='_key')
+    wide_all = fdf.pivot_table(index=DERIVED_INDEX, observed=True, columns='_input', values='value').reset_index()
+    wide_all = wide_all.reindex(columns=DERIVED_INDEX+input_names)
+    wide_all.columns.name = None
+
+    wides, longs = {}, {}
+    for name in sets:
+        formula_set = DERIVED_VARIABLES[name]
+        set_inputs = list(formula_set['inputs'].keys())
+        other = 'item' if formula_set['melt'] == 'variable' else 'variable'
+        outputs = [output[0] for output in formula_set['outputs']]
+        other_map = {output[0]:output[1] for output in formula_set['outputs']}
+        unit_map = {output[0]:output[2] for output in formula_set['outputs']}
+        wide = wide_all[wide_all[set_inputs].notna().any(axis=1)][DERIVED_INDEX+set_inputs].reset_index(drop=True)
+        if formula_set['fill_value'] != None:
+            wide = wide.fillna({col:formula_set['fill_value'] for col in set_inputs})
+        for formula, expression in formula_set['formulas']:
+            wide[formula] = evaluate_formula(expression, {col:wide[col] for col in wide.columns})
+        long = wide.melt(id_vars=DERIVED_INDEX, value_vars=outputs, var_name=formula_set['melt'], value_name='value')
+        long[other] = long[formula_set['melt']].map(other_map)
+        long['unit'] = long[formula_set['melt']].map(unit_map)
+        wides[name], longs[name] = wide, long
+
+    # sets whose inputs are not reported by any model of the data have no valid entries
+    sets = [name for name in sets if len(wides[name]) > 0]
+    if len(sets) == 0:
+        return results
+
+    # percent changes of all the outputs in one pass, each set keeping its own index (as if calculated alone)
+    long_all = pd.concat([longs[name].reset_index(drop=True).assign(_set=name) for name in sets])
+    print(">> Running percentage change calculations...")
+    pc_all = pc_diff_interp(long_all, base_year=base_year, save=False)
+    for name in sets:
+        pc = pc_all[pc_all._set==name].drop(columns='_set')
+        long_cols = list(longs[name].columns)
+        results[name] = {'wide':wides[name],
+                         'long':longs[name],
+                         'pc':pc[long_cols+[col for col in pc.columns if col not in long_cols]]}
+    return results
+
+def run_derived_calcs(fp, sets=None, file_format=None, output_dir=None, save=True, base_filename=None, base_year=2020):
+    """
+    Calculates the derived variables of formula sets (see `derive_variables`) from a pc-diff file, and saves the
+    wide, long and pc-diff outputs of each set.
+
+    Parameters:
+    -----------
+    fp (str or pd.DataFrame): File path of a pc-diff file (CSV, Parquet or Arrow IPC), or the pc-diff DataFrame itself.
+    sets (list of str or None, optional): Formula sets (see DERIVED_VARIABLES). If None, all of them. Defaults to None.
+    file_format (str, optional): Storage format of the outputs, 'csv', 'parquet' or 'arrow'. If None, the format of the input file is used ('csv' for a DataFrame). Defaults to None.
+    output_dir (str or dict, optional): Directory where the outputs of each set are saved, in the folder of the set
+        (e.g. 'emissions'), or the directory of each set. If None, the directory of the input file. Defaults to None.
+    save (bool, optional): If False, nothing is written to disk. Defaults to True.
+    base_filename (str, optional): Prefix of the output files. If None, the input file name (or the model name for a DataFrame) is used. Defaults to None.
+    base_year (int, optional): The base year of the percent changes and differences. Defaults to 2020.
+
+    Returns:
+    --------
+    dict: The derived variables of each set with their percentage changes, or None if the DataFrame has no valid entries for the set.
+    """
+    if isinstance(fp,pd.DataFrame):
+        df = fp
+        assert (not save) or (output_dir != None), "output_dir is needed to save the outputs of a DataFrame"
+        if file_format == None:
+            file_format = 'csv'
+        if base_filename == None:
+            base_filename = '-'.join([str(x) for x in df.model.unique()])
+    else:
+        df = read_stage(fp,index_col=0)
+        if file_format == None:
+            file_format = stage_format(fp)
+        if base_filename == None:
+            base_filename = os.path.splitext(fp.split('/')[-1])[0]
+        if output_dir == None:
+            output_dir = '/'.join(fp.split('/')[:-1])
+
+    results = derive_variables(df, sets, base_year)
+    pcs = {}
+    for name, result in results.items():
+        formula_set = DERIVED_VARIABLES[name]
+        if result == None:
+            print(f"DataFrame has no valid entries for {name} calcs!")
+            pcs[name] = None
+            continue
+        if formula_set['describe'] != None:
+            col, title = formula_set['describe']
+            print(f"\n{title}")
+            print(result['wide'].groupby(['model'], observed=True)[col].describe())
+        pcs[name] = result['pc']
+        if not save:
+            continue
+        set_dir = output_dir[name] if isinstance(output_dir, dict) else pjoin(output_dir, formula_set['folder'])
+        check_path(set_dir)
+        filename = stage_fp(pjoin(set_dir,f"{base_filename}_{formula_set['suffix']}-w.csv"),file_format)
+        print(f"\n>> Saving wide DataFrame to {filename}")
+        write_stage(result['wide'], filename, index=False)
+        filename = stage_fp(pjoin(set_dir,f"{base_filename}_{formula_set['suffix']}.csv"),file_format)
+        print(f">> Saving long DataFrame to {filename}")
+        write_stage(result['long'], filename, index=False)
+        filename = stage_fp(pjoin(set_dir,f"{base_filename}_{formula_set['suffix']}_pc-diff_interp-{base_year}.csv"),file_format)
+        print(f">> Saving percentage changes to {filename}")
+        write_stage(result['pc'], filename)
+        # diagnostics of the percent changes, written once per set (see pc_diff_diagnostics)
+        log_dir = pjoin(set_dir,'logs')
+        check_path(log_dir)
+        diagnostics_fp = pjoin(log_dir,f"{base_filename}_{formula_set['suffix']}_pc-diff-diagnostics_{time.strftime('%y%m%d-%H%M%S', time.localtime())}.csv")
+        diagnostics_df = pc_diff_diagnostics(result['pc'],base_year)
+        diagnostics_df.to_csv(diagnostics_fp,index=False)
+        if len(diagnostics_df) > 0:
+            print(f"{diagnostics_df.rows.sum()} failed check(s) in the percent changes and differences, see {diagnostics_fp}")
+    return pcs
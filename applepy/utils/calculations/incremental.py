@@ -0,0 +1,150 @@
+import pandas as pd
+import numpy as np
+
+from .bias_correction import *
+from .decomposition import *
+
+# a pc-diff group: all scenarios and years of one series of a model
+GROUP_COLS = ['model','variable','item','region','unit']
+# an entry of a submission
+KEY_COLS = ['model','scenario','region','variable','item','unit','year']
+
+def in_groups(df, groups, group_cols=GROUP_COLS):
+    """
+    Flags the rows of a DataFrame that belong to some groups, with one keyed join.
+
+    Parameters
+    ----------
+    df (pd.DataFrame): DataFrame with the `group_cols` columns.
+    groups (pd.DataFrame): Unique group keys (`group_cols` columns).
+    group_cols (list of str, optional): Group columns. Defaults to GROUP_COLS.
+
+    Returns
+    -------
+    np.ndarray: Boolean mask, True for the rows of `df` in `groups`.
+    """
+    if len(groups)==0:
+        return np.zeros(len(df), dtype=bool)
+    keys = df[group_cols].astype(object)
+    groups = groups[group_cols].astype(object).drop_duplicates().assign(_in_groups=True)
+    return keys.merge(groups, on=group_cols, how='left')['_in_groups'].notna().to_numpy()
+
+def replaced_rows(old_df, new_df, replace='scenario'):
+    """
+    Flags the rows of the previous data that a new submission replaces.
+
+    Parameters
+    ----------
+    old_df (pd.DataFrame): Previous data (e.g. a pc-diff output).
+    new_df (pd.DataFrame): New submission.
+    replace (str, optional): 'scenario' replaces every row of the (model, scenario) pairs of `new_df`, like the partial
+        update recipe of the data-processing notebook. 'key' only replaces the rows with the same KEY_COLS as a row of
+        `new_df`. Defaults to 'scenario'.
+
+    Returns
+    -------
+    np.ndarray: Boolean mask, True for the rows of `old_df` replaced by `new_df`.
+    """
+    assert replace in ['scenario','key'], "replace should be 'scenario' or 'key'"
+    cols = ['model','scenario'] if replace=='scenario' else KEY_COLS
+    return in_groups(old_df, new_df[cols].drop_duplicates(), cols)
+
+def dirty_groups(old_df, new_df, replace='scenario'):
+    """
+    Diffs a new submission against the previous data by key, and gets the groups whose entries changed.
+
+    A group is dirty if an entry was added, removed, or has a different value. Groups that are resubmitted unchanged
+    are not dirty.
+
+    Parameters
+    ----------
+    old_df (pd.DataFrame): Previous data, with the KEY_COLS columns and 'value'.
+    new_df (pd.DataFrame): New submission, with the KEY_COLS columns and 'value'.
+    replace (str, optional): 'scenario' or 'key', see `replaced_rows`. Defaults to 'scenario'.
+
+    Returns
+    -------
+    pd.DataFrame: Unique GROUP_COLS keys of the dirty groups.
+    """
+    old_part = old_df.loc[replaced_rows(old_df, new_df, replace), KEY_COLS+['value']]
+    dtypes = {col:(float if col=='year' else object) for col in KEY_COLS}
+    old_part = old_part.astype(dtypes)
+    new_part = new_df[KEY_COLS+['value']].astype(dtypes)
+    diff = old_part.merge(new_part, on=KEY_COLS, how='outer', suffixes=('_old','_new'), indicator=True)
+    same = (diff.value_old==diff.value_new) | (diff.value_old.isna() & diff.value_new.isna())
+    changed = (diff._merge!='both') | ~same
+    return diff.loc[changed, GROUP_COLS].drop_duplicates().reset_index(drop=True)
+
+def update_entries(old_df, new_df, replace='scenario'):
+    """
+    Replaces the entries of the previous data by the ones of a new submission.
+
+    Parameters
+    ----------
+    old_df (pd.DataFrame): Previous data.
+    new_df (pd.DataFrame): New submission.
+    replace (str, optional): 'scenario' or 'key', see `replaced_rows`. Defaults to 'scenario'.
+
+    Returns
+    -------
+    pd.DataFrame: The new entries, followed by the previous entries that are not replaced.
+    """
+    return concat_agmip([new_df, old_df[~replaced_rows(old_df, new_df, replace)]], ignore_index=True)
+
+def incremental_pc_diff(old_pc, old_df, new_df, replace='scenario', base_year=2020):
+    """
+    Updates a pc-diff output with a partial submission, recomputing only the groups that changed.
+
+    The new submission is diffed against the previous entries by key (see `dirty_groups`). The entries of the dirty
+    (model, variable, item, region, unit) groups are rebuilt (see `update_entries`), their percent change and difference
+    columns are recomputed with `pc_diff_frame`, and they are spliced into `old_pc` in place of the previous rows of
+    these groups. The cost of the recompute is proportional to the size of the dirty groups, not to the size of the model.
+
+    Parameters
+    ----------
+    old_pc (pd.DataFrame): Previous pc-diff output (see `pc_diff_interp`).
+    old_df (pd.DataFrame): Previous entries that `old_pc` was computed from (e.g. the template-checked output of
+        `el2_pipeline`). The pc-diff output cannot be used here, since its interpolated base-year rows are not entries.
+    new_df (pd.DataFrame): New (template-checked) submission, with columns 'model', 'scenario', 'region', 'variable',
+        'item', 'unit', 'year', 'value'. For example, only the replaced scenarios of one model.
+    replace (str, optional): 'scenario' or 'key', see `replaced_rows`. Defaults to 'scenario'.
+    base_year (int, optional): The base year of the percent changes. Defaults to 2020.
+
+    Returns
+    -------
+    pc_df (pd.DataFrame): Updated pc-diff output. The rows of the clean groups keep their order, the recomputed groups
+        are appended at the end.
+    dirty (pd.DataFrame): Keys of the recomputed groups, to update the decomposition (see `incremental_decomposition`).
+    """
+    dirty = dirty_groups(old_df, new_df, replace)
+    print(f"{len(dirty)} group(s) changed")
+
+    # previous entries of the dirty groups that are not replaced, with the new entries
+    data_cols = KEY_COLS+['value']
+    keep_old = in_groups(old_df, dirty) & ~replaced_rows(old_df, new_df, replace)
+    group_df = concat_agmip([new_df.loc[in_groups(new_df, dirty), data_cols], old_df.loc[keep_old, data_cols]], ignore_index=True)
+    group_pc = pc_diff_frame(group_df, base_year).reset_index(drop=True)
+
+    pc_df = concat_agmip([old_pc[~in_groups(old_pc, dirty)].reset_index(drop=True), group_pc], ignore_index=True)
+    return pc_df[old_pc.columns.intersection(pc_df.columns)], dirty
+
+def incremental_decomposition(old_dc, pc_df, dirty, decompose_fn=decompose_all):
+    """
+    Updates a decomposition output for the groups recomputed by `incremental_pc_diff`.
+
+    Parameters
+    ----------
+    old_dc (pd.DataFrame): Previous decomposition output (see `decompose_all`).
+    pc_df (pd.DataFrame): Updated pc-diff output.
+    dirty (pd.DataFrame): Keys of the recomputed groups.
+    decompose_fn (callable, optional): Decomposition of a pc-diff DataFrame, e.g. `decompose_all`, or a function that
+        filters the scenarios, regions and years first as in the data-processing notebook. Defaults to decompose_all.
+
+    Returns
+    -------
+    pd.DataFrame: Updated decomposition. The rows of the clean groups keep their order, the recomputed groups are
+    appended at the end.
+    """
+    dc_dirty = decompose_fn(pc_df[in_groups(pc_df, dirty)])
+    dc_df = concat_agmip([old_dc[~in_groups(old_dc, dirty)], dc_dirty], ignore_index=True)
+    return dc_df
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+# dimensions of the sorted index of a Dataset, from the most to the least selective in the notebooks
+INDEX_COLS = ['variable','item','region','scenario','model','year']
+
+class Dataset:
+    """
+    AgMIP DataFrame with a sorted index on its dimensions, for repeated selections (e.g. the global dataset or the
+    decomposition in the paper notebooks).
+
+    The rows are sorted once on the integer codes of the `index_cols` columns. A selection narrows the sorted rows
+    with binary searches, level by level, as long as the levels are selected, and the other selected columns are
+    then filtered on the remaining rows only. Recent selections are kept in a size-bounded LRU cache.
+
+    A selection has the same rows, in the same order and with the same index labels, as the equivalent boolean mask
+    (e.g. `df[(df.variable.isin(variables)) & (df.item==item) & (df.year==year)]`).
+
+    Parameters
+    ----------
+    df (pd.DataFrame): Data. It is not copied, and should not be modified after the Dataset is created.
+    index_cols (list of str, optional): Columns of the sorted index, in order. Columns not in `df` are skipped.
+        Defaults to INDEX_COLS.
+    cache_size (int, optional): Maximum number of selections in the cache. Defaults to 128.
+    cache_memory (int, optional): Maximum memory (bytes) of the selections in the cache. Defaults to 256 MiB.
+
+    Examples
+    --------
+    >>> ds = Dataset(pd.read_csv('../data/global-paper_dataset.csv', index_col=0))
+    >>> fdf = ds.select(variable=['CONS','FOOD'], item='AGR', region='WLD', year=2050, columns=['model','scenario','value'])
+    """
+    def __init__(self, df, index_cols=INDEX_COLS, cache_size=128, cache_memory=256*2**20):
+        self.df = df
+        self.index_cols = [col for col in index_cols if col in df.columns]
+        self.cache_size = cache_size
+        self.cache_memory = cache_memory
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # integer codes of each level, missing values last
+        self.levels = {}
+        codes = []
+        for col in self.index_cols:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                level_codes, uniques = df[col].cat.codes.to_numpy(), df[col].cat.categories
+            else:
+                try:
+                    level_codes, uniques = pd.factorize(df[col], sort=True)
+                except TypeError:
+                    level_codes, uniques = pd.factorize(df[col])
+            level_codes = np.where(level_codes<0, len(uniques), level_codes).astype(np.int64)
+            self.levels[col] = pd.Index(uniques)
+            codes.append(level_codes)
+
+        # positions of the rows of `df` in index order (np.lexsort sorts by the last key first)
+        self.positions = np.lexsort(codes[::-1]) if len(codes)>0 else np.arange(len(df))
+        self.codes = {col:level_codes[self.positions] for col, level_codes in zip(self.index_cols, codes)}
+
+    def __len__(self):
+        return len(self.df)
+
+    def _cache_key(self, dims, columns):
+        key = []
+        for col in sorted(dims.keys()):
+            values = dims[col]
+            if pd.api.types.is_list_like(values):
+                values = frozenset(values)
+            key.append((col, values))
+        return (tuple(key), None if columns == None else tuple(columns))
+
+    def _index_ranges(self, dims):
+        """
+        Narrows the sorted rows on the selected levels of the index.
+
+        Returns
+        -------
+        ranges (list of tuple): (start, stop) ranges of the sorted rows.
+        used (list of str): Levels that were used for the narrowing.
+        """
+        ranges = [(0, len(self.df))]
+        used = []
+        for col in self.index_cols:
+            if col not in dims:
+                # the next levels are not sorted within the ranges
+                break
+            values = dims[col] if pd.api.types.is_list_like(dims[col]) else [dims[col]]
+            level_codes = self.levels[col].get_indexer(pd.Index(list(values)).unique())
+            level_codes = np.sort(level_codes[level_codes>=0])
+            codes = self.codes[col]
+            new_ranges = []
+            for start, stop in ranges:
+                starts = start+np.searchsorted(codes[start:stop], level_codes, side='left')
+                stops = start+np.searchsorted(codes[start:stop], level_codes, side='right')
+                new_ranges += [(a, b) for a, b in zip(starts, stops) if b>a]
+            ranges = new_ranges
+            used.append(col)
+        return ranges, used
+
+    def select(self, columns=None, **dims):
+        """
+        Selects the rows with the given values of some dimensions.
+
+        Parameters
+        ----------
+        columns (list of str or None, optional): Columns of the selection. If None, all the columns. Defaults to None.
+        **dims: Values of the columns to select, a single value (e.g. `year=2050`) or a list of values
+            (e.g. `scenario=['BAU','ELM']`). Any column of the data can be used; the columns of the index are answered
+            by index slicing.
+
+        Returns
+        -------
+        pd.DataFrame: The selected rows, as a copy.
+        """
+        for col in dims:
+            assert col in self.df.columns, f"'{col}' is not a column of the dataset"
+        key = self._cache_key(dims, columns)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key].copy()
+        self.misses += 1
+
+        ranges, used = self._index_ranges(dims)
+        if len(ranges)>0:
+            sorted_positions = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+        else:
+            sorted_positions = np.zeros(0, dtype=np.int64)
+        # back to the order of the rows of df
+        positions = np.sort(self.positions[sorted_positions])
+        selection = self.df.iloc[positions]
+
+        # the dimensions that are not in the sorted index, or after an unselected level of the index
+        mask = np.ones(len(selection), dtype=bool)
+        for col, values in dims.items():
+            if col in used:
+                continue
+            if pd.api.types.is_list_like(values):
+                mask &= selection[col].isin(list(values)).to_numpy()
+            else:
+                mask &= (selection[col]==values).to_numpy()
+        if not mask.all():
+            selection = selection[mask]
+        if columns != None:
+            selection = selection[list(columns)]
+
+        self._add_to_cache(key, selection)
+        return selection.copy()
+
+    def _add_to_cache(self, key, selection):
+        size = int(selection.memory_usage(index=True, deep=False).sum())
+        if (self.cache_size<1) or (size>self.cache_memory):
+            return
+        self._cache[key] = selection
+        self._cache_bytes += size
+        while (len(self._cache)>self.cache_size) or (self._cache_bytes>self.cache_memory):
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= int(evicted.memory_usage(index=True, deep=False).sum())
+
+    def clear_cache(self):
+        """
+        Empties the cache of selections.
+        """
+        self._cache.clear()
+        self._cache_bytes = 0
+
+    def cache_info(self):
+        """
+        Gets the statistics of the cache of selections.
+
+        Returns
+        -------
+        dict: 'hits', 'misses', 'entries', and 'bytes' (memory of the cached selections).
+        """
+        return {'hits':self.hits, 'misses':self.misses, 'entries':len(self._cache), 'bytes':self._cache_bytes}
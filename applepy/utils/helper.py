@@ -1,8 +1,11 @@
+import csv
 import json
 import pickle
 import os
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from IPython.display import display, clear_output
 
 def find_nearest(array, value):
@@ -91,71 +94,245 @@ def loadPickle(filepath):
         data = pickle.load(f)   
     return data
 
-def AgMIP_read_raw_csv(fp, model = 'myGeoHub'):
+# columns of an AgMIP DataFrame, in order
+AGMIP_COLS = ['model','scenario','region','variable','item','unit','year','value']
+
+# layouts of the raw submissions
+# - 'myGeoHub': comma separated, no header (MAGNET, MAgPIE, AIM, FARM, GLOBIOM, ...)
+# - 'IMPACT': semicolon separated, with a header and an extra 'description' column
+# - 'IMAGE': comma separated, with a header (column names in any case)
+CSV_FORMATS = {'myGeoHub': {'delimiter':',', 'header':False},
+               'IMPACT': {'delimiter':';', 'header':True},
+               'IMAGE': {'delimiter':',', 'header':True}
+               }
+
+# layout of the submissions of each model, to check the `model` argument of AgMIP_read_raw_csv
+MODEL_FORMATS = {'myGeoHub':'myGeoHub',
+                 'MAGNET':'myGeoHub',
+                 'MAgPIE':'myGeoHub',
+                 'AIM':'myGeoHub',
+                 'FARM':'myGeoHub',
+                 'GLOBIOM':'myGeoHub',
+                 'IMPACT':'IMPACT',
+                 'IMAGE':'IMAGE'
+                 }
+
+# strings read as missing values, the defaults of pd.read_csv
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                 '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+def sniff_agmip_csv(fp, sample_size=1<<16):
+    """
+    Detects the layout of a raw AgMIP submission from its first bytes.
+
+    The delimiter is the most frequent of ',', ';' and tab in the first line. The first line is a header if it names
+    the 'model', 'scenario' and 'year' columns (in any case).
+
+    Parameters
+    ----------
+    fp (str): Path of the raw CSV file.
+    sample_size (int, optional): Number of bytes read. Defaults to 64 KiB.
+
+    Returns
+    -------
+    dict: 'format' (a key of CSV_FORMATS), 'delimiter', 'header' (bool), and 'columns', the names of the columns of
+    the file (AGMIP_COLS, plus 'description' for IMPACT).
+
+    Raises
+    ------
+    ValueError
+        If the file is empty, or its columns do not match any layout.
+    """
+    with open(fp, 'rb') as f:
+        sample = f.read(sample_size).decode('utf-8-sig', errors='replace')
+    lines = sample.splitlines()
+    if (len(lines)==0) or (lines[0].strip()==''):
+        raise ValueError(f"{fp} is empty")
+
+    first_line = lines[0]
+    delimiter = max([',',';','\t'], key=first_line.count)
+    fields = [field.strip() for field in next(csv.reader([first_line], delimiter=delimiter))]
+    names = [field.lower() for field in fields]
+    header = all([col in names for col in ['model','scenario','year']])
+
+    if not header:
+        if len(fields) != len(AGMIP_COLS):
+            raise ValueError(f"{fp} has no header and {len(fields)} columns, expected the {len(AGMIP_COLS)} columns {AGMIP_COLS}")
+        return {'format':'myGeoHub', 'delimiter':delimiter, 'header':False, 'columns':list(AGMIP_COLS)}
+
+    if 'description' in names:
+        csv_format = 'IMPACT'
+    else:
+        csv_format = 'IMAGE'
+    if all([col in names for col in AGMIP_COLS]):
+        columns = names
+    elif len(fields) == len(AGMIP_COLS):
+        # renamed by position, like the IMAGE submissions
+        columns = list(AGMIP_COLS)
+    else:
+        raise ValueError(f"{fp} has the columns {fields}, expected {AGMIP_COLS}")
+    return {'format':csv_format, 'delimiter':delimiter, 'header':True, 'columns':columns}
+
+def read_csv_arrow(fp, layout):
     """
-    TODO: 
-    Reads and processes raw CSV files for different agricultural models used in the Agricultural Model Intercomparison and Improvement Project (AgMIP).
+    Reads a raw AgMIP submission with the multi-threaded Arrow CSV reader.
+
+    The dimensions are read as dictionary-encoded strings (categoricals), 'year' and 'value' as float64. Only the
+    AGMIP_COLS columns are parsed. If 'year' or 'value' has entries that are not numbers (e.g. 'abc', see the
+    ValueFixTable of the template checks), they are read again as strings, like `pd.read_csv` does.
 
-    This function handles CSV files from various agricultural models, each with its own format and requirements. Depending on the specified model, it reads the CSV file and returns a pandas DataFrame with appropriate columns or modifications.
+    Parameters
+    ----------
+    fp (str): Path of the raw CSV file.
+    layout (dict): Layout of the file, see `sniff_agmip_csv`.
+
+    Returns
+    -------
+    pd.DataFrame: The AGMIP_COLS columns of the file.
+    """
+    read_options = pa_csv.ReadOptions(column_names=layout['columns'], skip_rows=int(layout['header']), use_threads=True)
+    parse_options = pa_csv.ParseOptions(delimiter=layout['delimiter'])
+    dimension = pa.dictionary(pa.int32(), pa.string())
+    column_types = {col:dimension for col in AGMIP_COLS[:-2]}
+
+    def read(number_type):
+        convert_options = pa_csv.ConvertOptions(column_types={**column_types, 'year':number_type, 'value':number_type},
+                                                include_columns=AGMIP_COLS,
+                                                null_values=CSV_NA_VALUES,
+                                                strings_can_be_null=True)
+        return pa_csv.read_csv(fp, read_options=read_options, parse_options=parse_options, convert_options=convert_options).to_pandas()
+
+    try:
+        df = read(pa.float64())
+    except pa.ArrowInvalid:
+        df = read(pa.string())
+        for col in ['year','value']:
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except (ValueError, TypeError):
+                # kept as strings, with NaN as missing value like pd.read_csv
+                df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+
+    # integer years, as pd.read_csv infers them
+    if pd.api.types.is_float_dtype(df.year) and df.year.notna().all() and (df.year == np.round(df.year)).all():
+        df['year'] = df.year.astype('int64')
+    return df
+
+def iter_csv_arrow(fp, layout=None, block_size=1<<26):
+    """
+    Reads a raw AgMIP submission (or a CSV stage output) in chunks, with the streaming Arrow CSV reader, so that files
+    larger than the memory can be scanned.
+
+    The dimensions are dictionary-encoded strings (categoricals), 'year' and 'value' are float64, with the entries that
+    are not numbers (e.g. 'abc') kept as strings. The type of a column can differ from chunk to chunk.
+
+    Parameters
+    ----------
+    fp (str): Path of the CSV file.
+    layout (dict or None, optional): Layout of the file, see `sniff_agmip_csv`. If None, it is detected. Defaults to None.
+    block_size (int, optional): Number of bytes of the file in a chunk. Defaults to 64 MiB.
+
+    Yields
+    ------
+    pd.DataFrame: The AGMIP_COLS columns of the next rows, indexed by their position in the file.
+    """
+    if layout == None:
+        layout = sniff_agmip_csv(fp)
+    read_options = pa_csv.ReadOptions(column_names=layout['columns'], skip_rows=int(layout['header']), block_size=block_size)
+    parse_options = pa_csv.ParseOptions(delimiter=layout['delimiter'])
+    dimension = pa.dictionary(pa.int32(), pa.string())
+    convert_options = pa_csv.ConvertOptions(column_types={**{col:dimension for col in AGMIP_COLS[:-2]}, 'year':pa.string(), 'value':pa.string()},
+                                            include_columns=AGMIP_COLS,
+                                            null_values=CSV_NA_VALUES,
+                                            strings_can_be_null=True)
+    start = 0
+    with pa_csv.open_csv(fp, read_options=read_options, parse_options=parse_options, convert_options=convert_options) as reader:
+        for batch in reader:
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(start, start+len(df))
+            start += len(df)
+            for col in ['year','value']:
+                number = pd.to_numeric(df[col], errors='coerce')
+                if number.notna().sum() == df[col].notna().sum():
+                    df[col] = number
+                else:
+                    df[col] = number.astype(object).where(number.notna(), df[col].astype(object)).where(df[col].notna(), np.nan)
+            yield df
+
+def AgMIP_read_raw_csv(fp, model = None, schema = True, value_dtype = 'float64', engine = 'arrow'):
+    """
+    Reads a raw AgMIP submission CSV file.
+
+    The layout of the file is detected from its first bytes (see `sniff_agmip_csv`), so the model does not need to be
+    given:
+    - 'myGeoHub': comma separated, no header (MAGNET, MAgPIE, AIM, FARM, GLOBIOM, ...)
+    - 'IMPACT': semicolon separated, with a header; the 'description' column is dropped
+    - 'IMAGE': comma separated, with a header; the columns are renamed to lower case
 
     Parameters:
     -----------
     fp : str
-    The file path to the raw CSV file to be read.
-    model : str
-        The name of the agricultural model. Supported models include:
-        - 'MAGNET'
-        - 'MAgPIE'
-        - 'AIM'
-        - 'IMPACT'
-        Default is 'myGeoHub'
-
+        The file path to the raw CSV file to be read.
+    model : str or None
+        The name of the agricultural model (a key of MODEL_FORMATS). If given, the detected layout must be the one of
+        the model, otherwise a ValueError is raised instead of misparsing the file. Default is None (detected).
+    schema : bool
+        If True, the AgMIP schema is applied (categorical dimensions, int16 year, see `apply_agmip_schema`). Default is True.
+    value_dtype : str
+        dtype of the values in the AgMIP schema, 'float64' or 'float32'. Default is 'float64'.
+    engine : str
+        'arrow' for the multi-threaded Arrow CSV reader with explicit column types (see `read_csv_arrow`), or 'pandas'
+        for `pd.read_csv`. Default is 'arrow'.
 
     Returns:
     --------
     pandas.DataFrame
-        A DataFrame containing the processed data from the CSV file. The structure of the DataFrame depends on the specified model:
-        - For 'MAGNET', 'MAgPIE', and 'AIM': The DataFrame will have columns ['model', 'scenario', 'region', 'variable', 'item', 'unit', 'year', 'value'].
-        - For 'IMPACT': The DataFrame will be read with a semicolon separator, and the 'description' column will be dropped if present.
+        A DataFrame with the columns ['model', 'scenario', 'region', 'variable', 'item', 'unit', 'year', 'value'].
 
     Raises:
     -------
     ValueError
-        If the model is not one of the supported models ('MAGNET', 'MAgPIE', 'AIM', 'IMPACT').
+        If the layout of the file is not recognized, or is not the one of `model`.
 
     Examples:
     ---------
-    >>> df = AgMIP_read_raw_csv('path/to/magnet_data.csv','MAGNET')
+    >>> df = AgMIP_read_raw_csv('path/to/magnet_data.csv')
     >>> df.head()
        model scenario region  variable   item unit  year  value
     0  ...     ...     ...      ...      ...   ...  ...   ...
     1  ...     ...     ...      ...      ...   ...  ...   ...
 
-    >>> df = AgMIP_read_raw_csv('IMPACT', 'path/to/impact_data.csv')
-    >>> df.head()
-       ...  ...  ...  ...  ...  ...  ...  ...
-    0  ...  ...  ...  ...  ...  ...  ...  ...
-    1  ...  ...  ...  ...  ...  ...  ...  ...
+    >>> df = AgMIP_read_raw_csv('path/to/impact_data.csv', 'IMPACT')
 
     Notes:
     ------
-    - Ensure the CSV file format matches the expected structure for the specified model.
-    - The function assumes that the first line in the CSV for 'IMPACT' contains headers separated by semicolons.
-
+    - The default of `model` used to be 'myGeoHub', which read every file as a myGeoHub CSV and misparsed the IMPACT
+      and IMAGE layouts. It is now None, and the layout is detected. Files in the myGeoHub layout are read the same
+      way, with or without `model`. Pass model='myGeoHub' to keep rejecting the other layouts (a ValueError is
+      raised instead of misparsing them).
     """
-    if (model=='myGeoHub') or (model == 'MAGNET') or (model=='MAgPIE') or (model=='AIM') or (model=='FARM') or (model =='GLOBIOM'):
-        col_names = ['model','scenario','region','variable','item','unit','year','value']
-        df = pd.read_csv(fp,names=col_names)
-    
-    elif model == 'IMPACT':
-        df = pd.read_csv(fp,sep=';').drop(columns='description')
-    
-    elif model == 'IMAGE':
-        # change column names to all lower case
-        col_names = ['model', 'scenario', 'region', 'variable', 'item', 'unit', 'year', 'value']
-        df = pd.read_csv(fp)
-        df.columns = col_names
-    
+    assert engine in ['arrow','pandas'], "engine should be 'arrow' or 'pandas'"
+    layout = sniff_agmip_csv(fp)
+    if model != None:
+        if model not in MODEL_FORMATS:
+            raise ValueError(f"unknown model '{model}'. Must be one of {list(MODEL_FORMATS.keys())}")
+        if MODEL_FORMATS[model] != layout['format']:
+            raise ValueError(f"{fp} has the '{layout['format']}' layout, but model '{model}' submits the '{MODEL_FORMATS[model]}' layout")
+
+    if engine == 'arrow':
+        df = read_csv_arrow(fp, layout)
+    else:
+        df = pd.read_csv(fp, sep=layout['delimiter'], header=0 if layout['header'] else None, names=layout['columns'], usecols=AGMIP_COLS)
+        df = df[AGMIP_COLS]
+
+    if schema:
+        # imported here, storage depends on this module through template
+        from .storage import apply_agmip_schema
+        df = apply_agmip_schema(df, value_dtype=value_dtype)
+    else:
+        for col in AGMIP_COLS[:-2]:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
     return df
 
 def get_group_keys(df,save_df=False):
@@ -189,7 +366,7 @@ def get_group_keys(df,save_df=False):
                     'item':[], 
                     'unit':[]
                     }
-    grouped = list(df.groupby(['model', 'scenario', 'region', 'variable', 'item', 'unit']).groups.keys())
+    grouped = list(df.groupby(['model', 'scenario', 'region', 'variable', 'item', 'unit'], observed=True).groups.keys())
     for model,scenario,region,variable,item,unit in grouped:
         grouped_dict['model'].append(model)
         grouped_dict['scenario'].append(scenario)
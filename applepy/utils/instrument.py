@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import threading
+import logging
+import functools
+import multiprocessing
+import psutil
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import contextmanager
+
+# reports that stages are recorded in, innermost last, one stack per thread (see RunReport.activate)
+_active = threading.local()
+
+def _active_reports():
+    if not hasattr(_active, 'reports'):
+        _active.reports = []
+    return _active.reports
+
+# logger of applepy, and the queues of the log files it writes to, innermost last (see log_to_file)
+logger = logging.getLogger('applepy')
+_log_queues = []
+
+class PeakMemory:
+    """
+    Samples the resident memory of the process in a thread, to get the peak memory of a block of code (including the
+    memory allocated by Arrow and polars, that tracemalloc does not see).
+
+    Attributes
+    ----------
+    start (int): Resident memory (bytes) when the block started.
+    peak (int): Largest resident memory (bytes) seen while the block ran.
+    used (int): Memory (bytes) used by the block on top of what was already allocated, set when the block ends.
+
+    Examples
+    --------
+    >>> with PeakMemory() as memory:
+    ...     df = pc_diff_interp(df, save=False)
+    >>> memory.used/2**20
+    """
+    def __init__(self, interval=0.005, callback=None, callback_interval=None):
+        # callback(peak_memory) is called every callback_interval seconds while the block runs
+        self.interval = interval
+        self.callback = callback
+        self.callback_interval = callback_interval
+        self.process = psutil.Process()
+
+    def __enter__(self):
+        self.start = self.process.memory_info().rss
+        self.peak = self.start
+        self.used = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        last_callback = time.perf_counter()
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            if (self.callback != None) and (time.perf_counter()-last_callback >= self.callback_interval):
+                last_callback = time.perf_counter()
+                self.callback(self.peak)
+            self._stop.wait(self.interval)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+        self.used = self.peak-self.start
+
+class StageRecord:
+    """
+    Measurements of one stage of a run, filled by `RunReport.stage`.
+
+    Attributes
+    ----------
+    name (str): Stage name.
+    parent (str or None): Stage this stage ran in, if any.
+    rows_in (int or None): Rows of the input.
+    rows_out (int or None): Rows of the output.
+    rows_done (int): Rows processed so far, for the live throughput (see `progress`).
+    dropped (dict): Rows dropped, or set aside, by reason.
+    wall_time (float): Wall time (s).
+    cpu_time (float): CPU time (s) of the process, all threads.
+    peak_memory (int): Peak memory (bytes) on top of the memory in use when the stage started.
+    status (str): 'running', 'done' or 'failed'.
+    """
+    def __init__(self, name, rows_in=None, parent=None):
+        self.name = name
+        self.parent = parent
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.rows_done = 0
+        self.dropped = {}
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_memory = None
+        self.status = 'running'
+        self.error = None
+
+    def drop(self, reason, rows):
+        """
+        Records rows dropped (or set aside) by the stage for a reason, e.g. `record.drop('conflicting_duplicate', 12)`.
+        """
+        self.dropped[reason] = self.dropped.get(reason, 0)+int(rows)
+
+    def progress(self, rows):
+        """
+        Records rows processed, for the live throughput of a stage that works in chunks or groups.
+        """
+        self.rows_done += int(rows)
+
+    def to_dict(self):
+        wall_time = self.wall_time
+        return {'stage':self.name,
+                'parent':self.parent,
+                'status':self.status,
+                'rows_in':self.rows_in,
+                'rows_out':self.rows_out,
+                'dropped':dict(self.dropped),
+                'wall_time':wall_time,
+                'cpu_time':self.cpu_time,
+                'rows_per_sec':(self.rows_in/wall_time) if (self.rows_in != None) and wall_time else None,
+                'peak_memory_mb':None if self.peak_memory == None else self.peak_memory/2**20,
+                'error':self.error
+                }
+
+class RunReport:
+    """
+    Per-stage measurements of the processing of one submission: wall time, CPU time, peak memory, rows in and out,
+    and rows dropped by reason (see `stage`).
+
+    While a stage runs, its throughput is printed every `live_interval` seconds, so that the log of a pool worker
+    (see `el2_pipeline_silent`) shows which stage of which submission is running, and how fast.
+
+    Parameters
+    ----------
+    submission (str): Name of the submission (e.g. the model or the file name).
+    live_interval (float or None, optional): Seconds between two live throughput lines. If None, nothing is printed
+        while a stage runs. Defaults to 10.
+    stream (file or None, optional): Stream of the live lines. If None, the current sys.stdout. Defaults to None.
+
+    Examples
+    --------
+    >>> report = RunReport('GLOBIOM')
+    >>> with report.stage('duplicates', rows_in=len(df)) as record:
+    ...     clean_df, duplicates_df = check_duplicates(df)
+    ...     record.rows_out = len(clean_df)
+    ...     record.drop('conflicting_duplicate', len(duplicates_df))
+    >>> report.save('GLOBIOM_report.json')
+    """
+    def __init__(self, submission, live_interval=10, stream=None):
+        self.submission = submission
+        self.live_interval = live_interval
+        self.stream = stream
+        self.stages = []
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.info = {}
+        self._open = []
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Records a stage: the block is timed and its peak memory sampled. The yielded StageRecord is filled by the
+        block (rows_out, `drop`, `progress`). A stage opened inside another one is recorded with it as parent.
+
+        Parameters
+        ----------
+        name (str): Stage name.
+        rows_in (int or None, optional): Rows of the input. Defaults to None.
+
+        Yields
+        ------
+        StageRecord
+        """
+        record = StageRecord(name, rows_in, self._open[-1].name if self._open else None)
+        self.stages.append(record)
+        self._open.append(record)
+        stream = self.stream if self.stream != None else sys.stdout
+        start, start_cpu = time.perf_counter(), time.process_time()
+
+        def live(peak):
+            elapsed = time.perf_counter()-start
+            rows = record.rows_done if record.rows_done > 0 else None
+            rate = f", {rows} rows ({rows/elapsed:.0f} rows/s)" if rows != None else (f", {record.rows_in} rows in" if record.rows_in != None else "")
+            print(f"[{self.submission}] {name}: running for {elapsed:.0f} s{rate}, peak memory {peak/2**20:.0f} MiB", file=stream, flush=True)
+
+        memory = PeakMemory(interval=0.02, callback=None if self.live_interval == None else live, callback_interval=self.live_interval)
+        try:
+            with memory:
+                yield record
+            record.status = 'done'
+        except BaseException as e:
+            record.status = 'failed'
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.wall_time = time.perf_counter()-start
+            record.cpu_time = time.process_time()-start_cpu
+            record.peak_memory = memory.used if memory.used != None else max(0, memory.peak-memory.start)
+            self._open.pop()
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, *exc):
+        self.deactivate()
+
+    def activate(self):
+        """
+        Makes this report the one that the `instrumented` functions record their stages in (in this thread of this
+        process), until `deactivate`. Can also be used as `with report:`.
+        """
+        _active_reports().append(self)
+        return self
+
+    def deactivate(self):
+        if self in _active_reports():
+            _active_reports().remove(self)
+
+    def to_dict(self):
+        """
+        Gets the report as a JSON-serializable dict: the submission, the process, the start time, the total wall and
+        CPU time of the top-level stages, the extra `info`, and the stages in the order they ran.
+        """
+        top = [record for record in self.stages if record.parent == None]
+        return {'submission':self.submission,
+                'pid':self.pid,
+                'started':time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'wall_time':sum([record.wall_time or 0 for record in top]),
+                'cpu_time':sum([record.cpu_time or 0 for record in top]),
+                'peak_memory_mb':max([record.peak_memory for record in top if record.peak_memory != None], default=0)/2**20,
+                'info':dict(self.info),
+                'stages':[record.to_dict() for record in self.stages]
+                }
+
+    def summary(self):
+        """
+        Gets the stages as a DataFrame, one row per stage.
+        """
+        import pandas as pd
+        return pd.DataFrame(self.to_dict()['stages'])
+
+    def save(self, fp):
+        """
+        Saves the report as JSON.
+
+        Returns
+        -------
+        str: fp
+        """
+        return save_report(self.to_dict(), fp)
+
+def active_report():
+    """
+    Gets the report that stages are recorded in (see `RunReport.activate`), or None.
+    """
+    reports = _active_reports()
+    return reports[-1] if reports else None
+
+@contextmanager
+def timed_stage(name, rows_in=None, report=None):
+    """
+    Records a stage in a report, or in the active report (see `RunReport.activate`). Without a report, the block runs
+    without being measured and a StageRecord is still yielded, so that instrumented code runs the same way.
+
+    Parameters
+    ----------
+    name (str): Stage name.
+    rows_in (int or None, optional): Rows of the input. Defaults to None.
+    report (RunReport or None, optional): Report. If None, the active report. Defaults to None.
+
+    Yields
+    ------
+    StageRecord
+    """
+    report = active_report() if report == None else report
+    if report == None:
+        yield StageRecord(name, rows_in)
+        return
+    with report.stage(name, rows_in) as record:
+        yield record
+
+def instrumented(name=None):
+    """
+    Decorator recording each call of a function as a stage of the active report (see `RunReport.activate`), with the
+    length of its first argument as rows in and the length of its output (or of the first element of a tuple
+    output) as rows out. Without an active report, the function runs as is.
+
+    Parameters
+    ----------
+    name (str or None, optional): Stage name. If None, the function name. Defaults to None.
+    """
+    def decorator(fn):
+        stage_name = fn.__name__ if name == None else name
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            report = active_report()
+            if report == None:
+                return fn(*args, **kwargs)
+            rows_in = len(args[0]) if args and hasattr(args[0], '__len__') and not isinstance(args[0], str) else None
+            with report.stage(stage_name, rows_in) as record:
+                result = fn(*args, **kwargs)
+                output = result[0] if isinstance(result, tuple) and result else result
+                if hasattr(output, '__len__') and not isinstance(output, str):
+                    record.rows_out = len(output)
+            return result
+        return wrapper
+    return decorator
+
+def aggregate_reports(reports):
+    """
+    Aggregates the reports of several submissions (e.g. of the workers of `el2_pipeline_multiprocess`) by stage.
+
+    Parameters
+    ----------
+    reports (list of dict): Reports, see `RunReport.to_dict`.
+
+    Returns
+    -------
+    dict: 'submissions' (number of reports), 'wall_time' and 'cpu_time' (sums over the submissions), 'stages' (for
+    each top-level stage: the sums of the wall time, CPU time, rows in and out, and rows dropped by reason, the
+    throughput, the largest peak memory, and the slowest submission), and 'slowest' (the submissions by wall time).
+    """
+    stages = {}
+    for report in reports:
+        for record in report['stages']:
+            if record['parent'] != None:
+                continue
+            total = stages.setdefault(record['stage'], {'submissions':0, 'failed':0, 'wall_time':0.0, 'cpu_time':0.0,
+                                                        'rows_in':0, 'rows_out':0, 'dropped':{}, 'peak_memory_mb':0.0,
+                                                        'slowest_submission':None, 'slowest_wall_time':0.0})
+            total['submissions'] += 1
+            total['failed'] += int(record['status'] == 'failed')
+            total['wall_time'] += record['wall_time'] or 0
+            total['cpu_time'] += record['cpu_time'] or 0
+            total['rows_in'] += record['rows_in'] or 0
+            total['rows_out'] += record['rows_out'] or 0
+            for reason, rows in record['dropped'].items():
+                total['dropped'][reason] = total['dropped'].get(reason, 0)+rows
+            total['peak_memory_mb'] = max(total['peak_memory_mb'], record['peak_memory_mb'] or 0)
+            if (record['wall_time'] or 0) > total['slowest_wall_time']:
+                total['slowest_submission'] = report['submission']
+                total['slowest_wall_time'] = record['wall_time']
+    for total in stages.values():
+        total['rows_per_sec'] = total['rows_in']/total['wall_time'] if total['wall_time'] > 0 else None
+    return {'submissions':len(reports),
+            'wall_time':sum([report['wall_time'] for report in reports]),
+            'cpu_time':sum([report['cpu_time'] for report in reports]),
+            'stages':stages,
+            'slowest':[{'submission':report['submission'], 'wall_time':report['wall_time'], 'peak_memory_mb':report['peak_memory_mb']}
+                       for report in sorted(reports, key=lambda x: x['wall_time'], reverse=True)]
+            }
+
+def save_report(report, fp):
+    """
+    Saves a report (or an aggregated report) as JSON, through a temporary file so that a reader never sees a partial file.
+
+    Returns
+    -------
+    str: fp
+    """
+    tmp_fp = f"{fp}.{os.getpid()}.tmp"
+    with open(tmp_fp, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    os.replace(tmp_fp, fp)
+    return fp
+
+@contextmanager
+def log_to_file(fp, level=logging.DEBUG):
+    """
+    Writes the records of the applepy logger to a file for the duration of a block.
+
+    The records go through a process-safe queue to a listener thread that owns the file, so that the workers of a
+    pool started in the block (with `init_log_worker` as initializer, see `log_queue`) write to the same file without
+    interleaving. Unlike `logging.basicConfig`, every call opens its own file, also in a long-lived worker process.
+
+    Parameters
+    ----------
+    fp (str): Log file.
+    level (int, optional): Level of the records written. Defaults to logging.DEBUG.
+
+    Yields
+    ------
+    multiprocessing.Queue: Queue of the log file.
+    """
+    queue = multiprocessing.Queue(-1)
+    handler = logging.FileHandler(fp, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s, %(processName)s, %(levelname)s, %(message)s', '%y%m%d-%H%M%S'))
+    listener = QueueListener(queue, handler)
+    queue_handler = QueueHandler(queue)
+    previous_level = logger.level
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    listener.start()
+    _log_queues.append(queue)
+    try:
+        yield queue
+    finally:
+        _log_queues.remove(queue)
+        logger.removeHandler(queue_handler)
+        logger.setLevel(previous_level)
+        listener.stop()
+        handler.close()
+        queue.close()
+
+def log_queue():
+    """
+    Gets the queue of the innermost `log_to_file` block, or None, to pass to the workers of a pool (see `init_log_worker`).
+    """
+    return _log_queues[-1] if _log_queues else None
+
+def init_log_worker(queue):
+    """
+    Pool initializer that sends the records of the applepy logger of a worker process to the queue of a `log_to_file`
+    block of the parent process, instead of the handlers inherited from it.
+
+    Parameters
+    ----------
+    queue (multiprocessing.Queue or None): Queue (see `log_queue`). If None, the records of the worker are discarded.
+
+    Returns
+    -------
+    None
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if queue != None:
+        logger.addHandler(QueueHandler(queue))
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.addHandler(logging.NullHandler())
@@ -0,0 +1,342 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from .helper import *
+from .storage import *
+
+# backends of the processing functions: 'pandas' (eager DataFrames), or 'polars' (lazy query plans of this module,
+# optimized and run multi-threaded by polars when collected)
+BACKENDS = ['pandas','polars']
+
+# column carrying the index of the pandas DataFrames through the lazy plans, so that the polars backend gives back
+# the same index as the pandas backend
+INDEX_COL = '_index'
+
+def to_lazy(df):
+    """
+    Converts an AgMIP DataFrame to a polars LazyFrame.
+
+    The dimensions become strings (the categoricals of the AgMIP schema are not kept, so that frames from different
+    sources can be joined), and the index is kept in the INDEX_COL column.
+
+    Parameters
+    ----------
+    df (pd.DataFrame, pl.DataFrame or pl.LazyFrame): Data. A polars frame is returned as a LazyFrame, as is.
+
+    Returns
+    -------
+    pl.LazyFrame
+    """
+    if isinstance(df, pl.LazyFrame):
+        return df
+    if isinstance(df, pl.DataFrame):
+        return df.lazy()
+    df = df.assign(**{INDEX_COL:df.index.to_numpy()})
+    # from_pandas cannot convert object columns of mixed types
+    df = df.astype({col:object for col in DIMENSION_COLS if col in df.columns})
+    lf = pl.from_pandas(df).lazy()
+    return lf.with_columns([pl.col(col).cast(pl.String) for col in DIMENSION_COLS if col in df.columns])
+
+def from_lazy(frame, schema=True):
+    """
+    Collects a LazyFrame (if needed) and converts it to a pandas DataFrame.
+
+    Parameters
+    ----------
+    frame (pl.LazyFrame or pl.DataFrame): Result of a lazy plan.
+    schema (bool, optional): If True, the AgMIP schema is applied (see `apply_agmip_schema`), otherwise the
+        dimensions are strings. Defaults to True.
+
+    Returns
+    -------
+    pd.DataFrame: The data, indexed by the INDEX_COL column if it is present.
+    """
+    if isinstance(frame, pl.LazyFrame):
+        frame = frame.collect()
+    df = frame.to_pandas()
+    if INDEX_COL in df.columns:
+        df = df.set_index(INDEX_COL)
+        df.index.name = None
+    for col in DIMENSION_COLS:
+        if (col in df.columns) and (df[col].dtype == object):
+            # polars nulls are None, pandas uses NaN
+            df[col] = df[col].where(df[col].notna(), np.nan)
+    if schema:
+        value_dtype = str(df.value.dtype) if ('value' in df.columns) and (str(df.value.dtype) in VALUE_DTYPES) else 'float64'
+        df = apply_agmip_schema(df, value_dtype=value_dtype)
+    return df
+
+def is_agmip_schema(df):
+    """
+    Checks whether a pandas DataFrame has the categorical dimensions of the AgMIP schema, so that the polars backend
+    returns the same dtypes as its input.
+    """
+    return any([isinstance(df[col].dtype, pd.CategoricalDtype) for col in DIMENSION_COLS if col in df.columns])
+
+def scan_agmip_csv(fp):
+    """
+    Scans a raw AgMIP submission as a LazyFrame, with the layout detected by `sniff_agmip_csv`.
+
+    The dimensions are read as strings and 'year' and 'value' as float64, and the INDEX_COL column is the row number
+    (as in `AgMIP_read_raw_csv`).
+
+    Parameters
+    ----------
+    fp (str): Path of the raw CSV file.
+
+    Returns
+    -------
+    pl.LazyFrame
+    """
+    layout = sniff_agmip_csv(fp)
+    schema = {col:(pl.Float64 if col in ['year','value'] else pl.String) for col in layout['columns']}
+    lf = pl.scan_csv(fp,
+                     separator=layout['delimiter'],
+                     has_header=layout['header'],
+                     new_columns=layout['columns'] if not layout['header'] else None,
+                     schema=schema,
+                     null_values=CSV_NA_VALUES)
+    return lf.select(AGMIP_COLS).with_row_index(INDEX_COL).with_columns(pl.col(INDEX_COL).cast(pl.Int64))
+
+def lazy_duplicates(lf):
+    """
+    Plans the duplicates check of `check_duplicates`.
+
+    Parameters
+    ----------
+    lf (pl.LazyFrame): AgMIP data.
+
+    Returns
+    -------
+    clean (pl.LazyFrame): Entries without duplicates (exact duplicates are kept once).
+    duplicates (pl.LazyFrame): Entries with conflicting values.
+    """
+    keys = ['model','scenario','region','variable','item','unit','year']
+    lf = lf.unique(subset=keys+['value'], keep='first', maintain_order=True)
+    duplicated = pl.len().over(keys)>1
+    return lf.filter(~duplicated), lf.filter(duplicated)
+
+def lazy_overrides(lf, compiled):
+    """
+    Plans the overrides check of `check_overrides`.
+
+    Parameters
+    ----------
+    lf (pl.LazyFrame): AgMIP data.
+    compiled (dict): Compiled overrides, see `compile_overrides`.
+
+    Returns
+    -------
+    clean (pl.LazyFrame): Entries that are not overridden, with the replacements applied.
+    dropped (pl.LazyFrame): Entries removed by a False status.
+    kept (pl.LazyFrame): Entries set aside by a True status.
+    """
+    schema = lf.collect_schema()
+
+    def labels(values, column):
+        # labels of the column dtype (e.g. the years), labels that cannot be converted never match
+        return pl.Series(list(values)).cast(schema[column], strict=False).drop_nulls()
+
+    drop = pl.lit(False)
+    keep = pl.lit(False)
+    replaced = []
+    for column, overrides in compiled.items():
+        if overrides['drop']:
+            drop = drop | pl.col(column).is_in(labels(overrides['drop'], column).implode()).fill_null(False)
+        if overrides['keep']:
+            keep = keep | pl.col(column).is_in(labels(overrides['keep'], column).implode()).fill_null(False)
+        if overrides['replace']:
+            old = labels(overrides['replace'].keys(), column)
+            new = labels(overrides['replace'].values(), column)
+            if len(old)==len(new):
+                replaced.append(pl.col(column).replace(old, new))
+
+    lf = lf.with_columns(_drop=drop, _keep=keep & ~drop)
+    if replaced:
+        lf = lf.with_columns(replaced)
+    clean = lf.filter(~pl.col('_drop') & ~pl.col('_keep')).drop(['_drop','_keep'])
+    dropped = lf.filter(pl.col('_drop')).drop(['_drop','_keep'])
+    kept = lf.filter(pl.col('_keep')).drop(['_drop','_keep'])
+    return clean, dropped, kept
+
+def lazy_template(lf, template_fp):
+    """
+    Plans the template check of `check_template`: variables missing from the VariableUnitValueTable are dropped, and
+    the entries of a known variable with an unexpected unit are exceptions.
+
+    Parameters
+    ----------
+    lf (pl.LazyFrame): AgMIP data.
+    template_fp (str or CompiledTemplate): RuleTables workbook.
+
+    Returns
+    -------
+    clean (pl.LazyFrame): Entries whose (variable, unit) pair is in the template.
+    exceptions (pl.LazyFrame): Entries of a template variable with a unit that is not in the template.
+    """
+    template = load_template(template_fp)
+    VariableUnitValueTable = template.tables['VariableUnitValueTable'].dropna(subset=['Variable','Unit'])
+    variables = pl.Series(pd.unique(VariableUnitValueTable.Variable.astype(str)), dtype=pl.String)
+    pairs = pl.Series(pd.unique(VariableUnitValueTable.Variable.astype(str)+'\x1f'+VariableUnitValueTable.Unit.astype(str)), dtype=pl.String)
+
+    variable_found = pl.col('variable').is_in(variables.implode()).fill_null(False)
+    pair_found = pl.concat_str([pl.col('variable'), pl.col('unit')], separator='\x1f').is_in(pairs.implode()).fill_null(False)
+    return lf.filter(variable_found & pair_found), lf.filter(variable_found & ~pair_found)
+
+def lazy_pc_diff(lf, base_year=2020):
+    """
+    Plans the percent change and differences columns of `pc_diff_frame`.
+
+    Groups that do not report `base_year` get an interpolated base-year row for each scenario, from the nearest years
+    below and above (as `interp_base_year`). If a scenario of the group cannot be interpolated, the group is kept with
+    empty percent change and difference columns. The BAU base-year, BAU same-year and ELM same-year references are
+    joined by key, and references that are missing or match more than one row are left empty.
+
+    The rows are in the order of `pc_diff_frame` (by group, interpolated rows at the end of their group), with the same
+    index in the INDEX_COL column (the index of the interpolated groups is reset).
+
+    Parameters
+    ----------
+    lf (pl.LazyFrame): AgMIP data.
+    base_year (int, optional): The base year for calculating percent changes and differences. Defaults to 2020.
+
+    Returns
+    -------
+    pl.LazyFrame: `lf` with the columns 'BAU_ref_year', 'percent_change_BAU_ref_year', 'diff_BAU_ref_year',
+    'percent_change_BAU', 'diff_BAU', 'percent_change_ELM', 'diff_ELM' added.
+    """
+    group_cols = ['model','variable','item','region','unit']
+    schema = lf.collect_schema()
+    columns = list(schema.names())
+    if INDEX_COL not in columns:
+        lf = lf.with_row_index(INDEX_COL).with_columns(pl.col(INDEX_COL).cast(pl.Int64))
+        columns.append(INDEX_COL)
+    lf = lf.filter(pl.all_horizontal([pl.col(col).is_not_null() for col in group_cols]))
+    lf = lf.with_row_index('_order').with_columns(_interp=pl.lit(False))
+
+    # base-year interpolation of the groups that do not report base_year
+    has_base_year = (pl.col('year')==base_year).fill_null(False).any().over(group_cols)
+    year = pl.col('year').cast(pl.Float64)
+    below = pl.col('year')<base_year
+    above = pl.col('year')>base_year
+    interp = (lf.filter(~has_base_year)
+                .group_by(group_cols+['scenario'])
+                .agg(_first=pl.col('_order').min(),
+                     _x0=year.filter(below).max(),
+                     _x1=year.filter(above).min(),
+                     _y0=pl.col('value').filter(year==year.filter(below).max()).first(),
+                     _y1=pl.col('value').filter(year==year.filter(above).min()).first(),
+                     _null_year=pl.col('year').is_null().any()))
+    ok = pl.col('_x0').is_not_null() & pl.col('_x1').is_not_null() & ~pl.col('_null_year') & pl.col('scenario').is_not_null()
+    interp = interp.with_columns(_failed=(~ok).any().over(group_cols))
+    failed = interp.filter(pl.col('_failed')).select(group_cols).unique()
+    interp = (interp.filter(~pl.col('_failed'))
+                    # same arithmetic as np.interp
+                    .with_columns(value=(pl.col('_y1')-pl.col('_y0'))/(pl.col('_x1')-pl.col('_x0'))*(base_year-pl.col('_x0'))+pl.col('_y0'),
+                                  year=pl.lit(base_year).cast(schema['year']),
+                                  _order=pl.col('_first'),
+                                  _interp=pl.lit(True))
+                    .select(group_cols+['scenario','year','value','_order','_interp']))
+
+    df_pc = pl.concat([lf, interp], how='diagonal_relaxed')
+    df_pc = df_pc.join(failed.with_columns(_valid=pl.lit(False)), on=group_cols, how='left')
+    df_pc = df_pc.sort(group_cols+['_interp','_order'])
+
+    # interpolated groups get a fresh index, as if concatenated with ignore_index=True
+    df_pc = df_pc.with_columns(pl.when(pl.col('_interp').any().over(group_cols))
+                                 .then(pl.int_range(pl.len()).over(group_cols))
+                                 .otherwise(pl.col(INDEX_COL))
+                                 .cast(pl.Int64)
+                                 .alias(INDEX_COL))
+    valid = pl.col('_valid').is_null() & pl.col('scenario').is_not_null() & pl.col('year').is_not_null()
+
+    def reference(mask, keys, name):
+        ref = (df_pc.filter(mask)
+                    .group_by(keys)
+                    .agg(pl.col('value').first().alias(name), pl.len().alias('_n'))
+                    .filter(pl.col('_n')==1)
+                    .drop('_n'))
+        return ref
+
+    df_pc = df_pc.join(reference((pl.col('scenario')=='BAU') & (pl.col('year')==base_year), group_cols, '_ref_base'), on=group_cols, how='left', maintain_order='left')
+    df_pc = df_pc.join(reference(pl.col('scenario')=='BAU', group_cols+['year'], '_ref_BAU'), on=group_cols+['year'], how='left', maintain_order='left')
+    df_pc = df_pc.join(reference(pl.col('scenario')=='ELM', group_cols+['year'], '_ref_ELM'), on=group_cols+['year'], how='left', maintain_order='left')
+
+    val = pl.col('value')
+    refs = {name:pl.when(valid).then(pl.col('_ref_'+name).fill_nan(None)) for name in ['base','BAU','ELM']}
+    df_pc = df_pc.with_columns(BAU_ref_year=pl.when(refs['base'].is_not_null()).then(pl.lit(float(base_year))).otherwise(pl.lit(None, dtype=pl.Float64)),
+                               percent_change_BAU_ref_year=(val-refs['base'])/refs['base']*100,
+                               diff_BAU_ref_year=val-refs['base'],
+                               percent_change_BAU=(val-refs['BAU'])/refs['BAU']*100,
+                               diff_BAU=val-refs['BAU'],
+                               percent_change_ELM=(val-refs['ELM'])/refs['ELM']*100,
+                               diff_ELM=val-refs['ELM'])
+    pc_cols = ['BAU_ref_year','percent_change_BAU_ref_year','diff_BAU_ref_year','percent_change_BAU','diff_BAU','percent_change_ELM','diff_ELM']
+    return df_pc.select(columns+pc_cols)
+
+def lazy_decompose(lf, drivers=None, value_types=None):
+    """
+    Plans the decomposition of `decompose_all` (wide format).
+
+    The scenarios are pivoted with one conditional aggregation per (value type, scenario), and the effects of every
+    driver, value type and normalization are computed as column expressions of the same plan.
+
+    Parameters
+    ----------
+    lf (pl.LazyFrame): pc-diff data.
+    drivers (list of str or None, optional): Drivers to decompose. If None, ['DIET','PROD','MITI','WAST']. Defaults to None.
+    value_types (list of str or None, optional): Columns to decompose. If None, ['value','percent_change_BAU','percent_change_BAU_ref_year']. Defaults to None.
+
+    Returns
+    -------
+    pl.LazyFrame: One row per group, driver, value type and normalization, with the columns of `decompose_all`.
+    """
+    drivers = ['DIET','PROD','MITI','WAST'] if drivers == None else list(drivers)
+    value_types = ['value','percent_change_BAU','percent_change_BAU_ref_year'] if value_types == None else list(value_types)
+    group_cols = ['model','region','variable','item','unit','year']
+    scenarios = list(dict.fromkeys(['BAU','ELM','ELM_MITI']+[prefix+driver for driver in drivers for prefix in ['BAU_','ELM_']]))
+    lf = lf.filter(pl.all_horizontal([pl.col(col).is_not_null() for col in group_cols]))
+    lf = lf.unique(subset=group_cols+['scenario'], keep='first', maintain_order=True)
+    wide = (lf.group_by(group_cols)
+              .agg([pl.col(value).filter(pl.col('scenario')==scenario).first().cast(pl.Float64).alias(f"{value}|{scenario}")
+                    for value in value_types for scenario in scenarios])
+              .sort(group_cols)
+              .with_row_index('_group'))
+
+    parts = []
+    for driver in drivers:
+        for value in value_types:
+            baseline = pl.col(f"{value}|BAU")
+            full = pl.col(f"{value}|ELM")
+            driver_only = pl.col(f"{value}|BAU_{driver}")
+            all_but_driver = pl.col(f"{value}|ELM_{driver}")
+            for normalized in [True,False]:
+                individual = driver_only-baseline
+                total = full-all_but_driver
+                if normalized:
+                    individual = individual/(full-baseline)
+                    total = total/(full-baseline)
+                interaction = total-individual
+                parts.append(wide.select(pl.col('_group'),
+                                         pl.lit(len(parts)).alias('_part'),
+                                         individual.alias('individual'),
+                                         total.alias('total'),
+                                         interaction.alias('interaction'),
+                                         *group_cols,
+                                         pl.lit(driver).alias('driver'),
+                                         pl.lit(normalized).alias('normalized'),
+                                         pl.lit(value).alias('value_type'),
+                                         full.alias('ELM'),
+                                         baseline.alias('BAU'),
+                                         pl.col(f"{value}|ELM_MITI").alias('EL2'),
+                                         all_but_driver.alias('ELM_driver'),
+                                         driver_only.alias('BAU_driver'),
+                                         ((individual-baseline)/baseline*100).alias('percent_change_BAU_individual'),
+                                         ((total-baseline)/baseline*100).alias('percent_change_BAU_total'),
+                                         ((interaction-baseline)/baseline*100).alias('percent_change_BAU_interaction')))
+
+    cols = ['individual','total','interaction','model','region','variable','item','year','unit','driver','normalized','value_type',
+            'ELM','BAU','EL2','ELM_driver','BAU_driver',
+            'percent_change_BAU_individual','percent_change_BAU_total','percent_change_BAU_interaction']
+    return pl.concat(parts).sort(['_group','_part']).select(cols)
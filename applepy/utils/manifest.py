@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import hashlib
+import pandas as pd
+
+from .. import __version__
+
+# name of the run manifest, saved in the data directory of el2_pipeline_multiprocess
+MANIFEST_FN = 'manifest.json'
+
+def file_hash(fp, chunk_size=1<<20):
+    """
+    Computes the content hash of a file.
+
+    Parameters
+    ----------
+    fp (str or None): File path. A missing file (or None) hashes to None.
+    chunk_size (int, optional): Number of bytes read at a time. Defaults to 1 MiB.
+
+    Returns
+    -------
+    str or None: SHA-256 hex digest of the file content.
+    """
+    if (fp == None) or not os.path.exists(fp):
+        return None
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def frame_hash(df):
+    """
+    Computes the content hash of a DataFrame (values, column names, and index).
+
+    Parameters
+    ----------
+    df (pd.DataFrame): DataFrame to hash.
+
+    Returns
+    -------
+    str: SHA-256 hex digest.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([str(col) for col in df.columns]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+def combine_hashes(*parts):
+    """
+    Combines hashes (or any values with a string representation) into a single key.
+
+    Returns
+    -------
+    str: SHA-256 hex digest of the parts.
+    """
+    return hashlib.sha256('|'.join([str(part) for part in parts]).encode()).hexdigest()
+
+class RunManifest:
+    """
+    Records what el2_pipeline_multiprocess produced for each submission of a data directory, so that a rerun (or an
+    interrupted batch) only processes the submissions whose inputs changed.
+
+    For each submission, the manifest stores the content hashes of the raw submission, its '_OVERRIDES_fix.csv' file,
+    the template workbook, and the applepy version, along with a key and the output files of each stage. The manifest is
+    saved as JSON (`MANIFEST_FN` in the data directory) after each submission is done, and written atomically.
+
+    Parameters
+    ----------
+    manifest_fp (str): Path of the manifest file. It is loaded if it exists.
+    """
+    def __init__(self, manifest_fp):
+        self.manifest_fp = manifest_fp
+        self.submissions = {}
+        if os.path.exists(manifest_fp):
+            with open(manifest_fp) as f:
+                self.submissions = json.load(f).get('submissions', {})
+
+    def save(self):
+        """
+        Saves the manifest, writing to a temporary file first so that an interrupted run never leaves a partial manifest.
+        """
+        tmp_fp = f"{self.manifest_fp}.{os.getpid()}.tmp"
+        with open(tmp_fp, 'w') as f:
+            json.dump({'applepy_version':__version__, 'submissions':self.submissions}, f, indent=1)
+        os.replace(tmp_fp, self.manifest_fp)
+
+    def submission_inputs(self, fp, template_fp, file_format='csv', overrides_fp=None):
+        """
+        Hashes the inputs of a submission.
+
+        Parameters
+        ----------
+        fp (str): Path of the raw submission.
+        template_fp (str): Path of the template workbook.
+        file_format (str, optional): Storage format of the stage outputs. Defaults to 'csv'.
+        overrides_fp (str or None, optional): Overrides file. If None, '<fp>_OVERRIDES_fix.csv'. Defaults to None.
+
+        Returns
+        -------
+        dict: Hashes of the inputs, and their combined 'key'.
+        """
+        if overrides_fp == None:
+            overrides_fp = fp.split('.csv')[0]+'_OVERRIDES_fix.csv'
+        inputs = {'input':file_hash(fp),
+                  'overrides':file_hash(overrides_fp),
+                  'template':file_hash(template_fp),
+                  'applepy_version':__version__,
+                  'file_format':file_format
+                  }
+        inputs['key'] = combine_hashes(*inputs.values())
+        return inputs
+
+    def entry(self, name):
+        """
+        Gets the manifest entry of a submission (an empty one if the submission was never processed).
+        """
+        return self.submissions.get(name, {'inputs':{}, 'stages':{}, 'status':None})
+
+    def is_done(self, name, inputs, data_dir):
+        """
+        Checks whether a submission was fully processed with the same inputs, and its outputs still exist.
+
+        Parameters
+        ----------
+        name (str): File name of the submission.
+        inputs (dict): Input hashes, see `submission_inputs`.
+        data_dir (str): Data directory; stage outputs are recorded relative to it.
+
+        Returns
+        -------
+        bool
+        """
+        entry = self.entry(name)
+        if (entry['status'] != 'done') or (entry['inputs'].get('key') != inputs['key']):
+            return False
+        return all([os.path.exists(os.path.join(data_dir, output)) for stage in entry['stages'].values() for output in stage['outputs']])
+
+    def update(self, name, entry):
+        """
+        Replaces the manifest entry of a submission and saves the manifest.
+        """
+        entry['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.submissions[name] = entry
+        self.save()
+
+def reuse_stage(entry, stage, key, data_dir):
+    """
+    Gets the recorded outputs of a stage if they were produced from the same inputs and still exist.
+
+    Parameters
+    ----------
+    entry (dict or None): Manifest entry of the submission, see RunManifest.
+    stage (str): Stage name (e.g. 'pc-diff').
+    key (str): Key of the current inputs of the stage.
+    data_dir (str): Data directory; stage outputs are recorded relative to it.
+
+    Returns
+    -------
+    list or None: Absolute paths of the outputs, or None if the stage has to be run.
+    """
+    if entry == None:
+        return None
+    record = entry['stages'].get(stage)
+    if (record == None) or (record['key'] != key):
+        return None
+    outputs = [os.path.join(data_dir, output) for output in record['outputs']]
+    if not all([os.path.exists(output) for output in outputs]):
+        return None
+    return outputs
+
+def record_stage(entry, stage, key, outputs, data_dir):
+    """
+    Records the key and output files of a stage in a manifest entry.
+
+    Parameters
+    ----------
+    entry (dict or None): Manifest entry of the submission. Nothing is recorded if None.
+    stage (str): Stage name.
+    key (str): Key of the inputs of the stage.
+    outputs (list): Paths of the files written by the stage.
+    data_dir (str): Data directory; outputs are recorded relative to it.
+
+    Returns
+    -------
+    None
+    """
+    if entry == None:
+        return
+    entry['stages'][stage] = {'key':key,
+                              'outputs':[os.path.relpath(output, data_dir) for output in outputs]
+                              }
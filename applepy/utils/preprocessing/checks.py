@@ -1,7 +1,215 @@
+import os
+import tempfile
 import pandas as pd
 import numpy as np
+import polars as pl
+from ..template import *
+from ..storage import *
+from ..lazy import *
 
-def check_duplicates(df, save_df=False):
+# columns identifying an entry, for the duplicates checks
+DUPLICATE_KEY_COLS = ['model','scenario','region','variable','item','unit','year']
+
+# number of hash partitions of the fingerprints spilled to disk by `duplicate_positions`
+DUPLICATE_PARTITIONS = 64
+
+def hashable_column(values):
+    """
+    Normalizes a column before it is hashed or compared, so that equal entries are equal whatever their dtype
+    (e.g. int16, int64 or float64 years, or categoricals with different categories).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype('float64')
+    return values
+
+def fingerprints(df, cols=DUPLICATE_KEY_COLS):
+    """
+    Hashes some columns of each row of a DataFrame to a 64-bit fingerprint.
+
+    Parameters
+    ----------
+    df (pd.DataFrame): AgMIP data.
+    cols (list of str, optional): Columns to hash. Defaults to DUPLICATE_KEY_COLS.
+
+    Returns
+    -------
+    np.ndarray: uint64 fingerprint of each row.
+    """
+    return pd.util.hash_pandas_object(pd.DataFrame({col:hashable_column(df[col]) for col in cols}), index=False).to_numpy()
+
+def _candidate_positions(key, position):
+    """
+    Finds the positions of the rows whose key fingerprint is shared with another row, i.e. the only rows that can be
+    duplicates.
+    """
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    shared = np.zeros(len(order), dtype=bool)
+    shared[1:] = sorted_key[1:] == sorted_key[:-1]
+    shared[:-1] |= shared[1:]
+    return position[order[shared]]
+
+def _exact_duplicates(candidates_df, key_cols, value_col):
+    """
+    Finds the exact and conflicting duplicates among candidate rows by comparing their columns, as `check_duplicates`:
+    the exact duplicates are the rows whose key and value are in an earlier row, the conflicting duplicates are the
+    remaining rows whose key is in another row.
+
+    Parameters
+    ----------
+    candidates_df (pd.DataFrame): Candidate rows in order of position, indexed by their positions.
+
+    Returns
+    -------
+    exact (np.ndarray): Positions of the exact duplicates.
+    conflicting (np.ndarray): Positions of the conflicting duplicates.
+    """
+    first = ~candidates_df.duplicated(subset=key_cols+[value_col])
+    remaining = candidates_df[first]
+    conflicting = remaining.duplicated(subset=key_cols, keep=False)
+    return candidates_df.index[~first].to_numpy(dtype=np.int64), remaining.index[conflicting].to_numpy(dtype=np.int64)
+
+def duplicate_positions(chunks, key_cols=DUPLICATE_KEY_COLS, value_col='value', max_memory=1<<29, spill_dir=None):
+    """
+    Finds the exact and conflicting duplicates of AgMIP data given as a DataFrame or as chunks of rows, by their
+    positions in the data.
+
+    The key of each row is hashed to a 64-bit fingerprint (see `fingerprints`), and only the fingerprints and positions
+    (16 bytes per row) are kept, chunk by chunk. When they take more than `max_memory`, they are hash-partitioned into
+    DUPLICATE_PARTITIONS files of `spill_dir`, and read back partition by partition, so that the memory stays bounded
+    whatever the size of the data. The rows whose fingerprint is shared are only candidates: their key and value
+    columns are then read (again, for chunks) and compared, so that a fingerprint collision never makes a duplicate.
+
+    Parameters
+    ----------
+    chunks (pd.DataFrame, list of pd.DataFrame or callable): Data, chunks of the data, or a function returning an
+        iterator over the chunks (e.g. `lambda: iter_stage(fp)`), which is called twice. A one-shot iterator cannot be used.
+    key_cols (list of str, optional): Columns identifying an entry. Defaults to DUPLICATE_KEY_COLS.
+    value_col (str, optional): Column of the values. Defaults to 'value'.
+    max_memory (int, optional): Memory (bytes) of the fingerprints kept in memory before they are spilled. Defaults to 512 MiB.
+    spill_dir (str or None, optional): Directory of the spilled fingerprints (a temporary directory inside it is used,
+        and deleted at the end). If None, the default temporary directory. Defaults to None.
+
+    Returns
+    -------
+    exact (np.ndarray): Sorted positions of the exact duplicates (a row with the same key and value was seen earlier).
+    conflicting (np.ndarray): Sorted positions of the conflicting duplicates (rows whose key is reported with
+        different values, each value once, i.e. after the exact duplicates are removed).
+    """
+    df = chunks if isinstance(chunks, pd.DataFrame) else None
+    if df is not None:
+        read_chunks = lambda: iter([df])
+    elif callable(chunks):
+        read_chunks = chunks
+    elif iter(chunks) is chunks:
+        raise TypeError("chunks are read twice, give a list of DataFrames or a function returning an iterator over them")
+    else:
+        read_chunks = lambda: iter(chunks)
+
+    buffers = []
+    buffered = 0
+    start = 0
+    tmp_dir = None
+    try:
+        for chunk in read_chunks():
+            buffers.append((fingerprints(chunk, key_cols), np.arange(start, start+len(chunk), dtype=np.int64)))
+            buffered += 16*len(chunk)
+            start += len(chunk)
+            if buffered > max_memory:
+                if tmp_dir == None:
+                    tmp_dir = tempfile.TemporaryDirectory(prefix='applepy-duplicates-', dir=spill_dir)
+                spill_fingerprints(buffers, tmp_dir.name)
+                buffers, buffered = [], 0
+
+        if tmp_dir == None:
+            if len(buffers) == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            candidates = _candidate_positions(*[np.concatenate(x) for x in zip(*buffers)])
+        else:
+            spill_fingerprints(buffers, tmp_dir.name)
+            candidates = np.concatenate([_candidate_positions(*load_fingerprints(tmp_dir.name, partition)) for partition in range(DUPLICATE_PARTITIONS)])
+    finally:
+        if tmp_dir != None:
+            tmp_dir.cleanup()
+    candidates = np.sort(candidates)
+    if len(candidates) == 0:
+        return candidates, candidates
+
+    # the key and value columns of the candidates, compared
+    cols = key_cols+[value_col]
+    if df is not None:
+        parts = [df.iloc[candidates][cols]]
+    else:
+        parts = []
+        start = 0
+        for chunk in read_chunks():
+            positions = candidates[np.searchsorted(candidates, start):np.searchsorted(candidates, start+len(chunk))]
+            parts.append(chunk.iloc[positions-start][cols])
+            start += len(chunk)
+    candidates_df = pd.concat([pd.DataFrame({col:hashable_column(part[col]).astype(object) for col in cols}) for part in parts])
+    candidates_df.index = candidates
+    return _exact_duplicates(candidates_df, key_cols, value_col)
+
+def spill_fingerprints(buffers, spill_dir):
+    """
+    Appends fingerprints (see `duplicate_positions`) to the files of their hash partitions.
+    """
+    if len(buffers) == 0:
+        return
+    key, position = [np.concatenate(x) for x in zip(*buffers)]
+    partition = (key % np.uint64(DUPLICATE_PARTITIONS)).astype(np.int64)
+    order = np.argsort(partition, kind='stable')
+    bounds = np.searchsorted(partition[order], np.arange(DUPLICATE_PARTITIONS+1))
+    for i in range(DUPLICATE_PARTITIONS):
+        part = order[bounds[i]:bounds[i+1]]
+        if len(part) == 0:
+            continue
+        for name, values in [('key',key), ('position',position)]:
+            with open(os.path.join(spill_dir, f'{name}-{i}.bin'), 'ab') as f:
+                values[part].tofile(f)
+
+def load_fingerprints(spill_dir, partition):
+    """
+    Loads the spilled fingerprints of a hash partition.
+
+    Returns
+    -------
+    tuple of np.ndarray: key and position.
+    """
+    arrays = []
+    for name, dtype in [('key',np.uint64), ('position',np.int64)]:
+        fp = os.path.join(spill_dir, f'{name}-{partition}.bin')
+        arrays.append(np.fromfile(fp, dtype=dtype) if os.path.exists(fp) else np.zeros(0, dtype=dtype))
+    return tuple(arrays)
+
+def find_duplicates(source, key_cols=DUPLICATE_KEY_COLS, value_col='value', chunk_rows=1<<20, max_memory=1<<29, spill_dir=None):
+    """
+    Finds the exact and conflicting duplicates of a DataFrame, or of a file scanned in chunks (see `duplicate_positions`).
+
+    Parameters
+    ----------
+    source (pd.DataFrame or str): Data, or a raw submission or stage output (CSV, Parquet or Arrow IPC, see `iter_stage`),
+        which does not need to fit in memory. A file is scanned twice.
+    key_cols (list of str, optional): Columns identifying an entry. Defaults to DUPLICATE_KEY_COLS.
+    value_col (str, optional): Column of the values. Defaults to 'value'.
+    chunk_rows (int, optional): Number of rows read at a time from a file. Defaults to 2**20.
+    max_memory (int, optional): Memory (bytes) of the fingerprints kept in memory before they are spilled. Defaults to 512 MiB.
+    spill_dir (str or None, optional): Directory of the spilled fingerprints. Defaults to None (temporary directory).
+
+    Returns
+    -------
+    exact (pd.Index): Index labels (row positions for a file) of the exact duplicates.
+    conflicting (pd.Index): Index labels (row positions for a file) of the conflicting duplicates.
+    """
+    chunks = source if isinstance(source, pd.DataFrame) else (lambda: iter_stage(source, chunk_rows))
+    exact, conflicting = duplicate_positions(chunks, key_cols, value_col, max_memory, spill_dir)
+    if isinstance(source, pd.DataFrame):
+        return source.index[exact], source.index[conflicting]
+    return pd.Index(exact), pd.Index(conflicting)
+
+def check_duplicates(df, save_df=False, backend='pandas'):
     """
     Check a pandas DataFrame for duplicated entries
 
@@ -11,6 +219,8 @@ def check_duplicates(df, save_df=False):
         DataFrame to check for duplicated entries. Must have columns: 'scenario','region','variable', 'item','unit','year'
     save_df : False or str 
         False, or file path for save file
+    backend : str
+        'pandas' to find candidates with 64-bit fingerprints of the keys and compare their entries (see `duplicate_positions`), or 'polars' to run the check as a lazy polars plan (see `lazy_duplicates`). Default is 'pandas'.
 
     Returns
     -------
@@ -18,13 +228,18 @@ def check_duplicates(df, save_df=False):
         DataFrame with duplicated entries (duplicates are kept)
 
     """
-    # keep only one duplicate if value is the same
-    clean_df = df.drop_duplicates(subset=['model','scenario','region','variable', 'item','unit','year','value'])
-
-    # check remaining duplicates
-    duplicates_idx = clean_df.duplicated(subset=['model','scenario','region','variable', 'item','unit','year'], keep=False)
-    duplicates_df = clean_df[duplicates_idx]
-    clean_df = clean_df[~duplicates_idx]
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    if backend == 'polars':
+        frames = pl.collect_all(list(lazy_duplicates(to_lazy(df))))
+        clean_df, duplicates_df = [from_lazy(frame, is_agmip_schema(df)) for frame in frames]
+    else:
+        # exact duplicates are kept once, entries with conflicting values are set aside (see `duplicate_positions`)
+        exact, conflicting = duplicate_positions(df)
+        duplicated = np.zeros(len(df), dtype=bool)
+        duplicated[exact] = True
+        duplicated[conflicting] = True
+        duplicates_df = df.iloc[conflicting]
+        clean_df = df[~duplicated]
 
     print(f"Found {len(df)-len(clean_df)} duplicated entries")
     print(f"...{len(duplicates_df)} of them have conflicting values...")
@@ -34,69 +249,277 @@ def check_duplicates(df, save_df=False):
         duplicates_df.to_csv(save_df)
     return clean_df, duplicates_df
 
-def check_overrides(df, overrides_fp):
+def compile_overrides(overrides_df):
+    """
+    Compiles the entries of an overrides file into per-column drop/keep/replace maps.
+
+    Parameters
+    ----------
+    overrides_df (pd.DataFrame): Overrides with columns 'label', 'column' (lower case) and 'status'. A False status
+        drops the rows with this label, a True status keeps them aside, and any other status replaces the label.
+
+    Returns
+    -------
+    dict: {column: {'drop': list, 'keep': list, 'replace': dict}} for each column found in the overrides.
+    """
+    compiled = {}
+    for column, entries in overrides_df.groupby('column', sort=False):
+        status = entries.status
+        is_false = (status==False).to_numpy(dtype=bool)
+        is_true = (status==True).to_numpy(dtype=bool) & ~is_false
+        replace = entries[~is_false & ~is_true].drop_duplicates(subset='label', keep='first')
+        compiled[column] = {'drop': list(entries.label[is_false].unique()),
+                            'keep': list(entries.label[is_true].unique()),
+                            'replace': dict(zip(replace.label, replace.status))
+                            }
+    return compiled
+
+def read_overrides(overrides_fp):
+    """
+    Reads an overrides file ('<submission>_OVERRIDES_fix.csv').
+
+    Parameters
+    ----------
+    overrides_fp (str): Path of the overrides file, with the columns label, column, status and no header.
+
+    Returns
+    -------
+    pd.DataFrame: Overrides with columns 'label', 'column' (lower case) and 'status' ('TRUE'/'FALSE' as booleans).
+    """
     col_names = ['label','column','status']
     overrides_df = pd.read_csv(overrides_fp,names=col_names)
     overrides_df.column = [x.lower() for x in overrides_df.column] # columns in all processing codes/dfs are in lowercase
     overrides_df['status'] = overrides_df['status'].replace({'TRUE': True, 'FALSE': False})
+    return overrides_df
 
-    overrides_idx = []
-    keep_idx = []
-    for _,x in overrides_df.iterrows():
-        # deal with False, treat manual as False...
-        # change status to lower case in case manual checker mis-typed the value
-        if (x.status == False):# or (x.status.lower() == 'manual'):
-            overrides_idx.append(df[df[x.column]==x.label].index.values)
+def check_overrides(df, overrides_fp, backend='pandas'):
+    # backend is 'pandas', or 'polars' to run the check as a lazy polars plan (see lazy_overrides)
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    compiled = compile_overrides(read_overrides(overrides_fp))
 
-        # deal with True, also prevent the template checker from removing this (so we are setting them aside in a separate file)
-        elif x.status == True:
-            keep_idx.append(df[df[x.column]==x.label].index.values)
+    if backend == 'polars':
+        frames = pl.collect_all(list(lazy_overrides(to_lazy(df), compiled)))
+        clean_df, overrides_df, keep_df = [from_lazy(frame, is_agmip_schema(df)) for frame in frames]
+    else:
+        # one isin per column and status instead of one full column scan per overrides entry
+        # labels are matched against the submitted values, before any replacement
+        drop_mask = np.zeros(len(df), dtype=bool)
+        keep_mask = np.zeros(len(df), dtype=bool)
+        replaced = {}
+        for column, overrides in compiled.items():
+            values = df[column]
+            # deal with False, treat manual as False...
+            if overrides['drop']:
+                drop_mask |= values.isin(overrides['drop']).to_numpy()
 
-        # if the value is not True, False, or manual, this is a replacement case
-        else:
-            df.loc[df[x.column]==x.label,x.column] = x.status
+            # deal with True, also prevent the template checker from removing this (so we are setting them aside in a separate file)
+            if overrides['keep']:
+                keep_mask |= values.isin(overrides['keep']).to_numpy()
 
-    try:     
-        overrides_idx = np.sort(np.unique(np.hstack(overrides_idx)))
-    except:
-        pass
-    try:
-        keep_idx = np.sort(np.unique(np.hstack(keep_idx)))
-    except:
-        pass
-    
-    keep_idx = [x for x in keep_idx if x not in overrides_idx]
-    clean_df = df[~df.index.isin(np.hstack([overrides_idx,keep_idx]))]
-    overrides_df = df[df.index.isin(overrides_idx)]
-    keep_df = df[df.index.isin(keep_idx)]
+            # if the value is not True, False, or manual, this is a replacement case
+            if overrides['replace']:
+                replaced[column] = replace_values(values, overrides['replace'])
+
+        if replaced:
+            df = df.assign(**replaced)
+
+        # dropped overrides take precedence over the kept ones
+        keep_mask &= ~drop_mask
+        clean_df = df[~drop_mask & ~keep_mask]
+        overrides_df = df[drop_mask]
+        keep_df = df[keep_mask]
 
     print(f"Overrides removed : {len(overrides_df)}")
     print(f"Overrides kept: {len(keep_df)}")
 
     return clean_df,overrides_df,keep_df
 
-def check_template(df,template_fp,save_exceptions = False):
+# validation checks of validate_template, in the order of their reason codes. Each check rejects the rows whose
+# value is not found in the corresponding RuleTables sheet
+VALIDATION_CHECKS = {'model':'ModelTable',
+                     'scenario':'ScenarioTable',
+                     'region':'RegionTable',
+                     'variable':'VariableUnitValueTable',
+                     'unit':'VariableUnitValueTable',
+                     'item':'ItemTable',
+                     'year':'YearTable',
+                     'value':'ValueFixTable',
+                     'range':'VariableUnitValueTable'
+                     }
+
+def encode_keys(values, allowed):
+    """
+    Integer-codes a column against the allowed values of a RuleTables sheet.
+
+    Parameters
+    ----------
+    values (pd.Series): Column to encode.
+    allowed (array-like): Allowed values, duplicates and missing values are ignored.
+
+    Returns
+    -------
+    np.ndarray: Position of each value in the unique allowed values, or -1 if the value is not allowed.
+    """
+    allowed = pd.unique(pd.Series(allowed).dropna())
+    return pd.Categorical(values, categories=allowed).codes.astype(np.int64)
+
+def apply_template_fixes(df, template_fp):
+    """
+    Applies the RegionFixTable and ValueFixTable replacements of the RuleTables to a DataFrame.
+
+    Regions found in RegionFixTable.Region are replaced by the corresponding Fix, and values found in
+    ValueFixTable.Value (e.g. 'n/a') are replaced by their Fix (missing if empty). Values are then converted to numbers;
+    values that are still not numeric become missing.
+
+    Parameters
+    ----------
+    df (pd.DataFrame): AgMIP DataFrame.
+    template_fp (str or CompiledTemplate): RuleTables workbook.
+
+    Returns
+    -------
+    df (pd.DataFrame): A copy of `df` with the fixes applied.
+    not_numeric (np.ndarray): Boolean mask of the rows whose value could not be converted to a number.
+    """
+    template = load_template(template_fp)
+    df = df.copy()
+
+    region_fix = template.tables['RegionFixTable'].dropna(subset=['Region','Fix'])
+    if len(region_fix)>0:
+        df['region'] = replace_values(df.region, dict(zip(region_fix.Region, region_fix.Fix)))
+
+    not_numeric = np.zeros(len(df), dtype=bool)
+    if not pd.api.types.is_numeric_dtype(df.value):
+        numeric = pd.to_numeric(df.value, errors='coerce')
+        # only the entries that are not numbers are looked up in the value fixes
+        unparsed = (numeric.isna() & df.value.notna()).to_numpy()
+        value_fix = template.tables['ValueFixTable'].dropna(subset=['Value'])
+        value_fix = dict(zip(value_fix.Value.astype(str).str.strip(), pd.to_numeric(value_fix.Fix, errors='coerce')))
+        stripped = df.value[unparsed].astype(str).str.strip()
+        to_fix = stripped.isin(list(value_fix.keys())).to_numpy()
+        numeric[unparsed] = stripped.map(value_fix).where(to_fix, np.nan).to_numpy(dtype=float)
+        not_numeric[unparsed] = ~to_fix
+        df['value'] = numeric
+    return df, not_numeric
+
+def validate_template(df, template_fp, checks = None, apply_fixes = True, verbose = True):
+    """
+    Validates every dimension of an AgMIP DataFrame against the RuleTables of the myGeoHub submission tool.
+
+    Each dimension is integer-coded against its RuleTables sheet, so that each check is a single anti-join over
+    integer keys (-1 codes, or (variable, unit) pair keys missing from VariableUnitValueTable), instead of a loop over
+    the variables. The fix tables (RegionFixTable, ValueFixTable) are applied first as vectorized mappings.
+
+    The checks are:
+    - 'model', 'scenario', 'region', 'item', 'year': value not in ModelTable, ScenarioTable, RegionTable, ItemTable, YearTable
+    - 'variable': variable not in VariableUnitValueTable
+    - 'unit': variable found, but the (variable, unit) pair is not in VariableUnitValueTable
+    - 'value': value not numeric after the ValueFixTable replacements
+    - 'range': value outside of the Minimum Value / Maximum Value of its (variable, unit) pair
+
+    Parameters
+    ----------
+    df (pd.DataFrame): AgMIP DataFrame with columns 'model', 'scenario', 'region', 'variable', 'item', 'unit', 'year', 'value'.
+    template_fp (str or CompiledTemplate): RuleTables workbook.
+    checks (list or None, optional): Checks to run, see VALIDATION_CHECKS. If None, all of them. Defaults to None.
+    apply_fixes (bool, optional): Whether to apply RegionFixTable and ValueFixTable first. Defaults to True.
+    verbose (bool, optional): Whether to print the number of rejected rows by reason. Defaults to True.
+
+    Returns
+    -------
+    clean_df (pd.DataFrame): Rows that pass all the checks (with the fixes applied).
+    except_df (pd.DataFrame): Rejected rows, with a 'reason' column listing the failed checks separated by '|' (e.g. 'item|year').
+    """
+    template = load_template(template_fp)
+    checks = list(VALIDATION_CHECKS.keys()) if checks == None else list(checks)
+    for check in checks:
+        assert check in VALIDATION_CHECKS, f"unknown check '{check}'. Must be one of {list(VALIDATION_CHECKS.keys())}"
+
+    if apply_fixes:
+        df, not_numeric = apply_template_fixes(df, template)
+    else:
+        not_numeric = np.zeros(len(df), dtype=bool)
+
+    failed = {}
+    for col, table in [('model','ModelTable'),
+                       ('scenario','ScenarioTable'),
+                       ('region','RegionTable'),
+                       ('item','ItemTable')
+                       ]:
+        if col in checks:
+            allowed = template.tables[table][col.capitalize()]
+            failed[col] = encode_keys(df[col], allowed)==-1
+
+    if 'year' in checks:
+        year = pd.to_numeric(df.year, errors='coerce')
+        failed['year'] = encode_keys(year, template.tables['YearTable'].Year.astype(float))==-1
+
+    if any(check in checks for check in ['variable','unit','range']):
+        VariableUnitValueTable = template.tables['VariableUnitValueTable'].dropna(subset=['Variable','Unit'])
+        variable_codes = encode_keys(df.variable, VariableUnitValueTable.Variable)
+        unit_codes = encode_keys(df.unit, VariableUnitValueTable.Unit)
+        n_units = len(pd.unique(VariableUnitValueTable.Unit))
+
+        # (variable, unit) pairs as a single integer key
+        pair_keys = variable_codes*n_units + unit_codes
+        pair_keys[(variable_codes==-1) | (unit_codes==-1)] = -1
+        allowed_keys = (encode_keys(VariableUnitValueTable.Variable, VariableUnitValueTable.Variable)*n_units
+                        + encode_keys(VariableUnitValueTable.Unit, VariableUnitValueTable.Unit))
+        pair_found = np.isin(pair_keys, allowed_keys)
+
+        if 'variable' in checks:
+            failed['variable'] = variable_codes==-1
+        if 'unit' in checks:
+            failed['unit'] = (variable_codes!=-1) & ~pair_found
+        if 'range' in checks:
+            bounds = pd.DataFrame({'Minimum Value':VariableUnitValueTable['Minimum Value'].values,
+                                   'Maximum Value':VariableUnitValueTable['Maximum Value'].values},
+                                  index=allowed_keys)
+            bounds = bounds[~bounds.index.duplicated()]
+            value = pd.to_numeric(df.value, errors='coerce').to_numpy(dtype=float)
+            minimum = bounds['Minimum Value'].reindex(pair_keys).to_numpy(dtype=float)
+            maximum = bounds['Maximum Value'].reindex(pair_keys).to_numpy(dtype=float)
+            # missing values and missing bounds are not range errors
+            failed['range'] = (value<minimum) | (value>maximum)
+
+    if 'value' in checks:
+        failed['value'] = not_numeric
+
+    # one bit per failed check, decoded into the reason string of each distinct code
+    reason_codes = np.zeros(len(df), dtype=np.int64)
+    ordered_checks = [check for check in VALIDATION_CHECKS if check in failed]
+    for bit, check in enumerate(ordered_checks):
+        reason_codes |= failed[check].astype(np.int64) << bit
+    rejected = reason_codes!=0
+
+    clean_df = df[~rejected]
+    except_df = df[rejected].copy()
+    except_codes = reason_codes[rejected]
+    reasons = {code: '|'.join([check for bit, check in enumerate(ordered_checks) if code & (1 << bit)]) for code in np.unique(except_codes)}
+    except_df['reason'] = pd.Series(except_codes, index=except_df.index).map(reasons)
+
+    if verbose:
+        print(f"Template exceptions removed: {len(except_df)}")
+        if len(except_df)>0:
+            print(except_df.reason.value_counts().to_string())
+
+    return clean_df,except_df
+
+def check_template(df,template_fp,save_exceptions = False,backend = 'pandas'):
     ## template check, this actually refers to the RulesTables in myGeoHub, which should be consistent with the AgMIP reporting template for this project
-    
-    # get template variables and units
-    VariableUnitValueTable = pd.read_excel(template_fp,'VariableUnitValueTable')
-
-    # double check that all variables in df are in VariableUnitValueTable.Variable
-    # set(df.variable.unique()).issubset(set(variables))
-    variables = VariableUnitValueTable.Variable.values
-    clean_df = df[df.variable.isin(variables)]
-
-    keep_idx = []
-    for variable in clean_df.variable.unique():
-        expected_unit = VariableUnitValueTable[VariableUnitValueTable.Variable==variable].Unit.values
-        keep_idx.append(clean_df[(clean_df.variable==variable) & (clean_df.unit.isin(expected_unit))].index.values)
-    try:
-        keep_idx = np.sort(np.unique(np.hstack(keep_idx)))
-    except:
-        keep_idx = []
-    except_df = clean_df[~clean_df.index.isin(keep_idx)]
-    clean_df = clean_df[clean_df.index.isin(keep_idx)]
+    ## only the variables and units are checked here, see validate_template to check all the RuleTables sheets
+
+    # variables missing from VariableUnitValueTable are dropped, rows with an unexpected unit are returned as exceptions
+    # (template_fp can also be an already loaded CompiledTemplate)
+    # backend is 'pandas', or 'polars' to run the check as a lazy polars plan (see lazy_template)
+    assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+    if backend == 'polars':
+        frames = pl.collect_all(list(lazy_template(to_lazy(df),template_fp)))
+        clean_df,except_df = [from_lazy(frame, is_agmip_schema(df)) for frame in frames]
+    else:
+        clean_df,except_df = validate_template(df,template_fp,checks=['variable','unit'],apply_fixes=False,verbose=False)
+        except_df = except_df[except_df.reason=='unit'].drop(columns='reason')
 
     print(f"Template exceptions removed: {len(except_df)}")
 
-    return clean_df,except_df
\ No newline at end of file
+    return clean_df,except_df
@@ -100,6 +100,11 @@ def interp_years_df(df,interp_years,return_type = 'df'):
                 'value': y
     }
     interp_df = pd.DataFrame(interp_dict)
+    # same dtypes as df (e.g. the categoricals of the AgMIP schema), so that concatenating them keeps the dtypes
+    dtypes = {col:df[col].dtype for col in cols}
+    if np.issubdtype(df.year.dtype, np.integer) and np.all(np.round(interp_years)==interp_years):
+        dtypes['year'] = df.year.dtype
+    interp_df = interp_df.astype(dtypes)
 
     if return_type == 'array':
         return y
@@ -147,4 +152,210 @@ def interp_base_year(k_df,base_year):
         interp_df = interp_years_df(k_df_s,interp_years,return_type=return_type)
         k_df = pd.concat([k_df,interp_df],ignore_index=True)
 
-    return k_df
\ No newline at end of file
+    return k_df
+
+
+def interp_base_year_frame(df, base_year, series_cols=('model','scenario','region','variable','item','unit')):
+    """
+    Interpolate `base_year` in every series of a DataFrame that does not report it, all series at once.
+
+    This is the batched version of `interp_base_year`. The series are sorted once by year, the years bracketing
+    `base_year` in each series are found with one sorted search, and the values of all the series are interpolated
+    in one vectorized pass (with the same arithmetic as `numpy.interp`). Series that report `base_year` are left
+    out, and series without a year before and after it cannot be interpolated. If a series reports a bracketing
+    year more than once, the first reported row is used.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame containing the `series_cols`, 'year' and 'value' columns.
+    base_year : int
+        The year to interpolate.
+    series_cols : tuple of str, optional
+        Columns identifying a series. The default is ('model','scenario','region','variable','item','unit').
+
+    Returns
+    -------
+    interp_df : pandas.DataFrame
+        One row per interpolated series, with the `series_cols`, 'year' and 'value' columns and the dtypes of `df`,
+        in the order of the first row of each series in `df`. The index is the position of that first row in `df`.
+    failed : numpy.ndarray of bool
+        For each row of `df`, True if its series does not report `base_year` and cannot be interpolated.
+
+    Examples
+    --------
+    >>> df = pd.DataFrame({'model':'Model1', 'scenario':['BAU']*2+['ELM']*2, 'region':'Region1',
+    ...                    'variable':'Variable1', 'item':'Item1', 'unit':'Unit1',
+    ...                    'year':[2010, 2030, 2010, 2030], 'value':[10, 30, 20, 40]})
+    >>> interp_df, failed = interp_base_year_frame(df, 2020)
+    >>> interp_df
+        model scenario   region   variable   item   unit  year  value
+    0  Model1      BAU  Region1  Variable1  Item1  Unit1  2020   20.0
+    2  Model1      ELM  Region1  Variable1  Item1  Unit1  2020   30.0
+    """
+    cols = list(series_cols)
+    series = df.groupby(cols, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    years = df['year'].to_numpy(dtype=float)
+    values = df['value'].to_numpy(dtype=float)
+
+    # rows of the series that do not report base_year (rows without a year are not used)
+    reported = np.zeros(series.max()+1 if len(series) > 0 else 0, dtype=bool)
+    reported[series[years==base_year]] = True
+    rows = np.flatnonzero(~reported[series] & ~np.isnan(years))
+    missing = np.unique(series[~reported[series]])
+
+    # sort by series then year, so that key = 2*series + (year > base_year) is sorted, and search it for the
+    # first row of each series, the first row after base_year (upper bracket) and the end of the series
+    rows = rows[np.lexsort((years[rows], series[rows]))]
+    key = 2*series[rows] + (years[rows] > base_year)
+    start = np.searchsorted(key, 2*missing, 'left')
+    upper = np.searchsorted(key, 2*missing+1, 'left')
+    end = np.searchsorted(key, 2*missing+2, 'left')
+    bracketed = (upper > start) & (upper < end)
+    failed = np.isin(series, missing[~bracketed])
+
+    # the lower bracket is the year before the upper one. The sort is stable, so if a series reports a bracketing
+    # year twice, the first reported row is at the start of its run of equal (series, year) positions
+    same = np.r_[False, (series[rows][1:]==series[rows][:-1]) & (years[rows][1:]==years[rows][:-1])]
+    run_start = np.maximum.accumulate(np.where(same, 0, np.arange(len(rows))))
+    lower = rows[run_start[upper[bracketed]-1]]
+    upper = rows[upper[bracketed]]
+    x0, x1, y0, y1 = years[lower], years[upper], values[lower], values[upper]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y1-y0)/(x1-x0)
+        value = slope*(base_year-x0)+y0
+        # as numpy.interp, from the upper year if the lower one gives NaN (infinite values), or the common value
+        value = np.where(np.isnan(value), slope*(base_year-x1)+y1, value)
+        value = np.where(np.isnan(value) & (y0==y1), y0, value)
+
+    # first row of each interpolated series, in the order of the series in df
+    first = np.full(len(reported), len(df))
+    np.minimum.at(first, series, np.arange(len(df)))
+    first = first[missing[bracketed]]
+    interp_df = df[cols].iloc[first]
+    interp_df.index = first
+    year = np.full(len(first), base_year)
+    if np.issubdtype(df.year.dtype, np.integer) and (round(base_year)==base_year):
+        year = year.astype(df.year.dtype)
+    interp_df = interp_df.assign(year=year, value=value)
+    return interp_df, failed
+
+# status of the values of `resample_years`, and how the values outside the years of a series are filled
+RESAMPLE_STATUS = ['reported','interpolated','extrapolated','held','out_of_range']
+RESAMPLE_OUTSIDE = ['nan','hold','linear','drop']
+
+def resample_years(df, years=None, step=1, value_cols=('value',), outside='nan', series_cols=('model','scenario','region','variable','item','unit')):
+    """
+    Resample every series of a DataFrame (e.g. a merged multi-model dataset) onto a common year grid, all series at once.
+
+    The rows are sorted once by series and year, the position of every (series, grid year) pair is found with one
+    sorted search, and all the values are computed in one vectorized pass: reported years are kept, years between
+    two reported years are interpolated linearly, and years before the first or after the last reported year are
+    filled according to `outside`. The 'year_status' column flags how each value was obtained.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame containing the `series_cols`, 'year' and `value_cols` columns. Rows without a year are ignored,
+        and when a series reports a year twice, the first row is used.
+    years : array-like, optional
+        Years of the grid. The default is None, every `step` years from the first to the last year of `df`.
+    step : int, optional
+        Step of the default grid. The default is 1 (annual).
+    value_cols : tuple of str, optional
+        Columns to resample. The default is ('value',). Percent changes and differences are not linear in the
+        values, recalculate them on the resampled values with `pc_diff_interp` instead.
+    outside : str, optional
+        Values of the grid years outside the years of a series:
+        - 'nan': empty values, flagged 'out_of_range' (every series has every grid year);
+        - 'hold': the first or last reported value, flagged 'held';
+        - 'linear': linear extrapolation of the first or last two reported years, flagged 'extrapolated' (a series
+          with a single year is held);
+        - 'drop': no row.
+        The default is 'nan'.
+    series_cols : tuple of str, optional
+        Columns identifying a series. The default is ('model','scenario','region','variable','item','unit').
+
+    Returns
+    -------
+    pandas.DataFrame
+        The `series_cols`, 'year', `value_cols` and 'year_status' (categorical, see RESAMPLE_STATUS) columns, with the
+        dtypes of `df`, one row per series and grid year, in the order of the series in `df` and then by year.
+
+    Raises
+    ------
+    ValueError
+        If `step` is not positive, or `years` is empty.
+
+    Examples
+    --------
+    >>> df = pd.DataFrame({'model':'Model1', 'scenario':'BAU', 'region':'Region1', 'variable':'Variable1',
+    ...                    'item':'Item1', 'unit':'Unit1', 'year':[2020, 2030], 'value':[10, 20]})
+    >>> resample_years(df, years=[2015, 2020, 2025, 2030], outside='hold')[['year','value','year_status']]
+       year  value   year_status
+    0  2015   10.0          held
+    1  2020   10.0      reported
+    2  2025   15.0  interpolated
+    3  2030   20.0      reported
+    """
+    assert outside in RESAMPLE_OUTSIDE, f"outside should be one of {RESAMPLE_OUTSIDE}"
+    if step <= 0:
+        raise ValueError(f"step should be positive, got {step}")
+    if (years is not None) and (np.size(years) == 0):
+        raise ValueError("years is empty")
+    cols = list(series_cols)
+    df = df[df.year.notna()]
+    if len(df) == 0:
+        return df[cols+['year']+list(value_cols)].assign(year_status=pd.Categorical([], RESAMPLE_STATUS))
+    x = df['year'].to_numpy(dtype=float)
+    if years is None:
+        grid = np.arange(x.min(), x.max()+step, step)
+        grid = grid[grid <= x.max()]
+    else:
+        grid = np.unique(np.asarray(years, dtype=float))
+    series = df.groupby(cols, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    n_series = series.max()+1
+
+    # rows sorted by series then year, without the repeated years of a series
+    order = np.lexsort((x, series))
+    order = order[np.r_[True, (series[order][1:] != series[order][:-1]) | (x[order][1:] != x[order][:-1])]]
+    s, x = series[order], x[order]
+
+    # sorted search of all the (series, grid year) pairs: key = series*span + year is increasing over the sorted rows
+    low = min(x.min(), grid.min())
+    span = max(x.max(), grid.max())-low+1
+    target_s = np.repeat(np.arange(n_series), len(grid))
+    target_x = np.tile(grid, n_series)
+    pos = np.searchsorted(s*span+(x-low), target_s*span+(target_x-low), 'left')
+    start = np.searchsorted(s, np.arange(n_series), 'left')[target_s]
+    end = np.searchsorted(s, np.arange(n_series), 'right')[target_s]
+
+    reported = (pos < end) & (x[np.minimum(pos, len(x)-1)] == target_x)
+    inside = ~reported & (pos > start) & (pos < end)
+    before = ~reported & (pos == start)
+    after = pos == end
+    extrapolated = (before | after) & ((end-start) > 1) & (outside == 'linear')
+    held = (before | after) & ~extrapolated & (outside in ['hold','linear'])
+    status = np.select([reported, inside, extrapolated, held], [0, 1, 2, 3], 4)
+
+    # rows of the two years each value is computed from (the same row for reported and held values)
+    i0 = np.select([inside, before, after], [pos-1, start, np.where(extrapolated, end-2, end-1)], pos)
+    i1 = np.select([before, after], [np.where(extrapolated, start+1, start), end-1], pos)
+
+    keep = (status != 4) if outside == 'drop' else np.ones(len(status), dtype=bool)
+    first = np.full(n_series, len(df))
+    np.minimum.at(first, series, np.arange(len(df)))
+    resampled_df = df[cols].iloc[first[target_s[keep]]].reset_index(drop=True)
+    year = target_x[keep]
+    resampled_df['year'] = year.astype(df.year.dtype) if np.issubdtype(df.year.dtype, np.integer) and np.all(np.round(year) == year) else year
+
+    i0, i1, status = i0[keep], i1[keep], status[keep]
+    x0, x1 = x[i0], x[i1]
+    for col in value_cols:
+        values = df[col].to_numpy(dtype=float)[order]
+        y0, y1 = values[i0], values[i1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = np.where(i0 != i1, (y1-y0)/(x1-x0)*(year-x0)+y0, y0)
+        resampled_df[col] = np.where(status == 4, np.nan, value)
+    resampled_df['year_status'] = pd.Categorical.from_codes(status, RESAMPLE_STATUS)
+    return resampled_df
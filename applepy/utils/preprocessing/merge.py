@@ -1,10 +1,63 @@
+import os
 import pandas as pd
 import time
+from functools import partial
 from os.path import join as pjoin
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from .checks import *
 from ..helper import *
+from ..storage import *
 
-def merge_raw(fps, save = False, output_dir = None, merge_fn = None):
+# executors of `read_inputs`: threads for the Arrow readers (which release the GIL), or processes
+READ_POOLS = {'thread':ThreadPoolExecutor,
+              'process':ProcessPoolExecutor
+              }
+
+def read_inputs(read_fn, fps, workers=None, pool='thread'):
+    """
+    Reads files concurrently.
+
+    Parameters
+    ----------
+    read_fn (callable): Reader of one file (e.g. `AgMIP_read_raw_csv`, `read_stage`). It must be picklable with `pool='process'`.
+    fps (list of str): Files.
+    workers (int or None, optional): Number of concurrent reads. If None, one per file, up to the number of CPUs. Defaults to None.
+    pool (str, optional): 'thread' or 'process' (see READ_POOLS). Defaults to 'thread'.
+
+    Returns
+    -------
+    list of pd.DataFrame: The DataFrames, in the order of `fps`.
+    """
+    assert pool in READ_POOLS, f"pool should be one of {list(READ_POOLS.keys())}"
+    if workers == None:
+        workers = min(len(fps), os.cpu_count() or 1)
+    if (workers <= 1) or (len(fps) <= 1):
+        return [read_fn(fp) for fp in fps]
+    with READ_POOLS[pool](max_workers=workers) as executor:
+        return list(executor.map(read_fn, fps))
+
+def model_precedence(dfs):
+    """
+    Finds the rows of DataFrames that are kept when the models of each DataFrame replace those of the previous ones
+    (as in a sequence of `update_dataset` calls): the rows of a model are kept from the last DataFrame that has it.
+
+    Parameters
+    ----------
+    dfs (list of pd.DataFrame): DataFrames, in increasing order of precedence.
+
+    Returns
+    -------
+    list of np.ndarray: Boolean mask of the kept rows of each DataFrame.
+    """
+    masks = [None]*len(dfs)
+    later_models = set()
+    for i in range(len(dfs)-1, -1, -1):
+        models = dfs[i].model
+        masks[i] = ~models.isin(list(later_models)).to_numpy()
+        later_models |= set(models.unique())
+    return masks
+
+def merge_raw(fps, save = False, output_dir = None, merge_fn = None, workers = None, pool = 'thread'):
     """
     Merges multiple raw CSV files from different agricultural models into a single DataFrame.
 
@@ -20,6 +73,10 @@ def merge_raw(fps, save = False, output_dir = None, merge_fn = None):
         The directory where the merged CSV file will be saved if `save` is True. If not specified, defaults to an 'output' subdirectory in the same directory as the first file in `fps`.
     merge_fn : str, optional
         The filename for the merged CSV file. If not specified, defaults to a name with the pattern `merged_YYMMDD.csv`, where `YYMMDD` is the current date.
+    workers : int, optional
+        Number of files read concurrently (see `read_inputs`). If not specified, one per file, up to the number of CPUs.
+    pool : str, optional, default='thread'
+        'thread' or 'process', the pool of the concurrent reads.
 
     Returns:
     --------
@@ -40,25 +97,25 @@ def merge_raw(fps, save = False, output_dir = None, merge_fn = None):
     Notes:
     ------
     - The function assumes that each CSV file name contains the model name before the '.csv' extension. This model name is used to determine the appropriate columns and format for reading the file.
-    - Duplicates within each file are checked and will be dropped using the `check_duplicates` function.
+    - Entries reported more than once within a file are dropped (no copy is kept), after the scenarios are upper-cased.
     - The function utilizes `AgMIP_read_raw_csv` to read and process each file according to its model-specific requirements.
-    - The `update_dataset` function is assumed to handle the merging of DataFrames correctly.
+    - The files are merged as by folding them in with `update_dataset`, in one pass: the rows of a model are taken from the last file that has it (see `model_precedence`), the last file first, and the DataFrames are concatenated once.
     - Ensure `check_path` and `pjoin` are defined and handle directory checks and path joining correctly.
     """
 
-    # start with the first file
     old_fp = fps[0]
-    old_df = AgMIP_read_raw_csv(old_fp)
+    dfs = read_inputs(AgMIP_read_raw_csv, fps, workers, pool)
+
     print("Duplicates will be dropped")
-    check_duplicates(old_df)
+    for i, df in enumerate(dfs):
+        #there are some that report ELM_DIET as ELM_Diet (replace_values keeps the categoricals of the AgMIP schema)
+        df['scenario'] = replace_values(df.scenario, {x:str(x).upper() for x in df.scenario.dropna().unique()})
+        dfs[i] = df.drop_duplicates(subset=['model','scenario','region','variable', 'item','unit','year'], keep=False)
+        print(f"{fps[i].split('/')[-1]}: dropped {len(df)-len(dfs[i])} duplicated entries")
 
-    for update_fp in fps[1:]:
-        # update_df = pd.read_csv(update_fp,index_col=0)
-        # model = update_fp.split('/')[-1].split('.csv')[0]
-        update_df = AgMIP_read_raw_csv(update_fp)
-        print("Duplicates will be dropped")
-        check_duplicates(update_df)
-        old_df = update_dataset(old_df,update_df)
+    # the last file first, with the models of the later files dropped from the earlier ones
+    masks = model_precedence(dfs)
+    old_df = concat_agmip([df[mask] for df, mask in zip(dfs, masks)][::-1]).reset_index(drop=True)
 
     # default update filename
     if merge_fn == None:
@@ -98,9 +155,12 @@ def update_dataset(old_df, new_df, full_replace = True):
     Note
     ----
     - The columns used for deduplication and indexing are assumed to be 'model', 'scenario', 'region', 'variable', 'item', 'unit', and 'year'.
+    - For a merged dataset kept on disk, `DatasetStore.upsert` does the same update (replace='model'), or a replacement
+      of scenarios or entries only, and rewrites only the model and scenario partitions that are touched.
     """
-    old_df.scenario = old_df.scenario.str.upper() #there are some that report ELM_DIET as ELM_Diet
-    new_df.scenario = new_df.scenario.str.upper()
+    #there are some that report ELM_DIET as ELM_Diet (replace_values keeps the categoricals of the AgMIP schema)
+    old_df.scenario = replace_values(old_df.scenario, {x:str(x).upper() for x in old_df.scenario.dropna().unique()})
+    new_df.scenario = replace_values(new_df.scenario, {x:str(x).upper() for x in new_df.scenario.dropna().unique()})
 
     if full_replace:
         old_df = old_df.drop_duplicates(subset=['model','scenario','region','variable', 'item','unit','year'], keep=False)
@@ -109,26 +169,60 @@ def update_dataset(old_df, new_df, full_replace = True):
         models_to_replace = new_df.model.unique()
         old_df = old_df[~old_df.model.isin(models_to_replace)]
         
-        return pd.concat([new_df, old_df]).reset_index(drop=True)
+        return concat_agmip([new_df, old_df]).reset_index(drop=True)
     
     else:
         old_df = old_df.drop_duplicates(subset=['model','scenario','region','variable', 'item','unit','year'], keep=False)
         new_df = new_df.drop_duplicates(subset=['model','scenario','region','variable', 'item','unit','year'], keep=False)
-        return pd.concat([new_df, old_df[~old_df.index.isin(new_df.index)]]).reset_index(drop=True)
+        return concat_agmip([new_df, old_df[~old_df.index.isin(new_df.index)]]).reset_index(drop=True)
     
-def merge_fps(fps, save = False, output_dir = None, merge_fn = None, drop_duplicates=False):  
+def merge_fps(fps, save = False, output_dir = None, merge_fn = None, drop_duplicates=False, file_format='csv', value_dtype='float64', replace_models=False, workers=None, pool='thread'):
+    """
+    Merges stage outputs (e.g. pc-diff files) saved as CSV, Parquet, or Arrow IPC files into a single DataFrame.
+
+    Parameters:
+    -----------
+    fps : list of str
+        A list of file paths to the files to be merged. Formats can be mixed (see `read_stage`).
+    save : bool, optional, default=False
+        If True, the merged DataFrame will be saved. If False, the merged DataFrame will be returned.
+    output_dir : str, optional
+        The directory where the merged file will be saved if `save` is True. If not specified, defaults to an 'output' subdirectory in the same directory as the first file in `fps`.
+    merge_fn : str, optional
+        The filename for the merged file. Its extension sets the storage format. If not specified, defaults to a name with the pattern `merged-<folder>_YYMMDD` and the extension of `file_format`.
+    drop_duplicates : bool, optional, default=False
+        If True, entries that are reported more than once are dropped (no copy is kept).
+    file_format : str, optional, default='csv'
+        Storage format of the merged file if `merge_fn` is not specified: 'csv', 'parquet' or 'arrow'.
+    value_dtype : str, optional, default='float64'
+        dtype of the values, 'float64' or 'float32' (see `apply_agmip_schema`). The dimensions are categoricals.
+    replace_models : bool, optional, default=False
+        If True, the rows of a model are only taken from the last file that has it (see `model_precedence`), as when the files are folded in with `update_dataset`.
+    workers : int, optional
+        Number of files read concurrently (see `read_inputs`). If not specified, one per file, up to the number of CPUs.
+    pool : str, optional, default='thread'
+        'thread' or 'process', the pool of the concurrent reads.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        If `save` is False, returns the merged DataFrame. If `save` is True, the function saves the DataFrame and returns None.
+    """
     base_dir = fps[0].split('/')[-2]
 
-    merged_df = pd.concat([pd.read_csv(fp) for fp in fps],ignore_index=True)
+    dfs = read_inputs(partial(read_stage,value_dtype=value_dtype), fps, workers, pool)
+    if replace_models:
+        dfs = [df[mask] for df, mask in zip(dfs, model_precedence(dfs))]
+    merged_df = concat_agmip(dfs,ignore_index=True)
     if drop_duplicates:
         merged_df = merged_df.drop_duplicates(subset=['model','scenario','region','variable', 'item','unit','year'], keep=False)
         # default update filename
         if merge_fn == None:
-            merge_fn = f"merged-{base_dir}_duplicates-dropped_{time.strftime('%y%m%d')}.csv"
+            merge_fn = stage_fp(f"merged-{base_dir}_duplicates-dropped_{time.strftime('%y%m%d')}.csv",file_format)
     else: 
         # default update filename
         if merge_fn == None:
-            merge_fn = f"merged-{base_dir}_{time.strftime('%y%m%d')}.csv"
+            merge_fn = stage_fp(f"merged-{base_dir}_{time.strftime('%y%m%d')}.csv",file_format)
 
     if save: 
         if output_dir == None:
@@ -136,6 +230,6 @@ def merge_fps(fps, save = False, output_dir = None, merge_fn = None, drop_duplic
             check_path(output_dir)
         merge_fp = pjoin(output_dir,merge_fn)
         print(f'Saving merged files to: {merge_fp}')
-        merged_df.to_csv(merge_fp)
+        write_stage(merged_df,merge_fp)
     else:    
         return merged_df
\ No newline at end of file
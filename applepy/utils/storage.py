@@ -0,0 +1,333 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from .template import *
+
+# file extension for each storage format of the pipeline stage outputs
+STAGE_EXTENSIONS = {'csv':'.csv',
+                    'parquet':'.parquet',
+                    'arrow':'.arrow'
+                    }
+
+# string dimensions of AgMIP DataFrames, categoricals in the AgMIP schema and dictionary-encoded in the columnar formats
+DIMENSION_COLS = ['model','scenario','region','variable','item','unit']
+
+# RuleTables of this package, whose values are the categories of the AgMIP schema
+DEFAULT_TEMPLATE_FP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'template','RuleTables.xlsx')
+
+# dtypes of the year and value columns in the AgMIP schema (value can be 'float32' to halve its memory)
+YEAR_DTYPE = 'int16'
+VALUE_DTYPES = ['float64','float32']
+
+def stage_format(fp):
+    """
+    Gets the storage format of a stage file from its extension.
+
+    Parameters
+    ----------
+    fp (str): Path to a '.csv', '.parquet', or '.arrow' (or '.feather') file.
+
+    Returns
+    -------
+    str: 'csv', 'parquet', or 'arrow'
+
+    Raises
+    ------
+    ValueError
+        If the extension is not a supported storage format.
+    """
+    ext = os.path.splitext(fp)[1].lower()
+    if ext == '.feather':
+        return 'arrow'
+    for file_format, format_ext in STAGE_EXTENSIONS.items():
+        if ext == format_ext:
+            return file_format
+    raise ValueError(f"unrecognized file extension '{ext}'. Must be one of {list(STAGE_EXTENSIONS.values())} or '.feather'.")
+
+def stage_fp(fp, file_format=None):
+    """
+    Changes the extension of a file path to the one of a storage format.
+
+    Parameters
+    ----------
+    fp (str): File path, with or without extension.
+    file_format (str or None): 'csv', 'parquet', or 'arrow'. If None, `fp` is returned unchanged.
+
+    Returns
+    -------
+    str: File path with the extension of `file_format`.
+    """
+    if file_format == None:
+        return fp
+    assert file_format in STAGE_EXTENSIONS, f"file_format should be one of {list(STAGE_EXTENSIONS.keys())}"
+    return os.path.splitext(fp)[0]+STAGE_EXTENSIONS[file_format]
+
+def sorted_categories(values):
+    """
+    Sorts category values, so that sorting or grouping by a categorical gives the same order as by strings.
+
+    Parameters
+    ----------
+    values (array-like): Unique values.
+
+    Returns
+    -------
+    pd.Index: The sorted values (in the given order if they cannot be compared).
+    """
+    values = pd.Index(values)
+    try:
+        return values.sort_values()
+    except TypeError:
+        return values
+
+def agmip_categories(values, col, template_fp=DEFAULT_TEMPLATE_FP):
+    """
+    Gets the categories of a dimension of the AgMIP schema: the values of the template, and the values of the data
+    that are not in the template.
+
+    Parameters
+    ----------
+    values (pd.Series): Column of the dimension.
+    col (str): Dimension, one of DIMENSION_COLS.
+    template_fp (str, CompiledTemplate or None, optional): Template workbook. If None, only the values of the data are
+        used. Defaults to the RuleTables of this package.
+
+    Returns
+    -------
+    pd.Index: Sorted categories.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        observed = values.cat.categories[np.unique(values.cat.codes[values.cat.codes>=0])]
+    else:
+        observed = pd.Index(values.dropna().unique())
+    if template_fp == None:
+        return sorted_categories(observed)
+    template_values = pd.Index(load_template(template_fp).categories.get(col, []))
+    return sorted_categories(template_values.append(observed[~observed.isin(template_values)]))
+
+def apply_agmip_schema(df, template_fp=DEFAULT_TEMPLATE_FP, value_dtype='float64'):
+    """
+    Casts an AgMIP DataFrame to the AgMIP schema.
+
+    - The dimensions ('model', 'scenario', 'region', 'variable', 'item', 'unit') become categoricals, whose categories
+      are the template values (plus the values of the data not in the template, see `agmip_categories`), so that
+      equality filters and group-bys compare integer codes instead of strings.
+    - 'year' becomes int16 when it has no missing values.
+    - 'value' becomes float64, or float32 if `value_dtype='float32'`. Values that are not numbers (e.g. 'n/a', see
+      `validate_template`) are left as they are.
+
+    Parameters
+    ----------
+    df (pd.DataFrame): AgMIP DataFrame. Columns that are not present are skipped.
+    template_fp (str, CompiledTemplate or None, optional): Template workbook for the categories. Defaults to the RuleTables of this package.
+    value_dtype (str, optional): 'float64' or 'float32'. Defaults to 'float64'.
+
+    Returns
+    -------
+    pd.DataFrame: A (shallow) copy of `df` with the typed columns.
+    """
+    assert value_dtype in VALUE_DTYPES, f"value_dtype should be one of {VALUE_DTYPES}"
+    df = df.copy(deep=False)
+    for col in DIMENSION_COLS:
+        if col in df.columns:
+            categories = agmip_categories(df[col], col, template_fp)
+            if not (isinstance(df[col].dtype, pd.CategoricalDtype) and df[col].cat.categories.equals(categories)):
+                df[col] = pd.Categorical(df[col], categories=categories)
+
+    if ('year' in df.columns) and pd.api.types.is_numeric_dtype(df.year) and df.year.notna().all():
+        year = df.year.to_numpy()
+        if (year == np.round(year)).all() and (np.abs(year) < np.iinfo(YEAR_DTYPE).max).all():
+            df['year'] = df.year.astype(YEAR_DTYPE)
+
+    if ('value' in df.columns) and pd.api.types.is_numeric_dtype(df.value):
+        df['value'] = df.value.astype(value_dtype)
+    return df
+
+def to_stage_schema(df):
+    """
+    Casts an AgMIP DataFrame to the typed schema used by the columnar storage formats (the AgMIP schema, see
+    `apply_agmip_schema`). The categoricals are stored dictionary-encoded.
+
+    Parameters
+    ----------
+    df (pd.DataFrame): AgMIP DataFrame.
+
+    Returns
+    -------
+    pd.DataFrame: A copy of `df` with the typed columns.
+    """
+    value_dtype = str(df.value.dtype) if ('value' in df.columns) and (str(df.value.dtype) in VALUE_DTYPES) else 'float64'
+    return apply_agmip_schema(df, value_dtype=value_dtype)
+
+def concat_agmip(dfs, **kwargs):
+    """
+    Concatenates AgMIP DataFrames, keeping the categoricals of the AgMIP schema.
+
+    `pd.concat` turns categoricals with different categories into strings. The categories of each dimension are
+    unified first (sorted union), so that the result keeps categoricals.
+
+    Parameters
+    ----------
+    dfs (list of pd.DataFrame): DataFrames to concatenate.
+    **kwargs: Passed to `pd.concat` (e.g. ignore_index=True).
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    dfs = list(dfs)
+    for col in DIMENSION_COLS:
+        cols = [df[col] for df in dfs if col in df.columns]
+        if not any([isinstance(x.dtype, pd.CategoricalDtype) for x in cols]):
+            continue
+        categories = pd.Index([])
+        for x in cols:
+            values = x.cat.categories if isinstance(x.dtype, pd.CategoricalDtype) else pd.Index(x.dropna().unique())
+            categories = categories.append(values[~values.isin(categories)])
+        categories = sorted_categories(categories)
+        dfs = [df.assign(**{col:pd.Categorical(df[col], categories=categories)}) if col in df.columns else df for df in dfs]
+    return pd.concat(dfs, **kwargs)
+
+def replace_values(values, mapping):
+    """
+    Replaces values of a column with a mapping, without converting categoricals to strings.
+
+    For a categorical, the categories are renamed (merged if two of them are mapped to the same value), and the codes
+    are remapped with one integer lookup.
+
+    Parameters
+    ----------
+    values (pd.Series): Column.
+    mapping (dict): Replacements; values not in `mapping` are kept.
+
+    Returns
+    -------
+    pd.Series: The column with the replacements.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        renamed = pd.Series([mapping.get(x, x) for x in values.cat.categories], dtype=object)
+        categories = sorted_categories(renamed.dropna().unique())
+        code_map = np.append(categories.get_indexer(renamed), -1)
+        # code -1 (missing) maps to the appended -1
+        codes = code_map[values.cat.codes.to_numpy()]
+        return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=values.index, name=values.name)
+    to_replace = values.isin(list(mapping.keys()))
+    return values.where(~to_replace, values.map(mapping))
+
+def write_stage(df, fp, index=True, compression='zstd'):
+    """
+    Saves a stage output in the format given by the file extension.
+
+    CSV files are written with `DataFrame.to_csv`. Parquet and Arrow IPC files are written with the typed schema
+    of `to_stage_schema` and compressed.
+
+    Parameters
+    ----------
+    df (pd.DataFrame): DataFrame to save.
+    fp (str): File path ending in '.csv', '.parquet', or '.arrow' (or '.feather').
+    index (bool, optional): Whether to save the index of `df`. Defaults to True.
+    compression (str, optional): Compression codec for Parquet and Arrow IPC files. Defaults to 'zstd'.
+
+    Returns
+    -------
+    None
+    """
+    file_format = stage_format(fp)
+    if file_format == 'csv':
+        df.to_csv(fp, index=index)
+        return
+    table = pa.Table.from_pandas(to_stage_schema(df), preserve_index=index)
+    if file_format == 'parquet':
+        pq.write_table(table, fp, compression=compression)
+    else:
+        feather.write_feather(table, fp, compression=compression)
+
+def read_stage(fp, categorical=True, value_dtype='float64', template_fp=DEFAULT_TEMPLATE_FP, **kwargs):
+    """
+    Reads a stage output saved as CSV, Parquet, or Arrow IPC.
+
+    Parameters
+    ----------
+    fp (str): File path ending in '.csv', '.parquet', or '.arrow' (or '.feather').
+    categorical (bool, optional): If True, the AgMIP schema is applied (see `apply_agmip_schema`). If False, the
+        dimensions are returned as strings. Defaults to True.
+    value_dtype (str, optional): dtype of the values in the AgMIP schema, 'float64' or 'float32'. Defaults to 'float64'.
+    template_fp (str, CompiledTemplate or None, optional): Template for the categories of the AgMIP schema. Defaults to the RuleTables of this package.
+    **kwargs: Passed to `pd.read_csv` for CSV files (e.g. index_col=0), ignored otherwise.
+
+    Returns
+    -------
+    pd.DataFrame: The stage output. The index is restored if it was saved.
+    """
+    file_format = stage_format(fp)
+    if file_format == 'csv':
+        df = pd.read_csv(fp, **kwargs)
+    elif file_format == 'parquet':
+        df = pq.read_table(fp).to_pandas()
+    else:
+        df = feather.read_table(fp).to_pandas()
+
+    if categorical:
+        return apply_agmip_schema(df, template_fp, value_dtype)
+    for col in DIMENSION_COLS:
+        if (col in df.columns) and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    return df
+
+def iter_stage(fp, chunk_rows=1<<20):
+    """
+    Reads a stage output (or a raw AgMIP submission) in chunks, so that files larger than the memory can be scanned.
+
+    Parquet files are read by row groups, Arrow IPC files by record batches (memory-mapped), and CSV files with the
+    streaming Arrow CSV reader (see `iter_csv_arrow`). The AgMIP schema is not applied.
+
+    Parameters
+    ----------
+    fp (str): File path ending in '.csv', '.parquet', or '.arrow' (or '.feather').
+    chunk_rows (int, optional): Number of rows of a Parquet chunk, and the approximate number of rows of a CSV chunk. Defaults to 2**20.
+
+    Yields
+    ------
+    pd.DataFrame: The next rows, indexed by their position in the file.
+    """
+    file_format = stage_format(fp)
+    if file_format == 'csv':
+        # imported here, as in AgMIP_read_raw_csv
+        from .helper import iter_csv_arrow
+        # about 100 bytes per CSV row
+        yield from iter_csv_arrow(fp, block_size=int(max(chunk_rows*100, 1<<20)))
+        return
+    if file_format == 'parquet':
+        batches = pq.ParquetFile(fp).iter_batches(batch_size=chunk_rows)
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(fp))
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    start = 0
+    for batch in batches:
+        df = batch.to_pandas()
+        df.index = pd.RangeIndex(start, start+len(df))
+        start += len(df)
+        yield df
+
+def export_csv(fp, csv_fp=None, index=True):
+    """
+    Exports a Parquet or Arrow IPC stage output to CSV.
+
+    Parameters
+    ----------
+    fp (str): File path of the stage output.
+    csv_fp (str or None, optional): File path of the CSV file. If None, `fp` with a '.csv' extension. Defaults to None.
+    index (bool, optional): Whether to save the index. Defaults to True.
+
+    Returns
+    -------
+    str: File path of the CSV file.
+    """
+    if csv_fp == None:
+        csv_fp = stage_fp(fp, 'csv')
+    read_stage(fp, categorical=False).to_csv(csv_fp, index=index)
+    return csv_fp
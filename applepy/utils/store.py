@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import shutil
+from urllib.parse import quote, unquote
+import numpy as np
+import pandas as pd
+
+from .storage import *
+
+# name of the manifest of a DatasetStore, in its root directory
+STORE_MANIFEST_FN = 'store.json'
+
+# columns identifying an entry of the dataset
+KEY_COLS = ['model','scenario','region','variable','item','unit','year']
+
+# columns of the existing rows replaced by an upsert, for each replace mode
+REPLACE_COLS = {'model':['model'],
+                'scenario':['model','scenario'],
+                'key':KEY_COLS
+                }
+
+# directory name of a missing partition value (as in hive-partitioned datasets)
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+def partition_dir(values, partition_cols):
+    """
+    Gets the directory of a partition, e.g. 'model=GLOBIOM/scenario=ELM_DIET' (hive layout, see `register_view`).
+
+    Parameters
+    ----------
+    values (tuple): Values of the partition columns.
+    partition_cols (list of str): Partition columns.
+
+    Returns
+    -------
+    str
+    """
+    parts = []
+    for col, value in zip(partition_cols, values):
+        value = NULL_PARTITION if pd.isna(value) else quote(str(value), safe='')
+        parts.append(f"{col}={value}")
+    return '/'.join(parts)
+
+def partition_values(name, partition_cols):
+    """
+    Gets the values of the partition columns from the directory of a partition (see `partition_dir`).
+
+    Returns
+    -------
+    tuple
+    """
+    values = []
+    for col, part in zip(partition_cols, name.split('/')):
+        value = part.split('=', 1)[1]
+        values.append(None if value == NULL_PARTITION else unquote(value))
+    return tuple(values)
+
+def key_index(df, cols):
+    """
+    Gets the keys of the rows of a DataFrame on some columns, comparable across DataFrames whatever their dtypes
+    (categoricals with different categories, strings, integer or float years).
+
+    Returns
+    -------
+    pd.MultiIndex
+    """
+    arrays = []
+    for col in cols:
+        values = df[col]
+        if col == 'year':
+            values = pd.to_numeric(values, errors='coerce').astype('float64')
+        else:
+            values = values.astype(object).where(values.notna(), None).astype(str)
+        arrays.append(values.to_numpy())
+    return pd.MultiIndex.from_arrays(arrays, names=cols)
+
+class DatasetStore:
+    """
+    Merged AgMIP dataset kept on disk as one file per partition (by model, and by scenario), updated in place with
+    `upsert` instead of rewriting the whole merged file.
+
+    An upsert only reads and writes the partitions it touches: replacing the four scenarios of one model in a
+    ten-model dataset writes the files of that model, and reads none with `replace='model'` or `replace='scenario'`.
+    The current version of the dataset is the set of files listed in the manifest (`STORE_MANIFEST_FN` in the root
+    directory). New partition files get the name of the new version, the manifest is then replaced atomically, and
+    the superseded files are deleted last, so that an interrupted upsert leaves the previous version readable.
+
+    The partitions are stage files (see `write_stage`) in a hive layout ('model=GLOBIOM/scenario=BAU/part-000003.parquet'),
+    so that the root directory can also be registered as a duckdb view (see `register_view`). There should be one
+    writer at a time.
+
+    Parameters
+    ----------
+    root (str): Root directory of the store. It is created if it does not exist, and the manifest is loaded if it does.
+    partition_cols (list or tuple of str, optional): Partition columns, ['model'] or ['model','scenario']. Must match
+        the manifest of an existing store. Defaults to ('model','scenario').
+    file_format (str, optional): Storage format of the partitions, 'parquet', 'arrow' or 'csv'. Defaults to 'parquet'.
+
+    Examples
+    --------
+    >>> store = DatasetStore('../data/store')
+    >>> store.upsert(merge_fps(fps))
+    >>> store.upsert(read_stage('GLOBIOM_pc-diff.parquet'), replace='scenario')
+    >>> df = store.read(model='GLOBIOM', scenario=['BAU','ELM'])
+    """
+    def __init__(self, root, partition_cols=('model','scenario'), file_format='parquet'):
+        assert list(partition_cols) in [['model'],['model','scenario']], "partition_cols should be ['model'] or ['model','scenario']"
+        assert file_format in STAGE_EXTENSIONS, f"file_format should be one of {list(STAGE_EXTENSIONS.keys())}"
+        self.root = root
+        self.manifest_fp = os.path.join(root, STORE_MANIFEST_FN)
+        os.makedirs(root, exist_ok=True)
+        self.manifest = {'version':0, 'partition_cols':list(partition_cols), 'file_format':file_format,
+                         'updated':None, 'partitions':{}, 'history':[]}
+        if os.path.exists(self.manifest_fp):
+            with open(self.manifest_fp) as f:
+                self.manifest = json.load(f)
+            assert self.manifest['partition_cols'] == list(partition_cols), f"the store is partitioned by {self.manifest['partition_cols']}"
+        self.partition_cols = self.manifest['partition_cols']
+        self.file_format = self.manifest['file_format']
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    def __len__(self):
+        return sum([partition['rows'] for partition in self.manifest['partitions'].values()])
+
+    def partitions(self):
+        """
+        Gets the partitions of the current version.
+
+        Returns
+        -------
+        pd.DataFrame: One row per partition, with the partition columns, 'file' (relative to the root directory), 'rows', 'bytes' and 'version'.
+        """
+        rows = [dict(zip(self.partition_cols, partition_values(name, self.partition_cols)), **partition)
+                for name, partition in sorted(self.manifest['partitions'].items())]
+        return pd.DataFrame(rows, columns=self.partition_cols+['file','rows','bytes','version'])
+
+    def files(self, **partitions):
+        """
+        Gets the files of the current version, optionally of some partitions only.
+
+        Parameters
+        ----------
+        **partitions: Values of the partition columns, a single value or a list (e.g. `model='GLOBIOM'`).
+
+        Returns
+        -------
+        list of str: Absolute paths.
+        """
+        names = self._select_partitions(partitions)
+        return [os.path.join(self.root, self.manifest['partitions'][name]['file']) for name in names]
+
+    def _select_partitions(self, partitions):
+        for col in partitions:
+            assert col in self.partition_cols, f"'{col}' is not a partition column of the store ({self.partition_cols})"
+        names = []
+        for name in sorted(self.manifest['partitions'].keys()):
+            values = dict(zip(self.partition_cols, partition_values(name, self.partition_cols)))
+            selected = True
+            for col, value in partitions.items():
+                value = [str(x) for x in value] if pd.api.types.is_list_like(value) else [str(value)]
+                selected &= values[col] in value
+            if selected:
+                names.append(name)
+        return names
+
+    def read(self, columns=None, **dims):
+        """
+        Reads the current version of the dataset, optionally a selection of it. The partitions that are not selected
+        are not read.
+
+        Parameters
+        ----------
+        columns (list of str or None, optional): Columns to keep. If None, all the columns. Defaults to None.
+        **dims: Values of columns to select, a single value or a list (e.g. `model='GLOBIOM'`, `scenario=['BAU','ELM']`).
+            The partition columns select the files that are read, the other columns filter their rows.
+
+        Returns
+        -------
+        pd.DataFrame: The selected rows (in the AgMIP schema), in partition order, with a fresh index.
+        """
+        fps = self.files(**{col:value for col, value in dims.items() if col in self.partition_cols})
+        if len(fps) == 0:
+            return pd.DataFrame(columns=KEY_COLS+['value'] if columns == None else columns)
+        df = concat_agmip([read_stage(fp) for fp in fps], ignore_index=True)
+        mask = np.ones(len(df), dtype=bool)
+        for col, value in dims.items():
+            if col not in self.partition_cols:
+                mask &= df[col].isin(list(value) if pd.api.types.is_list_like(value) else [value]).to_numpy()
+        if not mask.all():
+            df = df[mask].reset_index(drop=True)
+        return df if columns == None else df[list(columns)]
+
+    def upsert(self, new_df, replace='model'):
+        """
+        Inserts new data into the dataset, replacing the existing rows of its models, of its (model, scenario)
+        pairs, or of its keys.
+
+        As in `update_dataset`, the scenarios are upper-cased and the entries reported more than once in `new_df` are
+        dropped (no copy is kept). Only the partitions of the models (or the (model, scenario) pairs) of `new_df` are
+        touched; the existing rows of a touched partition are read only if some of them are kept, i.e. with
+        `replace='key'`, or with `replace='scenario'` on a store partitioned by model only.
+
+        Parameters
+        ----------
+        new_df (pd.DataFrame): New data, with the KEY_COLS columns.
+        replace (str, optional): Existing rows that are replaced (see REPLACE_COLS):
+            - 'model': all the rows of the models of `new_df` (as `update_dataset` with `full_replace=True`);
+            - 'scenario': the rows of the (model, scenario) pairs of `new_df`;
+            - 'key': the rows with the same (model, scenario, region, variable, item, unit, year) as a row of `new_df`.
+            Defaults to 'model'.
+
+        Returns
+        -------
+        dict: The new version, with the partitions written ('written', rows) and removed ('removed').
+        """
+        assert replace in REPLACE_COLS, f"replace should be one of {list(REPLACE_COLS.keys())}"
+        replace_cols = REPLACE_COLS[replace]
+        new_df = new_df.copy(deep=False)
+        new_df['scenario'] = replace_values(new_df.scenario, {x:str(x).upper() for x in new_df.scenario.dropna().unique()})
+        new_df = new_df.drop_duplicates(subset=KEY_COLS, keep=False)
+
+        # existing partitions touched by the new data: same model (or same model and scenario)
+        touch_cols = [col for col in self.partition_cols if col in replace_cols]
+        touched_values = set(new_df[touch_cols].drop_duplicates().itertuples(index=False, name=None))
+        touched_values = {tuple(None if pd.isna(x) else str(x) for x in values) for values in touched_values}
+        touched = [name for name in self.manifest['partitions']
+                   if partition_values(name, self.partition_cols)[:len(touch_cols)] in touched_values]
+
+        # rows of the touched partitions that are kept (none if whole partitions are replaced)
+        kept = {}
+        if not set(replace_cols).issubset(self.partition_cols):
+            new_keys = key_index(new_df, replace_cols)
+            for name in touched:
+                old_df = read_stage(os.path.join(self.root, self.manifest['partitions'][name]['file']))
+                old_df = old_df[~key_index(old_df, replace_cols).isin(new_keys)]
+                if len(old_df) > 0:
+                    kept[name] = old_df
+
+        new_parts = {}
+        if len(new_df) > 0:
+            for values, part_df in new_df.groupby(self.partition_cols, observed=True, dropna=False, sort=True):
+                values = values if isinstance(values, tuple) else (values,)
+                new_parts[partition_dir(values, self.partition_cols)] = part_df
+
+        version = self.version+1
+        partitions = dict(self.manifest['partitions'])
+        written, removed = {}, []
+        for name in sorted(set(touched) | set(new_parts.keys())):
+            parts = [part for part in [new_parts.get(name), kept.get(name)] if part is not None]
+            if len(parts) == 0:
+                partitions.pop(name)
+                removed.append(name)
+                continue
+            part_df = concat_agmip(parts, ignore_index=True)
+            file = f"{name}/part-{version:06d}{STAGE_EXTENSIONS[self.file_format]}"
+            fp = os.path.join(self.root, file)
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+            write_stage(part_df, fp, index=False)
+            partitions[name] = {'file':file, 'rows':len(part_df), 'bytes':os.path.getsize(fp), 'version':version}
+            written[name] = len(part_df)
+
+        superseded = [self.manifest['partitions'][name]['file'] for name in touched]
+        record = {'version':version, 'time':time.strftime('%Y-%m-%d %H:%M:%S'), 'replace':replace,
+                  'rows':len(new_df), 'written':written, 'removed':removed}
+        self._save_manifest(dict(self.manifest, version=version, updated=record['time'], partitions=partitions,
+                                 history=self.manifest['history']+[record]))
+        for file in superseded:
+            fp = os.path.join(self.root, file)
+            if os.path.exists(fp):
+                os.remove(fp)
+        for name in removed:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        return record
+
+    def _save_manifest(self, manifest):
+        # write to a temporary file first, so that an interrupted upsert never leaves a partial manifest
+        tmp_fp = f"{self.manifest_fp}.{os.getpid()}.tmp"
+        with open(tmp_fp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_fp, self.manifest_fp)
+        self.manifest = manifest
+
+    def vacuum(self):
+        """
+        Deletes the partition files that are not in the current version (e.g. left by an interrupted upsert).
+
+        Returns
+        -------
+        list of str: Deleted files, relative to the root directory.
+        """
+        current = {partition['file'] for partition in self.manifest['partitions'].values()}
+        deleted = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                file = os.path.relpath(os.path.join(dirpath, fn), self.root)
+                if fn.startswith('part-') and (file not in current):
+                    os.remove(os.path.join(dirpath, fn))
+                    deleted.append(file)
+        return deleted
@@ -0,0 +1,193 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+from .helper import *
+
+# bump when the compiled structure changes, so that old cache files are not reused
+TEMPLATE_CACHE_VERSION = 3
+
+# compiled templates already loaded in this process, keyed by (absolute path, mtime)
+_loaded_templates = {}
+
+class CompiledTemplate:
+    """
+    Parsed AgMIP template workbook, with its tables compiled into hashed lookup structures.
+
+    Two kinds of workbooks are supported:
+    - the myGeoHub `RuleTables.xlsx` (has a 'VariableUnitValueTable' sheet), used by the pipeline checks
+    - the AgMIP reporting template (has 'Variables' and 'Variables_extended' sheets), used by the coverage maps
+
+    Use `load_template` rather than creating this object directly, so that the parsed workbook is cached.
+
+    Attributes
+    ----------
+    template_fp (str): Absolute path of the workbook.
+    mtime (int): Modification time (ns) of the workbook when it was compiled.
+    tables (dict): RuleTables sheets as DataFrames, by sheet name (empty for the reporting template).
+    variables (list): Template variables, in template order.
+    variable_set (frozenset): Template variables, for membership tests.
+    units (dict): Allowed units (frozenset) by variable.
+    variable_units (frozenset): Allowed (variable, unit) pairs.
+    keep_variables (frozenset): Variables flagged with Keep==1, that bypass the overrides and template checks.
+    extended_variables (list): Variables of the 'Variables_extended' sheet (reporting template).
+    items (list): Item codes of the reporting template, in template order.
+    variable_items (dict): Items (frozenset) marked for each variable in the reporting template.
+    categories (dict): Template values of each dimension ('model', 'scenario', 'region', 'variable', 'item', 'unit'),
+        used as the categories of the AgMIP schema (see `apply_agmip_schema`).
+    """
+    def __init__(self, template_fp):
+        self.template_fp = os.path.abspath(template_fp)
+        self.mtime = os.stat(self.template_fp).st_mtime_ns
+        self.tables = {}
+        self.variables = []
+        self.variable_set = frozenset()
+        self.units = {}
+        self.variable_units = frozenset()
+        self.keep_variables = frozenset()
+        self.extended_variables = []
+        self.items = []
+        self.variable_items = {}
+        self.categories = {}
+
+        sheets = pd.ExcelFile(self.template_fp).sheet_names
+        if 'VariableUnitValueTable' in sheets:
+            self._compile_rule_tables()
+        elif 'Variables' in sheets:
+            self._compile_reporting_template()
+        else:
+            raise ValueError(f"{template_fp} is not a RuleTables workbook or an AgMIP reporting template")
+
+    def _compile_rule_tables(self):
+        self.tables = pd.read_excel(self.template_fp, sheet_name=None)
+        # keep the literal 'NaN', 'n/a', ... entries of the value fixes, they are the values to replace
+        self.tables['ValueFixTable'] = pd.read_excel(self.template_fp, sheet_name='ValueFixTable', keep_default_na=False, na_values=[''])
+        VariableUnitValueTable = self.tables['VariableUnitValueTable']
+
+        self.variables = list(pd.unique(VariableUnitValueTable.Variable.values))
+        self.variable_set = frozenset(self.variables)
+        self.units = {variable: frozenset(units.values) for variable, units in VariableUnitValueTable.groupby('Variable', sort=False).Unit}
+        self.variable_units = frozenset(zip(VariableUnitValueTable.Variable.values, VariableUnitValueTable.Unit.values))
+        self.keep_variables = frozenset(VariableUnitValueTable[VariableUnitValueTable.Keep==1].Variable.values)
+
+        def values(*cols):
+            return [x for x in pd.unique(pd.concat([col.dropna().astype(str) for col in cols]))]
+        self.categories = {'model':values(self.tables['ModelTable'].Model),
+                           'scenario':values(self.tables['ScenarioTable'].Scenario),
+                           'region':values(self.tables['RegionTable'].Region, self.tables['RegionFixTable'].Fix),
+                           'variable':values(VariableUnitValueTable.Variable, self.tables['VariableTable'].Variable),
+                           'item':values(self.tables['ItemTable'].Item),
+                           'unit':values(VariableUnitValueTable.Unit, self.tables['UnitTable'].Unit)
+                           }
+
+    def _compile_reporting_template(self):
+        AgMIP_xl = pd.read_excel(self.template_fp, "Variables")
+        AgMIP_extended = pd.read_excel(self.template_fp, "Variables_extended")
+        lookup = AgMIP_xl.iloc[0,:]
+
+        self.variables = list(AgMIP_xl.Variable[1:].unique())
+        self.variable_set = frozenset(self.variables)
+        self.units = {variable: frozenset(units.dropna().values) for variable, units in AgMIP_xl[1:].groupby('Variable', sort=False).Unit}
+        self.variable_units = frozenset((v,u) for v, units in self.units.items() for u in units)
+        self.extended_variables = list(AgMIP_extended.Variable.values)
+        self.items = list(lookup.values[3:-2])
+
+        item_cols = AgMIP_xl.columns.drop(['Variable','Description','Unit'])
+        marked = AgMIP_xl[item_cols]=='X'
+        for variable in self.variables:
+            if variable is not np.nan:
+                fdf = marked[AgMIP_xl.Variable==variable]
+                self.variable_items[variable] = frozenset(lookup[col] for col in item_cols if fdf[col].values[0])
+        self.categories = {'variable':[x for x in self.variables if x is not np.nan],
+                           'item':list(self.items)
+                           }
+
+def template_cache_fp(template_fp, cache_dir=None):
+    """
+    Gets the file path of the on-disk cache of a compiled template.
+
+    The cache file name is keyed by the absolute path and modification time of the workbook, so that editing the
+    workbook invalidates its cache.
+
+    Parameters
+    ----------
+    template_fp (str): Path of the template workbook.
+    cache_dir (str or None): Cache directory. If None, the APPLEPY_CACHE_DIR environment variable, or '~/.cache/applepy'.
+
+    Returns
+    -------
+    str: Path of the pickle file.
+    """
+    if cache_dir == None:
+        cache_dir = os.environ.get('APPLEPY_CACHE_DIR', os.path.join(os.path.expanduser('~'),'.cache','applepy'))
+    template_fp = os.path.abspath(template_fp)
+    key = f"{template_fp}|{os.stat(template_fp).st_mtime_ns}|{TEMPLATE_CACHE_VERSION}"
+    base_fn = os.path.splitext(os.path.basename(template_fp))[0]
+    return os.path.join(cache_dir, f"{base_fn}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pkl")
+
+def load_template(template_fp, cache_dir=None, use_cache=True):
+    """
+    Loads a compiled template, parsing the workbook only when needed.
+
+    The compiled template is looked up in this order: templates already loaded in this process, the on-disk cache
+    (see `template_cache_fp`), and finally the workbook itself, which is then compiled and cached.
+
+    Parameters
+    ----------
+    template_fp (str or CompiledTemplate): Path of the template workbook. A CompiledTemplate is returned as is.
+    cache_dir (str or None, optional): Cache directory (see `template_cache_fp`). Defaults to None.
+    use_cache (bool, optional): If False, the workbook is always parsed and no cache is written. Defaults to True.
+
+    Returns
+    -------
+    CompiledTemplate
+    """
+    if isinstance(template_fp, CompiledTemplate):
+        return template_fp
+
+    key = (os.path.abspath(template_fp), os.stat(template_fp).st_mtime_ns)
+    if use_cache and (key in _loaded_templates):
+        return _loaded_templates[key]
+
+    cache_fp = template_cache_fp(template_fp, cache_dir)
+    template = None
+    if use_cache and os.path.exists(cache_fp):
+        try:
+            template = loadPickle(cache_fp)
+        except Exception:
+            # unreadable cache, compile it again
+            template = None
+
+    if template == None:
+        template = CompiledTemplate(template_fp)
+        if use_cache:
+            try:
+                os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+                # write to a temporary file first so that concurrent workers never read a partial pickle
+                tmp_fp = f"{cache_fp}.{os.getpid()}.tmp"
+                savePickle(tmp_fp, template)
+                os.replace(tmp_fp, cache_fp)
+            except OSError:
+                pass
+
+    if use_cache:
+        _loaded_templates[key] = template
+    return template
+
+def init_template_worker(template_fps):
+    """
+    Pool initializer that loads the compiled templates once per worker process.
+
+    Parameters
+    ----------
+    template_fps (str or list of str): Template workbook path(s).
+
+    Returns
+    -------
+    None
+    """
+    if isinstance(template_fps, str):
+        template_fps = [template_fps]
+    for template_fp in template_fps:
+        load_template(template_fp)
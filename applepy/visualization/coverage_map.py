@@ -3,6 +3,8 @@ import seaborn as sns
 import numpy as np
 import matplotlib.pyplot as plt
 
+from ..utils.template import *
+
 def coverage_map(df):
     """
     Generates a heatmap to visualize the coverage of different models across variables and items.
@@ -30,7 +32,7 @@ def coverage_map(df):
     plt.figure(figsize=(10,10))
     sns.heatmap(summary_df,square=True,linewidths=1,cbar=False)
 
-def template_coverage_map(df):
+def template_coverage_map(df, template_fp = "../applepy/template/Reporting_template_AGMIP_2024-07-11.xlsx"):
     """
     Generates a heatmap to visualize the coverage of variables and items based on a given template and 
     input DataFrame. The function reads in a template Excel file, processes the variable-item mappings, 
@@ -43,24 +45,22 @@ def template_coverage_map(df):
     Parameters:
     -----------
     df (pd.DataFrame): A DataFrame containing 'variable' and 'item' columns to compare against the template.
+    template_fp (str, optional): Path of the AgMIP reporting template. Defaults to the 2024-07-11 template.
 
     Returns:
     --------
     None: Displays a heatmap using matplotlib and seaborn.
     """
-    template_fp = "../applepy/template/Reporting_template_AGMIP_2024-07-11.xlsx"
-    AgMIP_xl = pd.read_excel(template_fp,"Variables")
-    AgMIP_extended = pd.read_excel(template_fp,"Variables_extended")
-    lookup = AgMIP_xl.iloc[0,:]
+    # parsed once and cached, see load_template
+    template = load_template(template_fp)
     template_dict = {'variable':[],
                     'item':[]}
-    variables = AgMIP_xl.Variable[1:].unique()
-    extended_variables = AgMIP_extended.Variable.values
-    items = AgMIP_xl.iloc[0,:].values[3:-2]
+    variables = template.variables
+    extended_variables = template.extended_variables
+    items = template.items
     for variable in variables:
         if variable is not np.nan:
-            fdf = AgMIP_xl[AgMIP_xl.Variable==variable]
-            v_item = [AgMIP_xl.iloc[0,:][col] for col in fdf.columns.drop(['Variable','Description','Unit']) if fdf[col].values[0] == 'X']
+            v_item = [i for i in items if i in template.variable_items[variable]]
             for i in v_item:
                 template_dict['variable'].append(variable)
                 template_dict['item'].append(i)
@@ -102,21 +102,18 @@ def template_coverage_map(df):
     plt.figure(figsize=(15,15))
     sns.heatmap(summary_df_p,square=True,cmap='binary',vmax=1, xticklabels=True, yticklabels=True,linewidths=1,annot=annot,fmt='',cbar=False)
 
-def compare_template_coverage_map(df1,df2):   
+def compare_template_coverage_map(df1,df2, template_fp = "../applepy/template/Reporting_template_AGMIP_2024-07-11.xlsx"):   
 
-    template_fp = "../applepy/template/Reporting_template_AGMIP_2024-07-11.xlsx"
-    AgMIP_xl = pd.read_excel(template_fp,"Variables")
-    AgMIP_extended = pd.read_excel(template_fp,"Variables_extended")
-    lookup = AgMIP_xl.iloc[0,:]
+    # parsed once and cached, see load_template
+    template = load_template(template_fp)
     template_dict = {'variable':[],
                     'item':[]}
-    variables = AgMIP_xl.Variable[1:].unique()
-    extended_variables = AgMIP_extended.Variable.values
-    items = AgMIP_xl.iloc[0,:].values[3:-2]
+    variables = template.variables
+    extended_variables = template.extended_variables
+    items = template.items
     for variable in variables:
         if variable is not np.nan:
-            fdf = AgMIP_xl[AgMIP_xl.Variable==variable]
-            v_item = [AgMIP_xl.iloc[0,:][col] for col in fdf.columns.drop(['Variable','Description','Unit']) if fdf[col].values[0] == 'X']
+            v_item = [i for i in items if i in template.variable_items[variable]]
             for i in v_item:
                 template_dict['variable'].append(variable)
                 template_dict['item'].append(i)
@@ -0,0 +1,242 @@
+"""
+Benchmarks of the applepy processing stages on synthetic submissions (see synthetic.py).
+
+Each stage is timed at several sizes, and its wall time, rows/sec and peak memory are saved as JSON, to compare
+versions of applepy (or backends) on the same machine:
+
+    python benchmarks/run_benchmarks.py --sizes small medium --output before.json
+    python benchmarks/run_benchmarks.py --sizes small medium --output after.json
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+"""
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import psutil
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import applepy
+from applepy.utils.helper import *
+from applepy.utils.storage import *
+from applepy.utils.template import *
+from applepy.utils.preprocessing.checks import *
+from applepy.utils.preprocessing.merge import *
+from applepy.utils.calculations.bias_correction import *
+from applepy.utils.calculations.emissions import *
+from applepy.utils.calculations.land import *
+from applepy.utils.calculations.decomposition import *
+from applepy.utils.instrument import PeakMemory
+from synthetic import *
+
+# models of the submissions (all of them have emissions and land items, see model_emissions.json and model_land.json)
+MODELS = ['GLOBIOM','MAgPIE','IMAGE','AIM','GCAM','MAGNET','CAPRI','ENVISAGE']
+
+# submission parameters of each size (see make_submission), and the number of models
+SIZES = {'tiny':{'models':1, 'n_regions':3, 'n_variables':6, 'n_items':4},
+         'small':{'models':1, 'n_regions':5, 'n_variables':10, 'n_items':8},
+         'medium':{'models':2, 'n_regions':12, 'n_variables':25, 'n_items':12},
+         'large':{'models':4, 'n_regions':18, 'n_variables':40, 'n_items':20}
+         }
+
+STAGES = ['read_raw','check_duplicates','check_overrides','check_template','pc_diff_interp','emissions_calcs',
+          'land_calcs','merge_fps','decomposition']
+
+# stage whose output is the input of each stage
+STAGE_INPUTS = {'read_raw':None,
+                'check_duplicates':'read_raw',
+                'check_overrides':'check_duplicates',
+                'check_template':'check_overrides',
+                'pc_diff_interp':'check_template',
+                'emissions_calcs':'pc_diff_interp',
+                'land_calcs':'pc_diff_interp',
+                'merge_fps':'pc_diff_interp',
+                'decomposition':'pc_diff_interp'
+                }
+
+def run_stage(fn, repeat=1):
+    """
+    Runs a stage `repeat` times, with its output discarded.
+
+    Returns
+    -------
+    result: Output of the last run.
+    seconds (list of float): Wall time of each run.
+    peak_memory (int): Largest peak memory (bytes) of the runs, above the memory in use before the run.
+    """
+    seconds = []
+    peak_memory = 0
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            with PeakMemory() as memory:
+                start = time.perf_counter()
+                result = fn()
+                seconds.append(time.perf_counter()-start)
+        peak_memory = max(peak_memory, memory.used)
+    return result, seconds, peak_memory
+
+def benchmark_size(size, params, work_dir, stages=STAGES, repeat=1, backend='pandas', file_format='parquet', seed=0):
+    """
+    Generates the submissions of one size and times the stages on them, each stage taking the output of the previous one.
+
+    Returns
+    -------
+    list of dict: One record per stage.
+    """
+    params = dict(params)
+    n_models = params.pop('models')
+    data_dir = os.path.join(work_dir, size)
+    fps = []
+    overrides_fp = None
+    for i, model in enumerate(MODELS[:n_models]):
+        fp, overrides_fp = write_submission(data_dir, model, seed=seed+i, **params)
+        fps.append(fp)
+    template = load_template(DEFAULT_TEMPLATE_FP)
+    backend_kwargs = {} if backend == 'pandas' else {'backend':backend}
+
+    stage_fns = {}
+    stage_fns['read_raw'] = lambda: concat_agmip([AgMIP_read_raw_csv(fp) for fp in fps], ignore_index=True)
+    stage_fns['check_duplicates'] = lambda: check_duplicates(data['read_raw'], **backend_kwargs)[0]
+    stage_fns['check_overrides'] = lambda: check_overrides(data['check_duplicates'], overrides_fp, **backend_kwargs)[0]
+    stage_fns['check_template'] = lambda: check_template(data['check_overrides'], template, **backend_kwargs)[0]
+    stage_fns['pc_diff_interp'] = lambda: pc_diff_interp(data['check_template'], save=False, **backend_kwargs)
+    stage_fns['emissions_calcs'] = lambda: run_emissions_calcs(data['pc_diff_interp'], save=False)
+    stage_fns['land_calcs'] = lambda: run_land_calcs(data['pc_diff_interp'], save=False)
+    stage_fns['merge_fps'] = lambda: merge_fps(merge_inputs)
+    stage_fns['decomposition'] = lambda: decompose_all(data['pc_diff_interp'], **backend_kwargs)
+    # stages that are not timed still run once when a timed stage needs their output
+    needed = set()
+    for stage in stages:
+        while (stage != None) and (stage not in needed):
+            needed.add(stage)
+            stage = STAGE_INPUTS[stage]
+
+    data = {}
+    merge_inputs = []
+    records = []
+    for stage in STAGES:
+        if (stage == 'merge_fps') and (stage in needed):
+            # one pc-diff file per model, as merged in the data-processing notebook
+            pc_df = data['pc_diff_interp']
+            merge_dir = os.path.join(data_dir, 'pc-diff')
+            os.makedirs(merge_dir, exist_ok=True)
+            merge_inputs = []
+            for model, model_df in pc_df.groupby('model', observed=True):
+                merge_fp = stage_fp(os.path.join(merge_dir, f'{model}_pc-diff.csv'), file_format)
+                write_stage(model_df, merge_fp)
+                merge_inputs.append(merge_fp)
+        if stage not in needed:
+            continue
+        timed = stage in stages
+        result, seconds, peak_memory = run_stage(stage_fns[stage], repeat if timed else 1)
+        data[stage] = result
+        if not timed:
+            continue
+        if stage == 'read_raw':
+            rows_in = sum([len(pd.read_csv(fp, header=None, usecols=[0])) for fp in fps])
+        else:
+            rows_in = len(data[STAGE_INPUTS[stage]])
+        best = min(seconds)
+        records.append({'size':size,
+                        'stage':stage,
+                        'backend':backend,
+                        'models':n_models,
+                        'rows_in':int(rows_in),
+                        'rows_out':None if result is None else int(len(result)),
+                        'seconds':best,
+                        'seconds_all':seconds,
+                        'rows_per_sec':rows_in/best if best > 0 else None,
+                        'peak_memory_mb':peak_memory/2**20
+                        })
+        print(f"{size:>8} {stage:>17}: {rows_in:>9} rows in {best:8.3f} s, {records[-1]['rows_per_sec'] or 0:>12.0f} rows/s, {records[-1]['peak_memory_mb']:8.1f} MiB")
+    return records
+
+def environment():
+    """
+    Gets the versions and the machine of a benchmark run.
+    """
+    try:
+        commit = subprocess.run(['git','-C',REPO_DIR,'rev-parse','--short','HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    import numpy, pyarrow, polars
+    return {'applepy':applepy.__version__,
+            'commit':commit,
+            'python':platform.python_version(),
+            'pandas':pd.__version__,
+            'numpy':numpy.__version__,
+            'pyarrow':pyarrow.__version__,
+            'polars':polars.__version__,
+            'platform':platform.platform(),
+            'cpu_count':os.cpu_count(),
+            'memory_gb':psutil.virtual_memory().total/2**30,
+            'time':time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+
+def compare(base_fp, new_fp):
+    """
+    Prints the speedup and memory ratio of each stage and size between two benchmark results.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    with open(base_fp) as f:
+        base = pd.DataFrame(json.load(f)['results'])
+    with open(new_fp) as f:
+        new = pd.DataFrame(json.load(f)['results'])
+    cols = ['size','stage','rows_in','seconds','rows_per_sec','peak_memory_mb']
+    df = base[cols].merge(new[cols], on=['size','stage'], suffixes=('_base','_new'))
+    df['speedup'] = df.seconds_base/df.seconds_new
+    df['memory_ratio'] = df.peak_memory_mb_new/df.peak_memory_mb_base
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(df[['size','stage','rows_in_base','seconds_base','seconds_new','speedup','peak_memory_mb_base','peak_memory_mb_new','memory_ratio']])
+    return df
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['small','medium'], choices=list(SIZES.keys()), help='submission sizes (default: small medium)')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='stages to time (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each stage, the fastest is kept (default: 3)')
+    parser.add_argument('--backend', default='pandas', choices=BACKENDS, help='backend of the stages that have one (default: pandas)')
+    parser.add_argument('--file-format', default='parquet', choices=list(STAGE_EXTENSIONS.keys()), help='format of the merge_fps inputs (default: parquet)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic submissions (default: 0)')
+    parser.add_argument('--work-dir', default=None, help='directory of the synthetic submissions (default: a temporary directory, deleted at the end)')
+    parser.add_argument('--output', default=None, help="JSON file of the results (default: benchmarks/results/<commit>_<time>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE','NEW'), help='compare two JSON results instead of running the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    env = environment()
+    work_dir = args.work_dir if args.work_dir != None else tempfile.mkdtemp(prefix='applepy-benchmarks-')
+    try:
+        results = []
+        for size in args.sizes:
+            results += benchmark_size(size, SIZES[size], work_dir, args.stages, args.repeat, args.backend, args.file_format, args.seed)
+    finally:
+        if args.work_dir == None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output
+    if output == None:
+        output = os.path.join(REPO_DIR, 'benchmarks', 'results', f"{env['commit']}_{time.strftime('%y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'environment':env, 'settings':{k:v for k, v in vars(args).items() if k != 'compare'}, 'sizes':SIZES, 'results':results}, f, indent=2)
+    print(f">> Saving results to {output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pandas as pd
+
+# BAU and ELM, and each of them with one measure (BAU_<driver>) or all but one measure (ELM_<driver>)
+DRIVERS = ['DIET','PROD','WAST','MITI']
+SCENARIOS = ['BAU','ELM']+[f'{prefix}_{driver}' for prefix in ['BAU','ELM'] for driver in DRIVERS]
+
+YEARS = [2010,2020,2030,2040,2050]
+
+# variables and items needed by the emissions and land calcs, always generated first
+EMISSIONS_VARIABLES = ['ECH4','ECO2','EMIS','EN2O']
+LAND_ITEMS = ['AGR','CRP','GRS','ONV','FOR','ECP','LSP']
+
+# unit of the entries that fail the template check, and labels of the generated overrides file
+BAD_UNIT = 'badunit'
+BAD_REGION = 'World'
+DROPPED_ITEM = 'XXX'
+
+def template_dimensions(template_fp):
+    """
+    Gets the (variable, unit) pairs, regions and items of a RuleTables workbook, for realistic submissions.
+
+    Parameters
+    ----------
+    template_fp (str): RuleTables workbook.
+
+    Returns
+    -------
+    variable_units (list of tuple): (variable, unit) pairs, the emissions and land variables first.
+    regions (list of str): Regions, 'WLD' first.
+    items (list of str): Items, the land items first.
+    """
+    from applepy.utils.template import load_template
+    template = load_template(template_fp)
+    table = template.tables['VariableUnitValueTable'].dropna(subset=['Variable','Unit'])
+    table = table[~table.Variable.isin(template.keep_variables)].drop_duplicates(subset='Variable')
+    first = EMISSIONS_VARIABLES+['LAND']
+    variable_units = [(v, u) for v, u in zip(table.Variable, table.Unit) if v in first]
+    variable_units += [(v, u) for v, u in zip(table.Variable, table.Unit) if v not in first]
+    regions = [str(x) for x in template.tables['RegionTable'].Region.dropna()]
+    regions = ['WLD']+[x for x in regions if x != 'WLD']
+    items = [str(x) for x in template.tables['ItemTable'].Item.dropna()]
+    items = LAND_ITEMS+[x for x in items if x not in LAND_ITEMS]
+    return variable_units, regions, items
+
+def make_submission(model='GLOBIOM', n_regions=5, n_variables=10, n_items=6, scenarios=SCENARIOS, years=YEARS,
+                    base_year=2020, missing_base_year=0.1, no_bracket=0.01, duplicates=0.01, conflicting=0.5,
+                    unit_exceptions=0.005, overrides=0.005, template_fp=None, seed=0):
+    """
+    Generates a synthetic AgMIP submission of one model, with the issues the pipeline has to handle.
+
+    Every (variable, item, region) series is reported for all the scenarios and years, with values following a
+    random trend. Then:
+    - `missing_base_year` of the series skip the base year (it is interpolated by `pc_diff_interp`), and
+      `no_bracket` of them only report years after it (they cannot be interpolated);
+    - `duplicates` of the entries are reported twice, `conflicting` of these copies with a different value;
+    - `unit_exceptions` of the entries have a unit that is not in the template;
+    - `overrides` of the entries have a region to rename or an item to drop, listed in the overrides file.
+
+    Parameters
+    ----------
+    model (str, optional): Model name. Defaults to 'GLOBIOM'.
+    n_regions (int, optional): Number of regions (from the template, 'WLD' first). Defaults to 5.
+    n_variables (int, optional): Number of variables (from the template, the emissions and land variables first). Defaults to 10.
+    n_items (int, optional): Number of items (from the template, the land items first). Defaults to 6.
+    scenarios (list of str, optional): Scenarios. Defaults to SCENARIOS.
+    years (list of int, optional): Years. Defaults to YEARS.
+    base_year (int, optional): Base year of the percent changes. Defaults to 2020.
+    missing_base_year (float, optional): Share of the series without the base year. Defaults to 0.1.
+    no_bracket (float, optional): Share of the series with no year before the base year. Defaults to 0.01.
+    duplicates (float, optional): Share of the entries reported twice. Defaults to 0.01.
+    conflicting (float, optional): Share of the duplicates with a different value. Defaults to 0.5.
+    unit_exceptions (float, optional): Share of the entries with a unit that is not in the template. Defaults to 0.005.
+    overrides (float, optional): Share of the entries with an overridden region or item. Defaults to 0.005.
+    template_fp (str or None, optional): RuleTables workbook. Defaults to the RuleTables of applepy.
+    seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns
+    -------
+    df (pd.DataFrame): Submission, with the columns of a raw myGeoHub file, in random order.
+    overrides_df (pd.DataFrame): Overrides file, columns 'label', 'column', 'status'.
+    """
+    if template_fp == None:
+        from applepy.utils.storage import DEFAULT_TEMPLATE_FP
+        template_fp = DEFAULT_TEMPLATE_FP
+    rng = np.random.default_rng(seed)
+    variable_units, regions, items = template_dimensions(template_fp)
+    variable_units = variable_units[:n_variables]
+    regions = regions[:n_regions]
+    items = items[:n_items]
+
+    # one row per series
+    series = pd.MultiIndex.from_product([range(len(variable_units)), items, regions], names=['v','item','region']).to_frame(index=False)
+    n_series = len(series)
+    level = rng.lognormal(5, 2, n_series)
+    trend = rng.normal(0.01, 0.02, n_series)
+    # year sets of the series: all the years, no base year, or only years after the base year
+    kind = rng.choice(3, size=n_series, p=[1-missing_base_year-no_bracket, missing_base_year, no_bracket])
+    year_sets = [list(years),
+                 [y for y in years if y != base_year],
+                 [y for y in years if y > base_year]]
+
+    parts = []
+    for k, year_set in enumerate(year_sets):
+        idx = np.flatnonzero(kind==k)
+        if (len(idx)==0) or (len(year_set)==0):
+            continue
+        grid = pd.MultiIndex.from_product([idx, range(len(scenarios)), year_set], names=['s','scenario','year']).to_frame(index=False)
+        parts.append(grid)
+    grid = pd.concat(parts, ignore_index=True)
+    s = grid.s.to_numpy()
+    scenario_effect = rng.normal(0, 0.05, (n_series, len(scenarios)))
+    scenario_effect[:,0] = 0
+    value = level[s]*(1+trend[s])**(grid.year.to_numpy()-years[0])*(1+scenario_effect[s, grid.scenario.to_numpy()])
+
+    df = pd.DataFrame({'model':model,
+                       'scenario':np.asarray(scenarios, dtype=object)[grid.scenario.to_numpy()],
+                       'region':series.region.to_numpy()[s],
+                       'variable':np.asarray([v for v, u in variable_units], dtype=object)[series.v.to_numpy()[s]],
+                       'item':series.item.to_numpy()[s],
+                       'unit':np.asarray([u for v, u in variable_units], dtype=object)[series.v.to_numpy()[s]],
+                       'year':grid.year.to_numpy(),
+                       'value':np.round(value, 3)})
+
+    n = len(df)
+    # template exceptions and overridden entries
+    bad = rng.random(n) < unit_exceptions
+    df.loc[bad, 'unit'] = BAD_UNIT
+    overridden = rng.random(n) < overrides
+    renamed = overridden & (rng.random(n) < 0.5)
+    df.loc[renamed, 'region'] = BAD_REGION
+    df.loc[overridden & ~renamed, 'item'] = DROPPED_ITEM
+
+    # duplicates, some of them with a different value
+    copies = df[rng.random(n) < duplicates].copy()
+    conflict = rng.random(len(copies)) < conflicting
+    copies.loc[conflict, 'value'] = np.round(copies.value[conflict]*(1+rng.uniform(0.01, 0.1, conflict.sum())), 3)
+    df = pd.concat([df, copies], ignore_index=True)
+    df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+    overrides_df = pd.DataFrame({'label':[BAD_REGION, DROPPED_ITEM, BAD_UNIT],
+                                 'column':['Region', 'Item', 'Unit'],
+                                 'status':['WLD', 'FALSE', 'TRUE']})
+    return df, overrides_df
+
+def write_submission(data_dir, model='GLOBIOM', **kwargs):
+    """
+    Generates a synthetic submission (see `make_submission`) and saves it as a raw myGeoHub file, with its overrides
+    file, as in the submissions folder of `el2_pipeline_multiprocess`.
+
+    Parameters
+    ----------
+    data_dir (str): Output directory.
+    model (str, optional): Model name. Defaults to 'GLOBIOM'.
+    **kwargs: Passed to `make_submission`.
+
+    Returns
+    -------
+    fp (str): Path of the submission ('<data_dir>/<model>.csv').
+    overrides_fp (str): Path of the overrides file ('<data_dir>/<model>_OVERRIDES_fix.csv').
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    df, overrides_df = make_submission(model, **kwargs)
+    fp = os.path.join(data_dir, model+'.csv')
+    overrides_fp = os.path.join(data_dir, model+'_OVERRIDES_fix.csv')
+    df.to_csv(fp, index=False, header=False)
+    overrides_df.to_csv(overrides_fp, index=False, header=False)
+    return fp, overrides_fp
@@ -0,0 +1,44 @@
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+from synthetic import make_submission, write_submission
+
+# columns of an AgMIP entry, in the order the entries are compared
+KEY_COLS = ['model','scenario','region','variable','item','unit','year']
+
+def canonical(df, cols=None):
+    """
+    Sorts entries by key, with the dimensions as strings, to compare DataFrames whatever their row order and schema.
+    """
+    df = df.reset_index(drop=True).copy()
+    for col in KEY_COLS[:-1]:
+        df[col] = df[col].astype(str)
+    df['year'] = df.year.astype(float)
+    cols = list(df.columns) if cols == None else list(cols)
+    return df.sort_values(KEY_COLS, kind='stable').reset_index(drop=True)[cols]
+
+@pytest.fixture
+def submission():
+    """
+    Small synthetic submission with base years to interpolate, series that cannot be interpolated and duplicates.
+    """
+    df, _ = make_submission(n_regions=3, n_variables=5, n_items=4, missing_base_year=0.3, no_bracket=0.05, seed=1)
+    return df
+
+@pytest.fixture
+def submission_dir(tmp_path):
+    """
+    Raw submission files of three models, and a later file of one of them, as in a submissions folder.
+    """
+    fps = [write_submission(str(tmp_path), model, n_regions=3, n_variables=5, n_items=4, seed=i)[0]
+           for i, model in enumerate(['GLOBIOM','MAgPIE','IMAGE'])]
+    update_df, _ = make_submission('GLOBIOM', n_regions=3, n_variables=5, n_items=4, seed=42)
+    update_df.loc[update_df.scenario=='ELM_DIET', 'scenario'] = 'ELM_Diet'
+    update_fp = os.path.join(str(tmp_path), 'GLOBIOM2.csv')
+    update_df.to_csv(update_fp, index=False, header=False)
+    return fps+[update_fp]
@@ -0,0 +1,20 @@
+import io
+import contextlib
+from pandas.testing import assert_frame_equal
+from applepy.utils.calculations.bias_correction import pc_diff_frame, pc_diff_loop
+from applepy.utils.preprocessing.checks import check_duplicates
+from conftest import canonical, make_submission
+
+def test_pc_diff_frame_matches_loop(submission):
+    # pc-diff input of the pipeline: entries reported more than once are dropped first
+    with contextlib.redirect_stdout(io.StringIO()):
+        df, _ = check_duplicates(submission)
+    frame_df = pc_diff_frame(df)
+    loop_df = pc_diff_loop(df)
+    assert list(frame_df.columns) == list(loop_df.columns)
+    assert frame_df.percent_change_BAU.notna().any()
+    assert_frame_equal(canonical(frame_df), canonical(loop_df))
+
+def test_pc_diff_frame_matches_loop_missing_base_years():
+    df, _ = make_submission(n_regions=2, n_variables=4, n_items=3, missing_base_year=0.5, no_bracket=0.1, duplicates=0, seed=7)
+    assert_frame_equal(canonical(pc_diff_frame(df)), canonical(pc_diff_loop(df)))
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from applepy.utils.preprocessing.checks import check_duplicates, find_duplicates
+from applepy.utils.storage import write_stage
+from conftest import KEY_COLS
+
+def drop_duplicates(df):
+    # duplicates check before the fingerprints: exact copies kept once, conflicting entries set aside
+    clean_df = df.drop_duplicates(subset=KEY_COLS+['value'])
+    duplicated = clean_df.duplicated(subset=KEY_COLS, keep=False)
+    return clean_df[~duplicated], clean_df[duplicated]
+
+def test_check_duplicates_matches_drop_duplicates(submission):
+    clean_df, duplicates_df = check_duplicates(submission)
+    expected_clean, expected_duplicates = drop_duplicates(submission)
+    assert len(duplicates_df) > 0
+    assert_frame_equal(clean_df, expected_clean)
+    assert_frame_equal(duplicates_df, expected_duplicates)
+
+def test_check_duplicates_missing_keys_and_values(submission):
+    df = submission.copy()
+    df.loc[df.index[:20], 'region'] = np.nan
+    df.loc[df.index[40:60], 'value'] = np.nan
+    df = pd.concat([df, df.iloc[:10], df.iloc[40:50]])
+    clean_df, duplicates_df = check_duplicates(df)
+    expected_clean, expected_duplicates = drop_duplicates(df)
+    assert_frame_equal(clean_df, expected_clean)
+    assert_frame_equal(duplicates_df, expected_duplicates)
+
+def test_find_duplicates_streams_files(submission, tmp_path):
+    df = submission.reset_index(drop=True)
+    exact, conflicting = find_duplicates(df)
+    for file_format in ['csv','parquet']:
+        fp = str(tmp_path/f'submission.{file_format}')
+        write_stage(df, fp)
+        file_exact, file_conflicting = find_duplicates(fp, chunk_rows=1000, max_memory=1<<14)
+        assert (file_exact.to_numpy() == exact.to_numpy()).all()
+        assert (file_conflicting.to_numpy() == conflicting.to_numpy()).all()
@@ -0,0 +1,18 @@
+from pandas.testing import assert_frame_equal
+from applepy.utils.helper import AgMIP_read_raw_csv
+from applepy.utils.preprocessing.merge import merge_raw, update_dataset
+
+def fold_update_dataset(fps):
+    # merge before the one-pass merge: each file folded in with update_dataset
+    old_df = AgMIP_read_raw_csv(fps[0])
+    for update_fp in fps[1:]:
+        old_df = update_dataset(old_df, AgMIP_read_raw_csv(update_fp))
+    return old_df
+
+def test_merge_raw_matches_update_dataset_fold(submission_dir):
+    merged_df = merge_raw(submission_dir)
+    assert_frame_equal(merged_df, fold_update_dataset(submission_dir))
+    assert set(merged_df.scenario.unique()) == set(x.upper() for x in merged_df.scenario.unique())
+
+def test_merge_raw_concurrent_reads(submission_dir):
+    assert_frame_equal(merge_raw(submission_dir, workers=2), merge_raw(submission_dir, workers=1))
@@ -0,0 +1,50 @@
+import io
+import contextlib
+import warnings
+from pandas.testing import assert_frame_equal
+from applepy.pipeline.pipeline import el2_pipeline
+from applepy.utils.storage import DEFAULT_TEMPLATE_FP
+from applepy.utils.instrument import RunReport, active_report
+from conftest import canonical, write_submission
+
+def test_pipeline_backends_match(tmp_path):
+    fp, overrides_fp = write_submission(str(tmp_path), 'GLOBIOM', n_regions=3, n_variables=6, n_items=4, seed=3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pandas_df = el2_pipeline(fp, template_fp=DEFAULT_TEMPLATE_FP, save=False)
+        # polars warns from its engine (an error filter is ignored there), the deprecations are recorded instead
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', DeprecationWarning)
+            polars_df = el2_pipeline(fp, template_fp=DEFAULT_TEMPLATE_FP, save=False, backend='polars')
+    assert [str(w.message) for w in caught if issubclass(w.category, DeprecationWarning)] == []
+    assert len(pandas_df) > 0
+    assert list(pandas_df.columns) == list(polars_df.columns)
+    assert_frame_equal(canonical(pandas_df), canonical(polars_df), check_dtype=False)
+
+def test_pipeline_report_records_substages(tmp_path):
+    fp, overrides_fp = write_submission(str(tmp_path), 'GLOBIOM', n_regions=3, n_variables=6, n_items=4, seed=3)
+    report = RunReport('GLOBIOM', live_interval=None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        el2_pipeline(fp, template_fp=DEFAULT_TEMPLATE_FP, save=False, report=report)
+    parents = {record.name:record.parent for record in report.stages}
+    assert parents['pc-diff'] == None
+    assert parents['pc_diff_interp'] == 'pc-diff'
+    # the report is only active during the run
+    assert active_report() == None
+
+def test_multiprocess_isolates_dead_workers(tmp_path, monkeypatch):
+    import os
+    import applepy.pipeline.pipeline as pipeline
+    for i, model in enumerate(['GLOBIOM','AIM']):
+        write_submission(str(tmp_path), model, n_regions=2, n_variables=5, n_items=3, seed=i)
+    el2_pipeline = pipeline.el2_pipeline
+    def dying_pipeline(df, *args, **kwargs):
+        # the worker of AIM dies, as when killed out of memory
+        if df.model.iloc[0] == 'AIM':
+            os._exit(9)
+        return el2_pipeline(df, *args, **kwargs)
+    monkeypatch.setattr(pipeline, 'el2_pipeline', dying_pipeline)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = pipeline.el2_pipeline_multiprocess(str(tmp_path), DEFAULT_TEMPLATE_FP, workers=2)
+    assert [result['status'] for result in results] == ['failed', 'done']
+    assert results[0]['error'].startswith('worker died')
+    assert sorted(results[0]) == sorted(results[1])
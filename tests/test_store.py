@@ -0,0 +1,51 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from applepy.utils.preprocessing.merge import update_dataset
+from applepy.utils.store import DatasetStore
+from conftest import KEY_COLS, canonical, make_submission
+
+MODELS = ['GLOBIOM','MAgPIE','IMAGE']
+SCENARIOS = ['BAU','ELM','BAU_DIET','ELM_DIET']
+
+def submissions():
+    dfs = [make_submission(model, n_regions=3, n_variables=5, n_items=4, seed=i)[0] for i, model in enumerate(MODELS)]
+    return pd.concat(dfs, ignore_index=True)
+
+def test_upsert_matches_update_dataset(tmp_path):
+    full_df = submissions()
+    store = DatasetStore(str(tmp_path/'store'))
+    store.upsert(full_df)
+    base_df = canonical(store.read(), KEY_COLS+['value'])
+    assert_frame_equal(base_df, canonical(update_dataset(full_df.iloc[:0].copy(), full_df.copy()), KEY_COLS+['value']))
+
+    # a model replaced, as by update_dataset
+    new_df = make_submission('IMAGE', n_regions=3, n_variables=5, n_items=4, seed=99)[0]
+    expected_df = update_dataset(store.read(), new_df.copy())
+    store.upsert(new_df, replace='model')
+    assert_frame_equal(canonical(store.read(), KEY_COLS+['value']), canonical(expected_df, KEY_COLS+['value']))
+
+def test_upsert_scenarios(tmp_path):
+    full_df = submissions()
+    store = DatasetStore(str(tmp_path/'store'))
+    store.upsert(full_df)
+    base_df = canonical(store.read(), KEY_COLS+['value'])
+    new_df = make_submission('IMAGE', n_regions=3, n_variables=5, n_items=4, seed=99)[0]
+    new_df = new_df[new_df.scenario.isin(SCENARIOS)]
+    result = store.upsert(new_df, replace='scenario')
+    assert all(key.startswith('model=IMAGE') for key in result['written'])
+    replaced = (base_df.model=='IMAGE') & base_df.scenario.isin(SCENARIOS)
+    expected_df = pd.concat([update_dataset(new_df.copy(), new_df.copy()), base_df[~replaced]])
+    assert_frame_equal(canonical(store.read(), KEY_COLS+['value']), canonical(expected_df, KEY_COLS+['value']))
+    # reopened from its manifest
+    assert len(DatasetStore(str(tmp_path/'store'))) == len(store)
+
+def test_upsert_keys(tmp_path):
+    full_df = submissions()
+    store = DatasetStore(str(tmp_path/'store'))
+    store.upsert(full_df)
+    before_df = canonical(store.read(), KEY_COLS+['value'])
+    update_df = before_df[before_df.model=='GLOBIOM'].sample(20, random_state=0).assign(value=-1.0)
+    store.upsert(update_df, replace='key')
+    expected_df = before_df.merge(update_df, on=KEY_COLS, how='left', suffixes=('','_update'))
+    expected_df['value'] = expected_df.value_update.fillna(expected_df.value)
+    assert_frame_equal(canonical(store.read(), KEY_COLS+['value']), canonical(expected_df, KEY_COLS+['value']))